@@ -44,3 +44,44 @@ def test_search(samp_key):
         for key in CHECK_KEYS:
             for x in r["d"]["results"]:
                 assert key in x
+
+def fake_search(auth, query, **params):
+    """
+    Return a page of the 120 results of every query.
+    """
+
+    skip, top = params["$skip"], params["$top"]
+    results = [{"ID": "%s-%d" % (query, i)}
+               for i in range(skip, min(skip + top, 120))]
+    return {"d": {"results": results}}, 200
+
+def test_search_iter(monkeypatch):
+    """
+    Pages are yielded in rank order, till the first short page.
+    """
+
+    calls = []
+    def search(auth, query, **params):
+        calls.append(params["$skip"])
+        return fake_search(auth, query, **params)
+    monkeypatch.setattr(bing, "search", search)
+
+    results = list(bing.search_iter("key", "q", maxitems=1000, depth=4))
+    assert [r["ID"] for r in results] == ["q-%d" % i for i in range(120)]
+    assert max(calls) <= 50 * 6
+
+    results = list(bing.search_iter("key", "q", maxitems=70, depth=4))
+    assert [r["ID"] for r in results] == ["q-%d" % i for i in range(70)]
+
+def test_search_many(monkeypatch):
+    """
+    All the queries are searched.
+    """
+
+    monkeypatch.setattr(bing, "search", fake_search)
+
+    queries = ["q%d" % i for i in range(10)]
+    results = dict(bing.search_many(["k1", "k2"], queries, maxitems=100))
+    assert sorted(results) == queries
+    for query in queries:
+        assert len(results[query]) == 100
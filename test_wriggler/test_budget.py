@@ -0,0 +1,77 @@
+"""
+Test the retry budgets.
+"""
+
+import wriggler.budget as budget
+import wriggler.workers as workers
+
+def test_retry_budget(monkeypatch):
+    """
+    Retries are limited by the successes in the window.
+    """
+
+    clock = [1000.0]
+    monkeypatch.setattr(budget.time, "time", lambda: clock[0])
+
+    retry = budget.RetryBudget(ratio=0.5, window=10, minimum=2)
+    assert [retry.can_retry() for _ in range(3)] == [True, True, False]
+
+    for _ in range(4):
+        retry.success()
+    assert [retry.can_retry() for _ in range(3)] == [True, True, False]
+    assert retry.stats() == {"successes": 4, "retries": 4}
+
+    # Everything expires out of the window
+    clock[0] += 10
+    assert retry.stats() == {"successes": 0, "retries": 0}
+    assert retry.can_retry()
+
+def test_parent_budget():
+    """
+    Job budgets also draw from their parent.
+    """
+
+    parent = budget.RetryBudget(ratio=0, minimum=3)
+    job1 = budget.RetryBudget(ratio=0, minimum=2, parent=parent)
+    job2 = budget.RetryBudget(ratio=0, minimum=2, parent=parent)
+
+    assert job1.can_retry() and job1.can_retry()
+    assert not job1.can_retry()
+    assert job2.can_retry()
+    assert not job2.can_retry()
+    assert parent.stats()["retries"] == 3
+
+    job1.success()
+    assert parent.stats()["successes"] == 1
+
+def test_use():
+    """
+    The job budget is used in the thread, and in worker threads.
+    """
+
+    job = budget.RetryBudget()
+    assert budget.job() is None
+    with budget.use(job):
+        assert budget.current("api.twitter.com") is job
+        found = list(workers.imap(lambda auth, item: budget.current(),
+                                  range(4), [None, None]))
+        assert all(b is job for b in found)
+    assert budget.job() is None
+
+def test_host_budgets(monkeypatch):
+    """
+    Budgets are opt in, and kept per host once enabled.
+    """
+
+    monkeypatch.setattr(budget, "hosts", None)
+    assert budget.current("a.example.com") is budget.unlimited
+
+    budget.enable(ratio=0, minimum=1)
+    try:
+        first = budget.current("a.example.com")
+        assert first is budget.current("a.example.com")
+        assert first.can_retry() and not first.can_retry()
+        assert budget.current("b.example.com").can_retry()
+    finally:
+        budget.disable()
+    assert budget.current("a.example.com") is budget.unlimited
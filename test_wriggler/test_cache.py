@@ -0,0 +1,47 @@
+"""
+Test the expiring LRU cache.
+"""
+
+import time
+
+import wriggler.cache as cache
+
+def test_lru():
+    """
+    Least recently used entries are evicted first.
+    """
+
+    c = cache.TTLCache(maxsize=2, ttl=60)
+    c.put("a", 1)
+    c.put("b", 2)
+    assert c.get("a") == 1
+    c.put("c", 3)
+
+    assert c.get("b") is None
+    assert c.get("a") == 1
+    assert c.get("c") == 3
+    assert c.stats() == {"hits": 3, "misses": 1, "hit_rate": 0.75, "size": 2}
+
+def test_ttl():
+    """
+    Expired entries are not returned.
+    """
+
+    c = cache.TTLCache(ttl=0.1)
+    c.put("a", 1)
+    assert c.get("a") == 1
+    time.sleep(0.2)
+    assert c.get("a") is None
+
+def test_spill(tmpdir):
+    """
+    Evicted entries come back from the spill file.
+    """
+
+    c = cache.TTLCache(maxsize=2, ttl=60, spill=str(tmpdir.join("c.db")))
+    for key in "abcd":
+        c.put(key, key.upper())
+
+    for key in "abcd":
+        assert c.get(key) == key.upper()
+    assert c.stats()["size"] == 2
@@ -0,0 +1,69 @@
+"""
+Test the compressed sparse row graph store.
+"""
+
+import random
+
+import pytest
+
+from wriggler.csr import CSRWriter, CSRGraph
+from wriggler.mmarray import MappedView
+
+def cursor_pages(ids, fail=False):
+    """
+    Yield the ids in pages, like cursor_iter.
+    """
+
+    for start in range(0, len(ids), 3):
+        yield {"ids": ids[start:start + 3]}, {"code": 200}
+    if fail:
+        yield {"errors": []}, {"code": 401}
+
+def test_csr(tmpdir):
+    """
+    Neighbors written in pages are read back by user id.
+    """
+
+    dirname = str(tmpdir.join("graph"))
+    graph = {}
+    for _ in range(50):
+        user_id = random.randint(1, 2 ** 62)
+        graph[user_id] = [random.randint(1, 2 ** 62)
+                          for _ in range(random.randint(0, 20))]
+
+    with CSRWriter(dirname) as writer:
+        for user_id, ids in graph.items():
+            count = writer.add_pages(user_id, cursor_pages(ids, True))
+            assert count == len(ids)
+
+    with CSRGraph(dirname) as csr:
+        assert len(csr) == len(graph)
+        assert csr.nedges == sum(len(ids) for ids in graph.values())
+        for user_id, ids in graph.items():
+            assert user_id in csr
+            assert csr.neighbors(user_id) == ids
+            assert csr.degree(user_id) == len(ids)
+        assert dict(csr.iteritems()) == graph
+
+        # Neighbors are views of the mapped file, not copies
+        user_id = max(graph, key=lambda u: len(graph[u]))
+        view = csr.neighbors(user_id)
+        assert isinstance(view, MappedView)
+        assert list(view) == graph[user_id]
+        assert view[-1] == graph[user_id][-1]
+        assert view[1:3] == graph[user_id][1:3]
+
+        assert 0 not in csr
+        with pytest.raises(KeyError):
+            csr.neighbors(0)
+
+def test_csr_empty(tmpdir):
+    """
+    An empty graph can be read.
+    """
+
+    dirname = str(tmpdir.join("graph"))
+    CSRWriter(dirname).close()
+    with CSRGraph(dirname) as csr:
+        assert len(csr) == 0
+        assert 1 not in csr
@@ -3,6 +3,10 @@ Test the Foursquare API
 """
 
 import json
+import math
+import random
+import time
+
 import pytest
 import wriggler.foursquare as fsq
 
@@ -45,3 +49,139 @@ def test_lookup(samp_key):
         for key in CHECK_KEYS:
             assert key in results["response"]
         assert len(results["response"]["groups"]) > 0
+
+def fake_explore(venues, calls):
+    """
+    Return a venues_explore over the venues, recording the calls.
+    """
+
+    def explore(auth, **params):
+        calls.append(params)
+        lat, lng = [float(x) for x in params["ll"].split(",")]
+        scale = math.cos(math.radians(lat))
+        found = []
+        for venue in venues:
+            dy = (venue["location"]["lat"] - lat) * 111320.0
+            dx = (venue["location"]["lng"] - lng) * 111320.0 * scale
+            if math.hypot(dx, dy) <= params["radius"]:
+                found.append(venue)
+        items = [{"venue": v} for v in found[:params["limit"]]]
+        resp = {"totalResults": len(found), "groups": [{"items": items}]}
+        return {"response": resp}, 200
+
+    return explore
+
+def test_venues_sweep(monkeypatch):
+    """
+    The sweep finds all venues with fewer calls than a uniform grid.
+    """
+
+    random.seed(42)
+
+    # A dense center and sparse suburbs
+    venues = []
+    for i in range(2000):
+        if i < 1500:
+            lat, lng = random.gauss(0.5, 0.02), random.gauss(0.5, 0.02)
+        else:
+            lat, lng = random.random(), random.random()
+        venues.append({"id": str(i), "location": {"lat": lat, "lng": lng}})
+
+    calls = []
+    monkeypatch.setattr(fsq, "venues_explore", fake_explore(venues, calls))
+
+    found = list(fsq.venues_sweep("key", (0.0, 0.0), (1.0, 1.0),
+                                  nthreads=4, min_size=0.0001))
+    ids = [v["id"] for v in found]
+    assert len(ids) == len(set(ids))
+    assert set(ids) == set(v["id"] for v in venues)
+
+    # A uniform grid fine enough for the center needs thousands
+    assert len(calls) < 400
+
+def test_venues_sweep_large(monkeypatch):
+    """
+    Boxes larger than the largest radius are covered to the corners.
+    """
+
+    random.seed(7)
+    venues = [{"id": str(i), "location": {"lat": random.uniform(0, 4),
+                                          "lng": random.uniform(0, 4)}}
+              for i in range(30)]
+
+    calls = []
+    monkeypatch.setattr(fsq, "venues_explore", fake_explore(venues, calls))
+
+    found = list(fsq.venues_sweep("key", (0.0, 0.0), (4.0, 4.0)))
+    assert sorted(v["id"] for v in found) == sorted(v["id"] for v in venues)
+    assert all(c["radius"] <= fsq.EXPLORE_RADIUS_MAX for c in calls)
+
+class FakeResponse(object):
+    """
+    Response with rate limit headers.
+    """
+
+    def __init__(self, status_code, remaining, reset):
+        self.status_code = status_code
+        self.headers = {"X-RateLimit-Remaining": str(remaining),
+                        "X-RateLimit-Reset": str(reset),
+                        "date": time.strftime("%a, %d %b %Y %H:%M:%S GMT",
+                                              time.gmtime())}
+        self.text = "{}"
+
+    def json(self):
+        return {"meta": {"code": self.status_code}, "response": {}}
+
+def test_multi_auth(monkeypatch):
+    """
+    Exhausted credentials are skipped without blocking.
+    """
+
+    reset = int(time.time()) + 3600
+    remaining = {"a": 2, "b": 1}
+    used = []
+
+    def fake_get(endpoint, params, **kwargs):
+        cid = params["client_id"]
+        used.append(cid)
+        remaining[cid] -= 1
+        return FakeResponse(200, remaining[cid], reset)
+
+    monkeypatch.setattr(fsq.req, "get", fake_get)
+
+    keys = [{"client_id": cid, "client_secret": "s"} for cid in "ab"]
+    pool = fsq.MultiAuth(keys)
+
+    start = time.time()
+    for _ in range(3):
+        _, code = fsq.venues_explore(pool, ll="0,0")
+        assert code == 200
+    assert time.time() - start < 1
+
+    assert sorted(used) == ["a", "a", "b"]
+    assert pool.state.lease(pool.slots)[0] is None
+
+def test_server_error(monkeypatch):
+    """
+    Server errors without headers wait, and leave the rate limit alone.
+    """
+
+    reset = int(time.time()) + 3600
+    responses = [FakeResponse(200, 10, reset), FakeResponse(500, 0, 0),
+                 FakeResponse(200, 9, reset)]
+    responses[1].headers = {}
+
+    monkeypatch.setattr(fsq.req, "get",
+                        lambda endpoint, params, **kwargs: responses.pop(0))
+    sleeps = []
+    monkeypatch.setattr(fsq.time, "sleep", sleeps.append)
+
+    pool = fsq.MultiAuth([{"client_id": "a", "client_secret": "s"}])
+    fsq.venues_explore(pool, ll="0,0")
+    assert tuple(pool.state.get("a")) == (10, reset)
+
+    _, code = fsq.venues_explore(pool, ll="0,0")
+    assert code == 200
+    assert sleeps == [fsq.const.API_RETRY_AFTER]
+    # Two calls leased since the last header; not parked at 0
+    assert tuple(pool.state.get("a")) == (8, reset)
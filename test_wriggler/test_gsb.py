@@ -5,6 +5,7 @@ Test the Google safebrowsing api
 import pytest
 
 import wriggler.gsb as gsb
+import wriggler.cache as cache
 
 URLS = [
         "http://slashdot.org",
@@ -33,3 +34,65 @@ def test_lookup(samp_key):
         for u in URLS:
             assert response[u] in ("phishing", "malware", "phishing,malware", "ok")
 
+def test_make_body():
+    """
+    Bodies are within the size limit and have no duplicate urls.
+    """
+
+    urls = ["http://example.com/%d" % (i % 3000) for i in range(6000)]
+    urls.append("HTTP://Example.COM/0#frag")
+
+    seen = []
+    for pairs, canons, body, known in gsb.make_body(urls):
+        assert not known
+        lines = body.split("\n")
+        assert len(body) <= gsb.MAX_SIZE
+        assert int(lines[0]) == len(canons) <= gsb.MAX_URLS
+        assert lines[1:] == canons
+        assert len(set(canons)) == len(canons)
+        seen.extend(url for url, _ in pairs)
+
+    assert seen == urls
+
+def test_make_body_cache(monkeypatch):
+    """
+    Cached urls are not sent; verdicts are merged back.
+    """
+
+    vcache = cache.TTLCache(ttl=60)
+    vcache.put("http://example.com/1", "malware")
+    vcache.put("http://example.com/2", "ok")
+
+    urls = ["http://example.com/%d" % (i % 4) for i in range(8)]
+    batches = list(gsb.make_body(urls, vcache))
+    assert len(batches) == 1
+
+    pairs, canons, body, known = batches[0]
+    assert canons == ["http://example.com/0", "http://example.com/3"]
+    assert body == "2\nhttp://example.com/0\nhttp://example.com/3"
+    assert known == {"http://example.com/1": "malware",
+                     "http://example.com/2": "ok"}
+
+    stats = vcache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+
+    # All cached; nothing to send
+    batch = next(gsb.make_body(urls[1:3], vcache))
+    resp, status_code = gsb.lookup_batch("key", batch)
+    assert resp == {"http://example.com/1": "malware",
+                    "http://example.com/2": "ok"}
+    assert status_code == 200
+
+    # Sent urls all ok, but a cached one is not
+    monkeypatch.setattr(gsb, "do_lookup",
+                        lambda auth, urls, data: ({u: "ok" for u in urls},
+                                                  204))
+    batch = next(gsb.make_body(urls[:2], vcache))
+    resp, status_code = gsb.lookup_batch("key", batch)
+    assert resp == {"http://example.com/0": "ok",
+                    "http://example.com/1": "malware"}
+    assert status_code == 200
+
+    batch = next(gsb.make_body(["http://example.com/3"], vcache))
+    assert gsb.lookup_batch("key", batch)[1] == 204
@@ -0,0 +1,212 @@
+# pylint: disable=redefined-outer-name
+"""
+Test the local Safe Browsing database against a stand-in update server.
+"""
+
+import json
+import base64
+import hashlib
+import threading
+import BaseHTTPServer
+
+import pytest
+
+import wriggler.gsb_local as gsb_local
+
+BAD_URL = "http://evil.example.com/bad/page.html"
+GOOD_URL = "http://www.example.org/"
+MALWARE = ("MALWARE", "ANY_PLATFORM", "URL")
+
+def checksum(prefixes):
+    """
+    Return the checksum of the sorted prefixes.
+    """
+
+    return base64.b64encode(hashlib.sha256("".join(sorted(prefixes))).digest())
+
+class FakeServer(BaseHTTPServer.HTTPServer):
+    """
+    Serve canned list updates and the full hashes of BAD_URL.
+    """
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           FakeHandler)
+        self.updates = []
+        self.requests = []
+        self.full_hashes = [gsb_local.full_hash("evil.example.com/bad/")]
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handle the update and full hash requests.
+    """
+
+    def do_POST(self): # pylint: disable=invalid-name
+        length = int(self.headers["Content-Length"])
+        body = json.loads(self.rfile.read(length))
+        self.server.requests.append((self.path, body))
+
+        if "threatListUpdates:fetch" in self.path:
+            resp = {"listUpdateResponses": [self.server.updates.pop(0)],
+                    "minimumWaitDuration": "300.5s"}
+        else:
+            prefixes = set(base64.b64decode(e["hash"])
+                           for e in body["threatInfo"]["threatEntries"])
+            matches = [{"threatType": "MALWARE",
+                        "platformType": "ANY_PLATFORM",
+                        "threatEntryType": "URL",
+                        "threat": {"hash": base64.b64encode(h)},
+                        "cacheDuration": "300s"}
+                       for h in self.server.full_hashes if h[:4] in prefixes]
+            resp = {"matches": matches, "negativeCacheDuration": "300s"}
+
+        data = json.dumps(resp)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+@pytest.fixture
+def server(request):
+    """
+    Start the stand-in server.
+    """
+
+    srv = FakeServer()
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(srv.shutdown)
+    return srv
+
+def make_update(kind, prefixes, removals, all_prefixes):
+    """
+    Return a list update response.
+    """
+
+    update = {
+        "threatType": "MALWARE",
+        "platformType": "ANY_PLATFORM",
+        "threatEntryType": "URL",
+        "responseType": kind,
+        "additions": [],
+        "removals": [{"compressionType": "RAW",
+                      "rawIndices": {"indices": removals}}],
+        "newClientState": kind,
+        "checksum": {"sha256": checksum(all_prefixes)},
+    }
+    for size in set(len(p) for p in prefixes):
+        raw = "".join(p for p in prefixes if len(p) == size)
+        update["additions"].append({
+            "compressionType": "RAW",
+            "rawHashes": {"prefixSize": size,
+                          "rawHashes": base64.b64encode(raw)}
+        })
+    return update
+
+def test_url_expressions():
+    """
+    Host suffixes and path prefixes are generated as in the spec.
+    """
+
+    exprs = gsb_local.url_expressions("http://a.b.c/1/2.html?param=1")
+    assert set(exprs) == set([
+        "a.b.c/1/2.html?param=1", "a.b.c/1/2.html", "a.b.c/", "a.b.c/1/",
+        "b.c/1/2.html?param=1", "b.c/1/2.html", "b.c/", "b.c/1/",
+    ])
+
+def test_update_and_check(server, tmpdir):
+    """
+    Only prefix hits are checked remotely; updates are incremental.
+    """
+
+    bad = gsb_local.full_hash("evil.example.com/bad/")
+    other = [hashlib.sha256(str(i)).digest()[:4] for i in range(1000)]
+    long_prefix = hashlib.sha256("long").digest()
+    prefixes = other + [bad[:4], long_prefix]
+
+    server.updates.append(make_update("FULL_UPDATE", prefixes, [], prefixes))
+    endpoint = "http://%s:%d" % server.server_address
+    db = gsb_local.Database("key", str(tmpdir), [MALWARE], endpoint)
+
+    assert db.update() == 300.5
+    plist = db.lists[MALWARE]
+    assert len(plist) == 1002
+    assert plist.state == "FULL_UPDATE"
+
+    results = list(db.lookup([GOOD_URL, BAD_URL, GOOD_URL]))
+    assert results == [({GOOD_URL: "ok", BAD_URL: "malware"}, 200)]
+    assert len(server.requests) == 2
+
+    # Good urls never reach the server
+    assert list(db.lookup([GOOD_URL])) == [({GOOD_URL: "ok"}, 204)]
+    assert len(server.requests) == 2
+
+    # The state survives a restart
+    db = gsb_local.Database("key", str(tmpdir), [MALWARE], endpoint)
+    assert len(db.lists[MALWARE]) == 1002
+
+    # Remove the bad prefix
+    idx = sorted(prefixes).index(bad[:4])
+    new = [p for p in prefixes if p != bad[:4]]
+    server.updates.append(make_update("PARTIAL_UPDATE", [], [idx], new))
+    assert db.update() == 300.5
+    assert server.requests[-1][1]["listUpdateRequests"][0]["state"] == \
+        "FULL_UPDATE"
+    assert len(db.lists[MALWARE]) == 1001
+    assert list(db.lookup([BAD_URL])) == [({BAD_URL: "ok"}, 204)]
+
+def test_next_update_and_cache(server, tmpdir):
+    """
+    Updates wait as asked; full hash responses are cached.
+    """
+
+    bad = gsb_local.full_hash("evil.example.com/bad/")
+    good = gsb_local.full_hash("www.example.org/")
+    prefixes = [bad[:4], good[:4]]
+
+    server.updates.append(make_update("FULL_UPDATE", prefixes, [], prefixes))
+    endpoint = "http://%s:%d" % server.server_address
+    db = gsb_local.Database("key", str(tmpdir), [MALWARE], endpoint)
+
+    assert db.update() == 300.5
+    assert 300 < db.update() <= 300.5
+    assert len(server.requests) == 1
+
+    # A hit and a false positive, both asked once
+    for _ in range(3):
+        assert list(db.lookup([BAD_URL, GOOD_URL])) == \
+            [({GOOD_URL: "ok", BAD_URL: "malware"}, 200)]
+    assert len(server.requests) == 2
+
+    # Expired prefixes are asked again
+    db.negative.put(bad[:4], True, 0)
+    assert list(db.lookup([BAD_URL, GOOD_URL])) == \
+        [({GOOD_URL: "ok", BAD_URL: "malware"}, 200)]
+    assert len(server.requests) == 2
+
+    db.positive = gsb_local.TTLCache()
+    assert list(db.lookup([BAD_URL, GOOD_URL])) == \
+        [({GOOD_URL: "ok", BAD_URL: "malware"}, 200)]
+    assert len(server.requests) == 3
+    hashes = server.requests[-1][1]["threatInfo"]["threatEntries"]
+    assert hashes == [{"hash": base64.b64encode(bad[:4])}]
+
+def test_checksum_mismatch(server, tmpdir):
+    """
+    A list failing the checksum is cleared.
+    """
+
+    prefixes = [hashlib.sha256(str(i)).digest()[:4] for i in range(10)]
+    server.updates.append(make_update("FULL_UPDATE", prefixes, [],
+                                      prefixes[:5]))
+    endpoint = "http://%s:%d" % server.server_address
+    db = gsb_local.Database("key", str(tmpdir), [MALWARE], endpoint)
+
+    db.update()
+    assert len(db.lists[MALWARE]) == 0
+    assert db.lists[MALWARE].state == ""
@@ -0,0 +1,120 @@
+# pylint: disable=redefined-outer-name
+"""
+Test the shared key state backends.
+"""
+
+import time
+import threading
+
+import pytest
+
+import wriggler.keystate as ks
+
+@pytest.fixture(params=["local", "sqlite", "remote"])
+def state(request, tmpdir):
+    """
+    Return an empty key state of each backend.
+    """
+
+    if request.param == "local":
+        return ks.LocalKeyState()
+
+    if request.param == "sqlite":
+        return ks.SQLiteKeyState(str(tmpdir.join("keystate.db")))
+
+    server = ks.KeyStateServer(("127.0.0.1", 0))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    return ks.RemoteKeyState(server.server_address)
+
+def test_lease_unknown(state):
+    """
+    Keys never seen before are available.
+    """
+
+    slot, wait = state.lease(["a", "b"])
+    assert slot == "a"
+    assert wait == 0
+
+def test_lease_remaining(state):
+    """
+    Leases are taken from the key with the most calls remaining.
+    """
+
+    reset = int(time.time()) + 600
+    state.update("a", 1, reset)
+    state.update("b", 2, reset)
+
+    assert state.lease(["a", "b"]) == ("b", 0)
+    assert state.get("b") == (1, reset)
+    assert state.lease(["a", "b"]) == ("a", 0)
+    assert state.lease(["a", "b"]) == ("b", 0)
+
+    slot, wait = state.lease(["a", "b"])
+    assert slot is None
+    assert 590 <= wait <= 600
+
+    state.release("a")
+    assert state.lease(["a", "b"]) == ("a", 0)
+
+def test_update_merge(state):
+    """
+    Stale headers do not undo leases; a new window resets the count.
+    """
+
+    reset = int(time.time()) + 600
+    state.update("a", 5, reset)
+    state.lease(["a"])
+    state.update("a", 5, reset)
+    assert state.get("a") == (4, reset)
+
+    state.update("a", 15, reset + 900)
+    assert state.get("a") == (15, reset + 900)
+
+def test_window_over(state):
+    """
+    Keys whose window is over are available again.
+    """
+
+    state.update("a", 0, int(time.time()) - 1)
+    assert state.lease(["a"]) == ("a", 0)
+
+def test_replace(state):
+    """
+    Replaced rows are overwritten, not merged.
+    """
+
+    reset = int(time.time()) + 600
+    state.update("a", 2, reset)
+    state.update("a", 10, reset)
+    assert state.get("a") == (2, reset)
+
+    state.replace("a", 10, reset)
+    assert state.get("a") == (10, reset)
+    state.replace("a", 5, reset - 300)
+    assert state.get("a") == (5, reset - 300)
+
+def test_remote_hashes_slots():
+    """
+    The server only sees hashes of the slots.
+    """
+
+    server = ks.KeyStateServer(("127.0.0.1", 0))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        remote = ks.RemoteKeyState(server.server_address)
+        reset = int(time.time()) + 600
+        remote.update("secret:search", 3, reset)
+        assert remote.lease(["secret:search"]) == ("secret:search", 0)
+        assert remote.get("secret:search") == (2, reset)
+    finally:
+        server.shutdown()
+
+    stored = server.state.dump()
+    assert "secret:search" not in str(stored)
+    assert ks.hash_slot("secret:search") in str(stored)
@@ -0,0 +1,123 @@
+"""
+Test the per host circuit breaker.
+"""
+
+import pytest
+import requests
+
+import wriggler.req as req
+import wriggler.budget as budget
+
+class FakeResponse(object):
+    """
+    Response with only a status code.
+    """
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+def test_breaker(monkeypatch):
+    """
+    Closed -> open -> half-open -> open -> half-open -> closed.
+    """
+
+    clock = [1000.0]
+    monkeypatch.setattr(req.time, "time", lambda: clock[0])
+
+    breaker = req.CircuitBreaker(fail_max=3, reset_after=60, probes=2)
+    host = "api.example.com"
+
+    for _ in range(3):
+        breaker.allow(host)
+        breaker.failure(host)
+    assert breaker.state(host) == "open"
+    with pytest.raises(req.CircuitOpenError):
+        breaker.allow(host)
+
+    # Other hosts are not affected
+    breaker.allow("other.example.com")
+
+    # Half open; probes fail
+    clock[0] += 60
+    breaker.allow(host)
+    assert breaker.state(host) == "half-open"
+    breaker.failure(host)
+    assert breaker.state(host) == "open"
+
+    # Half open; only two probes, both succeed
+    clock[0] += 60
+    breaker.allow(host)
+    breaker.allow(host)
+    with pytest.raises(req.CircuitOpenError):
+        breaker.allow(host)
+    breaker.success(host)
+    assert breaker.state(host) == "half-open"
+    breaker.success(host)
+    assert breaker.state(host) == "closed"
+    breaker.allow(host)
+
+def test_robust_http(monkeypatch):
+    """
+    Requests fail fast once the circuit is open.
+    """
+
+    calls = []
+
+    def fake_get(url, *args, **kwargs):
+        calls.append(url)
+        if "down" in url:
+            raise requests.ConnectionError()
+        return FakeResponse(503 if "error" in url else 200)
+
+    monkeypatch.setattr(req, "breaker",
+                        req.CircuitBreaker(fail_max=5, reset_after=60))
+    monkeypatch.setattr(budget, "hosts", None)
+    monkeypatch.setattr(req.requests, "get", fake_get)
+    monkeypatch.setattr(req, "sleep", lambda secs: None)
+
+    with pytest.raises(req.CircuitOpenError):
+        req.get("http://down.example.com/a")
+    assert len(calls) == 5
+    with pytest.raises(req.ConnectFailError):
+        req.get("http://down.example.com/b")
+    assert len(calls) == 5
+
+    # Server errors count as failures
+    for _ in range(5):
+        assert req.get("http://error.example.com/").status_code == 503
+    assert req.breaker.state("error.example.com") == "open"
+
+    assert req.get("http://up.example.com/").status_code == 200
+
+def test_retry_budget(monkeypatch):
+    """
+    Connection retries stop when the budget runs out.
+    """
+
+    calls = []
+
+    def fake_get(url, *args, **kwargs):
+        calls.append(url)
+        raise requests.ConnectionError()
+
+    monkeypatch.setattr(req, "breaker", req.CircuitBreaker(fail_max=1000))
+    monkeypatch.setattr(budget, "hosts", budget.HostBudgets(minimum=3))
+    monkeypatch.setattr(req.requests, "get", fake_get)
+    monkeypatch.setattr(req, "sleep", lambda secs: None)
+
+    with pytest.raises(req.ConnectFailError):
+        req.get("http://down.example.com/")
+    assert len(calls) == 4
+
+    # The outage does not take the retries of other hosts
+    del calls[:]
+    with pytest.raises(req.ConnectFailError):
+        req.get("http://other.example.com/")
+    assert len(calls) == 4
+
+    # Without budgets, the retries are only bounded by CONNECT_RETRY_MAX
+    monkeypatch.setattr(budget, "hosts", None)
+    del calls[:]
+    with pytest.raises(req.ConnectFailError):
+        req.get("http://down.example.com/")
+    assert len(calls) == req.const.CONNECT_RETRY_MAX
@@ -0,0 +1,280 @@
+# pylint: disable=redefined-outer-name
+"""
+Test the multi auth key management.
+"""
+
+import time
+
+import pytest
+
+from wriggler import Error
+import wriggler.req as req
+import wriggler.budget as budget
+import wriggler.twitter.auth as auth
+import wriggler.twitter.rest as rest
+
+@pytest.fixture
+def samp_auth():
+    """
+    Return a multi auth object with three fake keys.
+    """
+
+    keys = [{"client_key": "ck%d" % i, "client_secret": "cs",
+             "resource_owner_key": "rk%d" % i, "resource_owner_secret": "rs"}
+            for i in range(3)]
+    return auth.MultiAuth(keys)
+
+def test_quarantine(samp_auth):
+    """
+    Failing keys are skipped for longer on every failure.
+    """
+
+    samp_auth.acquire()
+    assert samp_auth.idx == 0
+
+    samp_auth.skip_key(326)
+    first = samp_auth.health[0]["until"]
+    samp_auth.skip_key(326)
+    assert samp_auth.health[0]["until"] > first
+
+    report = samp_auth.health_report()
+    assert report[0]["status"] == "quarantined"
+    assert report[0]["failures"] == 2
+    assert report[0]["last_error"] == 326
+    assert report[1]["status"] == "ok"
+
+    samp_auth.acquire()
+    assert samp_auth.idx == 1
+
+def test_dead_keys(samp_auth):
+    """
+    Keys with invalid credentials are dropped.
+    """
+
+    for idx in range(3):
+        samp_auth.acquire()
+        assert samp_auth.idx == idx
+        samp_auth.skip_key(89)
+        assert samp_auth.health_report()[idx]["status"] == "dead"
+
+    with pytest.raises(Error):
+        samp_auth.acquire()
+
+def test_resource_name():
+    """
+    Endpoint urls map to rate limit resources.
+    """
+
+    url = "https://api.twitter.com/1.1/statuses/user_timeline.json"
+    assert auth.resource_name(url) == "/statuses/user_timeline"
+
+    url = "https://api.twitter.com/1.1/statuses/retweets/1234.json"
+    assert auth.resource_name(url) == "/statuses/retweets/:id"
+
+    url = "https://api.twitter.com/1.1/users/show.json"
+    assert auth.resource_name(url) == "/users/show/:id"
+
+def test_app_contexts(samp_auth):
+    """
+    App contexts are used only for resources supporting app auth.
+    """
+
+    app_auth = auth.MultiAuth(samp_auth.keys, app_auth=True)
+    app_auth.bearer["ck1"] = "token"
+    assert len(app_auth.contexts) == 6
+
+    # Exhaust the user contexts
+    for idx in range(3):
+        app_auth.state.update(app_auth.slot(idx, "/search/tweets"), 0,
+                              int(time.time()) + 600)
+
+    app_auth.state.update(app_auth.slot(3, "/search/tweets"), 0,
+                          int(time.time()) + 600)
+    app_auth.acquire("/search/tweets")
+    assert app_auth.contexts[app_auth.idx] == ("app", 1)
+    assert isinstance(app_auth.oauth, auth.BearerAuth)
+
+    # Exhausting a resource does not affect others
+    app_auth.acquire("/users/show/:id")
+    assert app_auth.idx == 0
+
+    app_auth.state.update(app_auth.slot(4, "/search/tweets"), 0,
+                          int(time.time()) + 600)
+    app_auth.bearer["ck2"] = "token"
+    app_auth.acquire("/search/tweets")
+    assert app_auth.contexts[app_auth.idx] == ("app", 2)
+
+def test_ichunks():
+    """
+    Chunks of any iterable.
+    """
+
+    chunks = list(auth.ichunks(iter(range(7)), 3))
+    assert chunks == [[0, 1, 2], [3, 4, 5], [6]]
+
+def test_sync_limits(samp_auth, monkeypatch):
+    """
+    Warm start fills the state of every context from the api.
+    """
+
+    reset = int(time.time()) + 600
+
+    class FakeResponse(object):
+        def __init__(self, owner_key):
+            self.owner_key = owner_key
+
+        def json(self):
+            if self.owner_key == "rk2":
+                return {"errors": [{"code": 89}]}
+            return {"resources": {"statuses": {
+                "/statuses/user_timeline": {"limit": 900, "reset": reset,
+                                            "remaining": 0},
+                "/statuses/lookup": {"limit": 900, "reset": reset,
+                                     "remaining": 17},
+            }, "users": {
+                "/users/show/:id": {"limit": 900, "reset": reset,
+                                    "remaining": 5},
+            }}}
+
+    def fake_get(url, **kwargs):
+        assert url == auth.RATE_LIMIT_ENDPOINT
+        return FakeResponse(kwargs["auth"].client.resource_owner_key)
+
+    monkeypatch.setattr(auth.req, "get", fake_get)
+
+    assert samp_auth.sync_limits(nthreads=2) == 2
+    state = samp_auth.state
+    slot = samp_auth.slot(0, "/statuses/user_timeline")
+    assert tuple(state.get(slot)) == (0, reset)
+    slot = samp_auth.slot(1, "/statuses/lookup")
+    assert tuple(state.get(slot)) == (17, reset)
+
+    # The state of users_show calls is synced too
+    resource = auth.resource_name("https://api.twitter.com/1.1/"
+                                  "users/show.json")
+    slot = samp_auth.slot(0, resource)
+    assert tuple(state.get(slot)) == (5, reset)
+
+    # Only the unsynced key is used for the exhausted resource
+    samp_auth.acquire("/statuses/user_timeline")
+    assert samp_auth.idx == 2
+
+    # Local drift below the server is corrected
+    slot = samp_auth.slot(0, "/statuses/lookup")
+    state.update(slot, 3, reset)
+    assert tuple(state.get(slot)) == (3, reset)
+    samp_auth.sync_limits(nthreads=2)
+    assert tuple(state.get(slot)) == (17, reset)
+
+def test_persist_state(samp_auth, tmpdir):
+    """
+    Rate limits, quarantine and dead keys survive a restart.
+    """
+
+    reset = int(time.time()) + 600
+    samp_auth.state.update(samp_auth.slot(1, "/users/show/:id"), 3, reset)
+    samp_auth.acquire()
+    samp_auth.skip_key(326)
+    samp_auth.acquire()
+    samp_auth.skip_key(89)
+
+    fname = str(tmpdir.join("keystate.json"))
+    samp_auth.save_state(fname)
+
+    other = auth.MultiAuth(samp_auth.keys)
+    assert other.load_state(fname)
+    report = other.health_report()
+    assert [r["status"] for r in report] == ["quarantined", "dead", "ok"]
+    assert other.live == [0, 2]
+    slot = other.slot(1, "/users/show/:id")
+    assert tuple(other.state.get(slot)) == (3, reset)
+
+    assert not other.load_state(str(tmpdir.join("missing.json")))
+
+def test_limit_not_parked(samp_auth):
+    """
+    Skips and headerless responses leave the rate limit state alone.
+    """
+
+    reset = int(time.time()) + 900
+    headers = {"X-Rate-Limit-Remaining": "899",
+               "X-Rate-Limit-Reset": str(reset)}
+    slot = samp_auth.slot(0, "/users/show/:id")
+
+    samp_auth.acquire("/users/show/:id")
+    assert samp_auth.check_limit(headers)
+    assert tuple(samp_auth.state.get(slot)) == (899, reset)
+
+    assert not samp_auth.check_limit({})
+    samp_auth.skip_key(130)
+    assert tuple(samp_auth.state.get(slot)) == (899, reset)
+    assert samp_auth.health[0]["until"] <= int(time.time()) + 5
+
+class FakeResponse(object):
+    """
+    Error response without an error code.
+    """
+
+    headers = {}
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        raise ValueError(self.text)
+
+def test_strikes(samp_auth, monkeypatch):
+    """
+    Keys which keep timing out, or getting bare 401s from calls that
+    do not depend on the user, are skipped.
+    """
+
+    used = []
+    def fake_get(url, **kwargs):
+        used.append(kwargs["auth"].client.resource_owner_key)
+        if used[-1] == "rk0":
+            raise req.RequestTimeoutError(url, "get")
+        return FakeResponse(401, "Unauthorized")
+
+    monkeypatch.setattr(rest.req, "get", fake_get)
+    monkeypatch.setattr(budget, "hosts", None)
+
+    # rk0 keeps timing out, so the call moves on to rk1
+    _, meta = rest.users_show(samp_auth, screen_name="x")
+    assert meta["code"] == 401
+    assert used == ["rk0"] * auth.const.KEY_STRIKES_MAX + ["rk1"]
+    report = samp_auth.health_report()
+    assert report[0]["status"] == "quarantined"
+    assert report[0]["last_error"] == "timeout"
+    assert samp_auth.health[1].get("strikes", 0) == 0
+
+    # The third bare 401 of rk1 skips it, and the call moves on to rk2
+    del used[:]
+    for _ in range(3):
+        rest.trends_place(samp_auth, id=1)
+    assert used == ["rk1", "rk1", "rk1", "rk2"]
+    assert samp_auth.health_report()[1]["status"] == "quarantined"
+    assert samp_auth.health[2]["strikes"] == 1
+
+def test_protected_users(samp_auth, monkeypatch):
+    """
+    Bare 401s of protected users give up without striking the key.
+    """
+
+    used = []
+    def fake_get(url, **kwargs):
+        used.append(kwargs["auth"].client.resource_owner_key)
+        return FakeResponse(401, "Unauthorized")
+
+    slept = []
+    monkeypatch.setattr(rest.req, "get", fake_get)
+    monkeypatch.setattr(rest.time, "sleep", slept.append)
+    monkeypatch.setattr(auth.time, "sleep", slept.append)
+
+    for user_id in range(15):
+        _, meta = rest.users_show(samp_auth, user_id=user_id)
+        assert meta == {"code": 401, "error_code": 0}
+    assert used == ["rk0"] * 15
+    assert slept == []
+    assert samp_auth.health_report()[0]["status"] == "ok"
@@ -0,0 +1,76 @@
+"""
+Test the retweet cascade crawler.
+"""
+
+import json
+
+import wriggler.twitter.auth as auth
+import wriggler.twitter.rest as rest
+import wriggler.twitter.cascade as cascade
+from wriggler.twitter import snowflake_time, time_snowflake
+
+SEED_TIME = 1459893357
+
+def fake_retweeters_ids(ath, **params):
+    """
+    Retweeters of seed are 1 to seed % 1000, in pages of 100.
+    """
+
+    ids = range(1, params["id"] % 1000 + 1)
+    for page in range(0, len(ids), 100):
+        yield {"ids": ids[page:page + 100]}, {"code": 200}
+
+def fake_retweets_id(ath, **params):
+    """
+    Only the latest ten retweets, plus one not in the ids yet.
+    """
+
+    nids = params["id"] % 1000
+    users = range(nids - 9, nids + 2)
+    retweets = [{"id": time_snowflake(SEED_TIME + u), "user": {"id": u}}
+                for u in users]
+    return retweets, {"code": 200, "error_code": 0}
+
+def fake_users_lookup(ath, **params):
+    """
+    Every user exists.
+    """
+
+    assert len(params["user_id"]) <= 100
+    users = [{"id": u} for u in params["user_id"]]
+    return users, {"code": 200, "error_code": 0}
+
+def test_crawl_cascades(monkeypatch, tmpdir):
+    """
+    Edges of all seeds are written; profiles once per user.
+    """
+
+    monkeypatch.setattr(rest, "statuses_retweeters_ids", fake_retweeters_ids)
+    monkeypatch.setattr(rest, "statuses_retweets_id", fake_retweets_id)
+    monkeypatch.setattr(rest, "users_lookup", fake_users_lookup)
+
+    keys = [{"client_key": "ck", "client_secret": "cs",
+             "resource_owner_key": "rk", "resource_owner_secret": "rs"}]
+    seeds = [5000 + n for n in (50, 120, 250)]
+    edges_fname = str(tmpdir.join("edges.tsv"))
+    profiles_fname = str(tmpdir.join("users.json"))
+
+    ncascades, nedges = cascade.crawl_cascades(auth.MultiAuth(keys), seeds,
+                                               edges_fname, profiles_fname,
+                                               nthreads=2)
+    assert ncascades == 3
+    assert nedges == 51 + 121 + 251
+
+    timed = {}
+    with open(edges_fname) as fobj:
+        for line in fobj:
+            seed, uid, rtid, rt_time = line.split()
+            if rtid != "-":
+                timed[int(seed), int(uid)] = float(rt_time)
+                assert float(rt_time) == round(snowflake_time(int(rtid)), 3)
+    assert len(timed) == 3 * 11
+    assert int(timed[5250, 251]) == SEED_TIME + 251
+
+    with open(profiles_fname) as fobj:
+        users = [json.loads(line)["id"] for line in fobj]
+    assert sorted(users) == range(1, 252)
@@ -0,0 +1,31 @@
+"""
+Test the bounding box index.
+"""
+
+import random
+
+from wriggler.twitter.geo import BoxIndex
+
+def test_box_index():
+    """
+    Same as checking every box.
+    """
+
+    boxes = []
+    for i in range(200):
+        west = random.uniform(-180, 170)
+        south = random.uniform(-90, 80)
+        box = (west, south, west + random.uniform(0, 10),
+               south + random.uniform(0, 10))
+        boxes.append((box, i))
+
+    index = BoxIndex(cell=2.0)
+    for box, i in boxes:
+        index.add(box, i)
+    assert len(index) == 200
+
+    for _ in range(1000):
+        lon, lat = random.uniform(-180, 180), random.uniform(-90, 90)
+        naive = [i for (w, s, e, n), i in boxes
+                 if w <= lon <= e and s <= lat <= n]
+        assert sorted(index.query(lon, lat)) == naive
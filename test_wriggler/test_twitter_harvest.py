@@ -0,0 +1,93 @@
+"""
+Test the bulk timeline harvester.
+"""
+
+import os
+import json
+
+from wriggler import Error
+import wriggler.twitter.auth as auth
+import wriggler.twitter.rest as rest
+import wriggler.twitter.harvest as harvest
+
+def fake_timeline(ath, **params):
+    """
+    Users divisible by 10 are protected; others have 500 tweets.
+    """
+
+    user_id = params["user_id"]
+    if user_id % 10 == 0:
+        yield {"errors": []}, {"code": 401, "error_code": 0}
+        return
+
+    for page in range(0, 500, 200):
+        tweets = [{"id": i, "user_id": user_id}
+                  for i in range(page, min(page + 200, 500))]
+        yield tweets, {"code": 200, "error_code": 0}
+
+def test_harvest(monkeypatch, tmpdir):
+    """
+    Timelines go to their shards and every user is indexed once.
+    """
+
+    monkeypatch.setattr(rest, "statuses_user_timeline", fake_timeline)
+
+    fname = str(tmpdir.join("users.txt"))
+    with open(fname, "w") as fobj:
+        for user_id in range(1, 41):
+            if user_id == 7:
+                fobj.write("%d\t100\n" % user_id)
+            else:
+                fobj.write("%d\n" % user_id)
+
+    keys = [{"client_key": "ck", "client_secret": "cs",
+             "resource_owner_key": "rk", "resource_owner_secret": "rs"}]
+    outdir = str(tmpdir.join("out"))
+    nusers, ntweets = harvest.harvest(auth.MultiAuth(keys), fname, outdir,
+                                      nthreads=4, nshards=4, maxitems=300)
+    assert nusers == 40
+    assert ntweets == 35 * 300 + 100
+
+    index = {}
+    with open(os.path.join(outdir, "index.tsv")) as fobj:
+        for line in fobj:
+            user_id, code, _, count, shard = [int(x) for x in line.split()]
+            index[user_id] = (code, count, shard)
+    assert len(index) == 40
+    assert index[10] == (401, 0, 2)
+    assert index[7] == (200, 100, 3)
+
+    with open(os.path.join(outdir, "timelines-001.json")) as fobj:
+        tweets = [json.loads(line) for line in fobj]
+    assert set(t["user_id"] % 4 for t in tweets) == set([1])
+
+    # Resume does nothing more
+    assert harvest.harvest(auth.MultiAuth(keys), fname, outdir,
+                           nthreads=4, nshards=4) == (0, 0)
+
+def test_harvest_failures(monkeypatch, tmpdir):
+    """
+    Failed users are retried on resume; users with no tweets asked are not.
+    """
+
+    failing = set([3])
+    def flaky_timeline(ath, **params):
+        if params["user_id"] in failing:
+            raise Error("Tries exhausted: 100")
+        return fake_timeline(ath, **params)
+
+    monkeypatch.setattr(rest, "statuses_user_timeline", flaky_timeline)
+
+    fname = str(tmpdir.join("users.txt"))
+    with open(fname, "w") as fobj:
+        fobj.write("1\n2\t0\n3\n")
+
+    keys = [{"client_key": "ck", "client_secret": "cs",
+             "resource_owner_key": "rk", "resource_owner_secret": "rs"}]
+    outdir = str(tmpdir.join("out"))
+    assert harvest.harvest(auth.MultiAuth(keys), fname, outdir,
+                           maxitems=300) == (2, 300)
+
+    failing.clear()
+    assert harvest.harvest(auth.MultiAuth(keys), fname, outdir,
+                           maxitems=300) == (1, 300)
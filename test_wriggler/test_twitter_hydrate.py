@@ -0,0 +1,70 @@
+"""
+Test the streaming hydration of ids.
+"""
+
+import json
+import struct
+
+import pytest
+
+from wriggler import Error
+import wriggler.twitter.auth as auth
+import wriggler.twitter.rest as rest
+import wriggler.twitter.hydrate as hydrate
+
+def fake_lookup(ath, **params):
+    """
+    Return the odd ids; 404 when all are missing.
+
+    Batches with ids over 3000 are forbidden, and over 4000 fail.
+    """
+
+    ids = params["id"]
+    assert len(ids) <= 100
+    if max(ids) > 4000:
+        raise Error("Tries exhausted: 100")
+    if max(ids) > 3000:
+        return {"errors": []}, {"code": 403, "error_code": 0}
+
+    tweets = [{"id": i} for i in ids if i % 2]
+    if not tweets:
+        return {"errors": []}, {"code": 404, "error_code": 34}
+    return tweets, {"code": 200, "error_code": 0}
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_hydrate(monkeypatch, tmpdir, binary):
+    """
+    Found objects and missing ids are written out.
+    """
+
+    monkeypatch.setattr(rest, "statuses_lookup", fake_lookup)
+
+    ids = (range(1, 1001) + range(3001, 3101) + range(4001, 4101) +
+           [2000, 2002])
+    fname = str(tmpdir.join("ids"))
+    with open(fname, "wb") as fobj:
+        if binary:
+            fobj.write(struct.pack("<%dq" % len(ids), *ids))
+        else:
+            fobj.write("".join("%d\n" % i for i in ids))
+
+    keys = [{"client_key": "ck", "client_secret": "cs",
+             "resource_owner_key": "rk", "resource_owner_secret": "rs"}]
+    out_fname = str(tmpdir.join("tweets.json"))
+    missing_fname = str(tmpdir.join("missing.txt"))
+    counts = hydrate.hydrate(auth.MultiAuth(keys), "tweets", fname,
+                             out_fname, missing_fname, nthreads=3,
+                             binary=binary)
+    assert counts == (500, 502, 200)
+
+    with open(out_fname) as fobj:
+        found = sorted(json.loads(line)["id"] for line in fobj)
+    assert found == range(1, 1001, 2)
+
+    with open(missing_fname) as fobj:
+        missing = sorted(int(line) for line in fobj)
+    assert missing == range(2, 1001, 2) + [2000, 2002]
+
+    with open(missing_fname + ".failed") as fobj:
+        failed = sorted(int(line) for line in fobj)
+    assert failed == range(3001, 3101) + range(4001, 4101)
@@ -0,0 +1,81 @@
+"""
+Test the adaptive timeline monitor.
+"""
+
+import wriggler.twitter.auth as auth
+import wriggler.twitter.rest as rest
+import wriggler.twitter.monitor as monitor
+from wriggler.twitter import time_snowflake
+
+KEYS = [{"client_key": "ck", "client_secret": "cs",
+         "resource_owner_key": "rk", "resource_owner_secret": "rs"}]
+
+START = 1459893357.0
+
+def test_intervals(monkeypatch):
+    """
+    Poll frequency goes as the square root of the rate.
+    """
+
+    monkeypatch.setattr(monitor.time, "time", lambda: START)
+    sched = monitor.Monitor(auth.MultiAuth(KEYS), [1, 2, 3],
+                            min_interval=0)
+
+    sched.update(1, START, [])
+    sched.update(2, START, [])
+    sched.update(1, START + 86400, [{"id": i} for i in range(99)])
+    sched.update(2, START + 86400, [])
+
+    assert abs(sched.rate(1) / sched.rate(2) - 100) < 1e-9
+    ratio = sched.interval(2) / sched.interval(1)
+    assert abs(ratio - 10) < 1e-9
+
+    # Total poll frequency is the budget
+    freq = sum(1 / sched.interval(u) for u in sched.users)
+    assert abs(freq - sched.budget()) < 1e-9
+
+def test_monitor(monkeypatch):
+    """
+    New tweets are all found, and active users are polled more.
+    """
+
+    clock = [START]
+    posts = {
+        1: [START + 30 * i for i in range(1, 2000)],
+        2: [START + 86400 * i for i in range(1, 3)],
+    }
+    polls = {1: 0, 2: 0}
+    last_poll = {}
+
+    def fake_timeline(ath, **params):
+        user_id = params["user_id"]
+        polls[user_id] += 1
+        last_poll[user_id] = clock[0]
+        since_id = params.get("since_id", 0)
+        ids = [time_snowflake(ts) for ts in posts[user_id]
+               if ts <= clock[0]]
+        tweets = [{"id": i} for i in ids if i > since_id][-200:]
+        meta = {"code": 200}
+        if "maxitems" in params:
+            return [(tweets, meta)]
+        return tweets, meta
+
+    def fake_sleep(secs):
+        clock[0] += secs
+
+    monkeypatch.setattr(rest, "statuses_user_timeline", fake_timeline)
+    monkeypatch.setattr(monitor.time, "time", lambda: clock[0])
+    monkeypatch.setattr(monitor.time, "sleep", fake_sleep)
+
+    multi = auth.MultiAuth(KEYS)
+    tweets = list(monitor.monitor(multi, [1, 2], nthreads=2, maxpolls=100,
+                                  share=0.01, min_interval=0))
+
+    assert sum(polls.values()) == 100
+    assert polls[1] > 3 * polls[2]
+    found = [t["id"] for t in tweets]
+    assert len(found) == len(set(found))
+    expected = [time_snowflake(ts) for ts in posts[1]
+                if ts <= last_poll[1]]
+    assert set(expected) == set(found) - set(time_snowflake(ts)
+                                             for ts in posts[2])
@@ -3,6 +3,8 @@
 Test the search_tweets api.
 """
 
+import time
+
 import pytest
 
 import wriggler.twitter.auth as auth
@@ -442,3 +444,31 @@ def test_statuses_retweets_id(samp_auth):
         assert len(data) >= 1
         for tweet in data:
             assert tweet["retweeted_status"]["id"] == retweeted_tweet_id
+
+def test_cursor_iter_prefetch():
+    """
+    Prefetched pages are the same as without prefetch.
+    """
+
+    calls = []
+    def fake_ids(auth, **params):
+        cursor = params.get("cursor", 1)
+        calls.append(cursor)
+        time.sleep(0.01)
+        data = {"ids": range(cursor, cursor + 10)}
+        next_cursor = cursor + 10 if cursor < 100 else 0
+        return data, {"next_cursor": next_cursor, "count": 10}
+
+    plain = list(rest.cursor_iter(fake_ids, 1000, None, {}))
+    fetched = list(rest.cursor_iter(fake_ids, 1000, None, {"prefetch": 3}))
+    assert plain == fetched
+    assert len(plain) == 11
+
+    pages = rest.cursor_iter(fake_ids, 1000, None, {"prefetch": 2})
+    assert next(pages)[0]["ids"][0] == 1
+    pages.close()
+
+    # No call is made after the iterator is closed
+    made = len(calls)
+    time.sleep(0.05)
+    assert len(calls) == made
@@ -0,0 +1,93 @@
+"""
+Test the multi subscriber keyword router.
+"""
+
+import json
+import random
+
+from wriggler.twitter.router import Automaton, Router
+
+def test_automaton():
+    """
+    All occurrences are found, overlapping ones too.
+    """
+
+    automaton = Automaton()
+    for word in ("he", "she", "his", "hers"):
+        automaton.add(word, word)
+    automaton.build()
+
+    found = sorted(automaton.search("ushers"))
+    assert found == [(1, 4, "she"), (2, 4, "he"), (2, 6, "hers")]
+
+    # Same as a naive search on random strings
+    words = ["".join(random.choice("ab") for _ in range(random.randint(1, 4)))
+             for _ in range(10)]
+    automaton = Automaton()
+    for word in set(words):
+        automaton.add(word, word)
+    automaton.build()
+    text = "".join(random.choice("ab") for _ in range(200))
+    naive = sorted((i, i + len(w), w) for w in set(words)
+                   for i in range(len(text)) if text.startswith(w, i))
+    assert sorted(automaton.search(text)) == naive
+
+def test_router():
+    """
+    Tweets go to the subscribers whose terms they match.
+    """
+
+    router = Router(qsize=2)
+    news = router.subscribe("news", ["breaking news", "Reuters"])
+    cats = router.subscribe("cats", ["cat"])
+    assert router.track() == ["breaking news", "cat", "reuters"]
+
+    def line(text):
+        return json.dumps({"id": 1, "text": text})
+
+    assert router.route(line("News is BREAKING!")) == set(["news"])
+    assert router.route(line("#cat via @reuters")) == set(["news", "cats"])
+    assert router.route(line("breaking the category")) == set()
+    assert router.route(line("concatenate")) == set()
+    assert router.route(json.dumps({"delete": {}})) == set()
+    assert router.route(json.dumps({
+        "text": "truncated", "extended_tweet": {"full_text": "a cat"}
+    })) == set(["cats"])
+
+    assert news.get_nowait()["text"] == "News is BREAKING!"
+    assert cats.qsize() == 2
+
+    router.route(line("cat"))
+    assert router.stats()["cats"] == {"queued": 2, "dropped": 1}
+    assert router.stats()["news"] == {"queued": 1, "dropped": 0}
+
+def test_router_locations():
+    """
+    Geotagged tweets go to the subscribers whose boxes contain them.
+    """
+
+    nyc = (-74.26, 40.48, -73.70, 40.92)
+    sf = (-122.75, 36.8, -121.75, 37.8)
+    usa = (-125.0, 24.0, -66.0, 50.0)
+
+    router = Router(cell=0.5)
+    router.subscribe("nyc", locations=[nyc])
+    router.subscribe("west", ["earthquake"], locations=[sf])
+    router.subscribe("usa", locations=[usa])
+    assert router.locations() == sorted([nyc, sf, usa])
+
+    def line(lon, lat, text="hello"):
+        return json.dumps({"text": text, "coordinates": {
+            "type": "Point", "coordinates": [lon, lat]}})
+
+    assert router.route(line(-73.98, 40.75)) == set(["nyc", "usa"])
+    assert router.route(line(-122.42, 37.77)) == set(["west", "usa"])
+    # Near, but outside the boxes
+    assert router.route(line(-73.5, 40.75)) == set(["usa"])
+    assert router.route(line(2.35, 48.85, "earthquake")) == set(["west"])
+
+    # Tweets with only a place use its center
+    place = {"bounding_box": {"type": "Polygon", "coordinates": [[
+        [-74.0, 40.7], [-74.0, 40.8], [-73.9, 40.8], [-73.9, 40.7]]]}}
+    tweet = json.dumps({"text": "hi", "coordinates": None, "place": place})
+    assert router.route(tweet) == set(["nyc", "usa"])
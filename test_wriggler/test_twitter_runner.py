@@ -0,0 +1,85 @@
+# pylint: disable=redefined-outer-name
+"""
+Test the process pool crawl runner.
+"""
+
+import os
+import json
+
+import pytest
+
+from wriggler import Error
+import wriggler.twitter.runner as runner
+
+@pytest.fixture
+def kfname(tmpdir):
+    """
+    Return a key file with four fake keys.
+    """
+
+    keys = [{"client_key": "ck%d" % i, "client_secret": "cs",
+             "resource_owner_key": "rk%d" % i, "resource_owner_secret": "rs"}
+            for i in range(4)]
+
+    fname = str(tmpdir.join("keys.json"))
+    with open(fname, "w") as fobj:
+        json.dump(keys, fobj)
+    return fname
+
+def fake_endpoint(auth, **params):
+    """
+    Pretend to call an endpoint; pages when maxitems is given.
+    """
+
+    data = {"user_id": params["user_id"], "pid": os.getpid(),
+            "keys": [k["client_key"] for k in auth.keys]}
+    meta = {"code": 200, "error_code": 0}
+    if params.get("maxitems", 0) > 0:
+        return iter([(data, meta), (data, meta)])
+    return data, meta
+
+def test_imap_crawl(kfname):
+    """
+    Every task is done exactly once, by one of the key blocks.
+    """
+
+    tasks = range(100)
+    results = list(runner.imap_crawl(fake_endpoint, tasks, kfname,
+                                     size=2, param="user_id"))
+
+    assert sorted(task for task, _, _ in results) == tasks
+    for task, data, meta in results:
+        assert meta["code"] == 200
+        assert data["user_id"] == task
+        assert data["keys"] in (["ck0", "ck1"], ["ck2", "ck3"])
+
+def test_crawl_pages(kfname):
+    """
+    Iterated endpoints send every page to the sink.
+    """
+
+    pages = []
+    sink = lambda task, data, meta: pages.append(task)
+    tasks = [{"user_id": i} for i in range(10)]
+    count = runner.crawl(fake_endpoint, tasks, kfname, sink,
+                         size=1, maxitems=10)
+
+    assert count == 20
+    assert len(pages) == 20
+
+def dying_endpoint(auth, **params):
+    """
+    Kill the worker process without sending anything back.
+    """
+
+    os._exit(3) # pylint: disable=protected-access
+
+def test_worker_died(kfname, monkeypatch):
+    """
+    A killed worker is reported instead of waiting forever.
+    """
+
+    monkeypatch.setattr(runner, "POLL_INTERVAL", 0.1)
+    with pytest.raises(Error):
+        list(runner.imap_crawl(dying_endpoint, [1], kfname,
+                               param="user_id"))
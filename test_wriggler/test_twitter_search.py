@@ -0,0 +1,68 @@
+"""
+Test the parallel snowflake range search.
+"""
+
+import time
+import random
+
+import wriggler.twitter.auth as auth
+import wriggler.twitter.rest as rest
+import wriggler.twitter.search as search
+from wriggler.twitter import snowflake_time, time_snowflake
+
+def test_snowflake():
+    """
+    Snowflake ids encode the time.
+    """
+
+    # https://twitter.com/POTUS/status/717026378739290112
+    assert int(snowflake_time(717026378739290112)) == 1459787385
+    ts = 1459893357.123
+    assert abs(snowflake_time(time_snowflake(ts)) - ts) < 0.001
+
+def test_id_ranges():
+    """
+    Ranges are contiguous and newest first.
+    """
+
+    ranges = search.id_ranges(1459000000, 1459600000, 6)
+    assert len(ranges) == 6
+    for (since_id, _), (_, max_id) in zip(ranges, ranges[1:]):
+        assert since_id == max_id
+    assert ranges[0][1] == time_snowflake(1459600000) - 1
+
+def test_search_parallel(monkeypatch):
+    """
+    The merged results are unique and in descending order.
+    """
+
+    now = time.time()
+    ids = [time_snowflake(now - random.random() * 6 * 24 * 3600) + i
+           for i in range(3000)]
+
+    fetched = []
+    def fake_search(ath, **params):
+        found = sorted((i for i in ids
+                        if params["since_id"] < i <= params["max_id"]),
+                       reverse=True)
+        for page in range(0, len(found), 100):
+            fetched.append(page)
+            statuses = [{"id": i} for i in found[page:page + 100]]
+            yield {"statuses": statuses}, {"code": 200}
+
+    monkeypatch.setattr(rest, "search_tweets", fake_search)
+
+    keys = [{"client_key": "ck", "client_secret": "cs",
+             "resource_owner_key": "rk", "resource_owner_secret": "rs"}]
+    tweets = list(search.search_parallel(auth.MultiAuth(keys), "news",
+                                         nthreads=3, until=now + 1))
+    assert [t["id"] for t in tweets] == sorted(set(ids), reverse=True)
+
+    # Ranges ahead of the consumer only fetch up to depth pages
+    del fetched[:]
+    tweets = search.search_parallel(auth.MultiAuth(keys), "news", nthreads=2,
+                                    parts=4, depth=1, until=now + 1)
+    next(tweets)
+    time.sleep(0.05)
+    assert len(fetched) <= 2 * (1 + 1) + 1
+    tweets.close()
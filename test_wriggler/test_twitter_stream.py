@@ -2,12 +2,17 @@
 Test the search_tweets api.
 """
 
+import json
+import time
 from itertools import islice
 
 import pytest
 
+import wriggler.req as req
+import wriggler.const as const
 import wriggler.twitter.auth as auth
 import wriggler.twitter.stream as stream
+from wriggler.twitter import boxes_to_csv
 
 TEST_USERS = [
     (759251, "CNN"),
@@ -62,4 +67,139 @@ def test_statuses_sample(samp_auth):
     for line in iterable:
         pass
 
+def tweet(tid):
+    """
+    Return the stream line of a tweet.
+    """
+
+    return json.dumps({"id": tid, "text": "tweet %d" % tid})
+
+def delete(tid):
+    """
+    Return the stream line of a status deletion notice.
+    """
+
+    return json.dumps({"delete": {"status": {"id": tid, "user_id": 1}}})
+
+def fake_stream(lines, gap=0.0, error=None):
+    """
+    Yield the lines, gap seconds apart, then raise the error if any.
+    """
+
+    for line in lines:
+        time.sleep(gap)
+        yield line
+    if error is not None:
+        raise error
+
+def test_message_id():
+    """
+    Tweets are identified by id, others by content.
+    """
+
+    assert stream.message_id(tweet(5)) == 5
+    assert stream.message_id('{"id": 5, "text": "x"}') == 5
+    assert stream.message_id(delete(5)) != stream.message_id(delete(6))
+    assert stream.message_id(delete(5)) == \
+        stream.message_id('{"delete":{"status":{"user_id":1,"id":5}}}')
+    assert stream.message_id("garbage") == "garbage"
+
+def test_merge_streams():
+    """
+    Each message is emitted once, even across a reconnect gap.
+    """
+
+    first = [tweet(i) for i in range(0, 60)] + [delete(3)]
+    # The second connection missed 20 to 40 while reconnecting
+    second = ([tweet(i) for i in range(0, 20)] +
+              [tweet(i) for i in range(40, 80)] + [delete(3)])
+
+    streams = [fake_stream(first, 0.001), fake_stream(second, 0.001)]
+    lines = list(stream.merge_streams(streams))
+
+    assert sorted(lines) == sorted(set(first + second))
+
+def test_merge_streams_window():
+    """
+    Only the last window messages are remembered.
+    """
+
+    lines = [tweet(1), tweet(2), tweet(3), tweet(1)]
+    merged = list(stream.merge_streams([fake_stream(lines)], window=2))
+    assert merged == lines
+    merged = list(stream.merge_streams([fake_stream(lines)], window=3))
+    assert merged == lines[:3]
+
+def test_merge_streams_errors():
+    """
+    A failed stream is survived; all failing is raised.
+    """
+
+    lines = [tweet(i) for i in range(10)]
+    streams = [fake_stream(lines[:5], error=ValueError("down")),
+               fake_stream(lines, 0.01)]
+    assert sorted(stream.merge_streams(streams)) == sorted(lines)
+
+    streams = [fake_stream([], error=ValueError("down")) for _ in range(2)]
+    with pytest.raises(ValueError):
+        list(stream.merge_streams(streams))
+
+def test_boxes_to_csv():
+    """
+    Bounding boxes are flattened for the locations parameter.
+    """
+
+    boxes = [(-122.75, 36.8, -121.75, 37.8), (-74, 40, -73, 41)]
+    assert boxes_to_csv(boxes) == "-122.75,36.8,-121.75,37.8,-74,40,-73,41"
+    assert boxes_to_csv([-74, 40, -73, 41]) == "-74,40,-73,41"
+    with pytest.raises(ValueError):
+        boxes_to_csv([(-74, 40, -73)])
+
+class FakeAuth(object):
+    """
+    Auth with a dummy user token, for stream_call.
+    """
+
+    token = {"client_key": "ck", "client_secret": "cs",
+             "resource_owner_key": "rk", "resource_owner_secret": "rs"}
+
+class FakeStreamResponse(object):
+    """
+    Streaming response returning the given lines.
+    """
+
+    status_code = 200
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+def test_stream_reconnects(monkeypatch):
+    """
+    Streams back off and reconnect when the retries run out.
+    """
+
+    results = [req.ConnectFailError("url", "post"),
+               req.ConnectFailError("url", "post"),
+               FakeStreamResponse([tweet(1), tweet(2)]),
+               req.ConnectFailError("url", "post"),
+               FakeStreamResponse([tweet(3)])]
+
+    def post(*args, **kwargs):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    sleeps = []
+    monkeypatch.setattr(stream.req, "post", post)
+    monkeypatch.setattr(stream, "sleep", sleeps.append)
+
+    lines = stream.stream_call("url", FakeAuth(), {}, "post")
+    assert list(islice(lines, 3)) == [tweet(1), tweet(2), tweet(3)]
 
+    # Doubled while failing, reset once connected
+    start = const.CONNECT_RETRY_AFTER
+    assert sleeps == [start, start * 2, start]
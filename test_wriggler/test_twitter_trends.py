@@ -0,0 +1,81 @@
+"""
+Test the delta only trends poller.
+"""
+
+import json
+
+import wriggler.twitter.auth as auth
+import wriggler.twitter.rest as rest
+import wriggler.twitter.trends as trends
+
+KEYS = [{"client_key": "ck%d" % i, "client_secret": "cs",
+         "resource_owner_key": "rk%d" % i, "resource_owner_secret": "rs"}
+        for i in range(2)]
+
+def test_diff_trends():
+    """
+    Trends are compared by name and rank.
+    """
+
+    old = [{"name": "a", "tweet_volume": 1}, {"name": "b", "tweet_volume": 2},
+           {"name": "d", "tweet_volume": 5}]
+    new = [{"name": "b", "tweet_volume": 3}, {"name": "c", "tweet_volume": 4},
+           {"name": "d", "tweet_volume": 5}]
+    entered, left, moved, changed = trends.diff_trends(old, new)
+    assert entered == [(2, new[1])]
+    assert left == [(1, "a")]
+    assert moved == [("b", 2, 1)]
+    assert changed == [(1, new[0])]
+    assert trends.diff_trends(new, new) == ([], [], [], [])
+
+    # Only the order changed
+    swapped = [new[1], new[0], new[2]]
+    assert trends.diff_trends(new, swapped) == \
+        ([], [], [("c", 2, 1), ("b", 1, 2)], [])
+
+def test_min_interval():
+    """
+    The interval scales with the places and the keys.
+    """
+
+    multi = auth.MultiAuth(KEYS)
+    assert trends.min_interval(multi, 150) == 900
+    assert trends.min_interval(multi, 75) == 450
+
+def test_poll_trends(monkeypatch, tmpdir):
+    """
+    Only places whose trends changed are written.
+    """
+
+    calls = []
+
+    def fake_available(ath):
+        return [{"woeid": w} for w in (1, 2, 3)], {"code": 200}
+
+    def fake_place(ath, **params):
+        woeid = params["id"]
+        calls.append(woeid)
+        if woeid == 3:
+            return {}, {"code": 404, "error_code": 34}
+        # Place 2 changes every call
+        volume = len(calls) if woeid == 2 else 0
+        data = [{"trends": [{"name": "#w%d" % woeid,
+                             "tweet_volume": volume}]}]
+        return data, {"code": 200, "error_code": 0}
+
+    sleeps = []
+    monkeypatch.setattr(rest, "trends_available", fake_available)
+    monkeypatch.setattr(rest, "trends_place", fake_place)
+    monkeypatch.setattr(trends.time, "sleep", sleeps.append)
+
+    fname = str(tmpdir.join("trends.json"))
+    count = trends.poll_trends(auth.MultiAuth(KEYS), fname, rounds=3,
+                               nthreads=2)
+    assert len(calls) == 9
+    assert len(sleeps) == 2 and all(s > 0 for s in sleeps)
+
+    with open(fname) as fobj:
+        deltas = [json.loads(line) for line in fobj]
+    assert count == len(deltas) == 4
+    assert sorted(d["woeid"] for d in deltas) == [1, 2, 2, 2]
+    assert all(len(d["entered"]) == 1 for d in deltas if d["woeid"] == 1)
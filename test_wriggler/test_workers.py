@@ -0,0 +1,64 @@
+"""
+Test the concurrent call helpers.
+"""
+
+import time
+import random
+
+import pytest
+
+import wriggler.workers as workers
+
+def slow_square(auth, x):
+    """
+    Square x after a random delay.
+    """
+
+    time.sleep(random.random() / 100)
+    return auth, x * x
+
+def test_imap_ordered():
+    """
+    Results are yielded in input order.
+    """
+
+    results = list(workers.imap(slow_square, iter(range(100)), "abcd"))
+    assert [x for _, x in results] == [x * x for x in range(100)]
+    assert set(auth for auth, _ in results) == set("abcd")
+
+def test_imap_unordered():
+    """
+    All results are yielded as they complete.
+    """
+
+    results = workers.imap(slow_square, range(100), "ab", ordered=False)
+    assert sorted(x for _, x in results) == [x * x for x in range(100)]
+
+def test_imap_error():
+    """
+    Errors are raised in the caller.
+    """
+
+    def fail(auth, x):
+        if x == 5:
+            raise ValueError(x)
+        return x
+
+    with pytest.raises(ValueError):
+        list(workers.imap(fail, range(10), "ab"))
+
+def test_prefetch():
+    """
+    Prefetched items keep their order, and errors reach the caller.
+    """
+
+    assert list(workers.prefetch(iter(range(20)), 3)) == range(20)
+
+    def fail():
+        yield 1
+        raise ValueError(2)
+
+    items = workers.prefetch(fail(), 3)
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
@@ -3,12 +3,16 @@ API for BingSearch Web
 """
 
 import time
+from urlparse import urlsplit
 from base64 import b64encode
 
 import logbook
+import requests
 
 import wriggler.const as const
 import wriggler.req as req
+import wriggler.budget as budget
+import wriggler.workers as workers
 
 from wriggler.azure import AzureError
 
@@ -16,20 +20,29 @@ log = logbook.Logger(__name__)
 
 ENDPOINT = "https://api.datamarket.azure.com/Bing/SearchWeb/v1/Web"
 
+# Maximum number of results in a page
+MAX_TOP = 50
+
 def search(auth, query, **params):
     """
     Return the results web search query from Bing.
+
+    Pass session to make the request over a pooled session.
     """
 
+    session = params.pop("session", None)
+
     auth = "Basic " + b64encode(":" + auth)
     auth_header = {"Authorization": auth}
 
     params.setdefault("$format", "json")
     params.setdefault("Query", "'%s'" % query)
 
+    retries = budget.current(urlsplit(ENDPOINT).netloc)
     tries = 0
     while tries < const.API_RETRY_MAX:
-        r = req.get(ENDPOINT, params=params, headers=auth_header, timeout=60.0)
+        r = req.get(ENDPOINT, params=params, headers=auth_header,
+                    session=session, timeout=60.0)
 
         # Proper receive
         if 200 <= r.status_code < 300:
@@ -39,6 +52,8 @@ def search(auth, query, **params):
             except ValueError:
                 log.info(u"Try L1 {}: Falied to decode JSON - {}\n{}",
                          tries, r.status_code, r.text)
+                if not retries.can_retry():
+                    break
                 tries += 1
                 continue
 
@@ -50,6 +65,8 @@ def search(auth, query, **params):
                      tries, r.status_code, r.text)
             time.sleep(const.API_RETRY_AFTER)
 
+            if not retries.can_retry():
+                break
             tries += 1
             continue
 
@@ -58,3 +75,66 @@ def search(auth, query, **params):
 
     # Give up
     raise AzureError(r, tries)
+
+def make_session(size):
+    """
+    Return a session keeping up to size connections open.
+    """
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=size)
+    session.mount("https://", adapter)
+    return session
+
+def search_iter(auth, query, maxitems=500, depth=4, session=None, **params):
+    """
+    Iterate over the results of the query in rank order.
+
+    The next depth pages are requested concurrently, and iteration
+    stops after maxitems results or at the first page which is not full.
+    """
+
+    top = min(params.pop("$top", MAX_TOP), MAX_TOP)
+    if session is None:
+        session = make_session(depth)
+
+    def fetch(ath, skip):
+        page = dict(params)
+        page["$top"] = min(top, maxitems - skip)
+        page["$skip"] = skip
+        data, _ = search(ath, query, session=session, **page)
+        return page["$top"], data["d"]["results"]
+
+    pages = workers.imap(fetch, xrange(0, maxitems, top), [auth] * depth,
+                         window=depth)
+    count = 0
+    try:
+        for size, results in pages:
+            for result in results[:maxitems - count]:
+                yield result
+            count += len(results)
+            if len(results) < size or count >= maxitems:
+                return
+    finally:
+        pages.close()
+
+def search_many(auths, queries, maxitems=500, per_key=2, **params):
+    """
+    Search for many queries at once.
+
+    Every query is paged by one thread, and at most per_key
+    threads use the same key at a time.
+
+    Yields (query, results) as the queries complete.
+    """
+
+    auths = [auth for auth in auths for _ in xrange(per_key)]
+    session = make_session(len(auths))
+
+    def fetch(ath, query):
+        results = search_iter(ath, query, maxitems, depth=1,
+                              session=session, **dict(params))
+        return query, list(results)
+
+    return workers.imap(fetch, queries, auths, ordered=False)
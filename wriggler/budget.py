@@ -0,0 +1,183 @@
+"""
+Retry budgets.
+
+Every retry, at the connection level (L0) or the api level (L1), has to
+be drawn from a retry budget. A budget allows RETRY_BUDGET_MIN retries,
+plus RETRY_BUDGET_RATIO retries per successful request, over a sliding
+window of RETRY_BUDGET_WINDOW seconds. So a partial outage can only add
+a bounded fraction to the load on the api, instead of multiplying it.
+
+Budgets are opt in; without one, retries are only bounded by the retry
+limits of the loops. enable() gives every host its own budget, so an
+outage of one host does not take the retries of the others. A job budget
+set for the thread with use() takes over for all the hosts the job calls;
+a job budget with a parent also draws from it.
+"""
+
+from __future__ import division
+
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import wriggler.const as const
+
+class RetryBudget(object):
+    """
+    Retries allowed in proportion to the successes; thread safe.
+    """
+
+    def __init__(self, ratio=None, window=None, minimum=None, parent=None):
+        super(RetryBudget, self).__init__()
+
+        self.ratio = const.RETRY_BUDGET_RATIO if ratio is None else ratio
+        self.window = const.RETRY_BUDGET_WINDOW if window is None else window
+        self.minimum = const.RETRY_BUDGET_MIN if minimum is None else minimum
+        self.parent = parent
+
+        self.lock = threading.Lock()
+
+        # Per second buckets of [second, successes, retries]
+        self.buckets = deque()
+        self.successes, self.retries = 0, 0
+
+    def bucket(self):
+        """
+        Expire the buckets out of the window; return the current one.
+        """
+
+        now = int(time.time())
+        while self.buckets and self.buckets[0][0] <= now - self.window:
+            _, successes, retries = self.buckets.popleft()
+            self.successes -= successes
+            self.retries -= retries
+
+        if not self.buckets or self.buckets[-1][0] != now:
+            self.buckets.append([now, 0, 0])
+        return self.buckets[-1]
+
+    def success(self):
+        """
+        Record a successful request.
+        """
+
+        with self.lock:
+            self.bucket()[1] += 1
+            self.successes += 1
+        if self.parent is not None:
+            self.parent.success()
+
+    def can_retry(self):
+        """
+        Return True and record the retry if the budget allows it.
+        """
+
+        with self.lock:
+            bucket = self.bucket()
+            if self.retries >= self.minimum + self.ratio * self.successes:
+                return False
+            if self.parent is not None and not self.parent.can_retry():
+                return False
+            bucket[2] += 1
+            self.retries += 1
+            return True
+
+    def stats(self):
+        """
+        Return the successes and retries in the window.
+        """
+
+        with self.lock:
+            self.bucket()
+            return {"successes": self.successes, "retries": self.retries}
+
+class Unlimited(object):
+    """
+    Budget allowing every retry.
+    """
+
+    def success(self):
+        pass
+
+    def can_retry(self):
+        return True
+
+    def stats(self):
+        return {"successes": 0, "retries": 0}
+
+unlimited = Unlimited()
+
+class HostBudgets(object):
+    """
+    A retry budget for every host, made on first use; thread safe.
+    """
+
+    def __init__(self, **kwargs):
+        super(HostBudgets, self).__init__()
+
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def get(self, host):
+        """
+        Return the budget of the host.
+        """
+
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = RetryBudget(**self.kwargs)
+            return self.hosts[host]
+
+# Per host budgets of the process, once enabled
+hosts = None
+
+_local = threading.local()
+
+def enable(ratio=None, window=None, minimum=None):
+    """
+    Give every host a retry budget.
+    """
+
+    global hosts # pylint: disable=global-statement
+    hosts = HostBudgets(ratio=ratio, window=window, minimum=minimum)
+
+def disable():
+    """
+    Drop the per host budgets.
+    """
+
+    global hosts # pylint: disable=global-statement
+    hosts = None
+
+def job():
+    """
+    Return the job budget of the thread, if any.
+    """
+
+    return getattr(_local, "budget", None)
+
+def current(host=None):
+    """
+    Return the budget for the retries of the thread to the host.
+    """
+
+    if job() is not None:
+        return job()
+    if hosts is None or host is None:
+        return unlimited
+    return hosts.get(host)
+
+@contextmanager
+def use(budget):
+    """
+    Use the budget for the retries made in the thread.
+    """
+
+    old = getattr(_local, "budget", None)
+    _local.budget = budget
+    try:
+        yield budget
+    finally:
+        _local.budget = old
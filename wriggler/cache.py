@@ -0,0 +1,105 @@
+"""
+In memory LRU cache with expiring entries.
+
+Entries evicted from memory can be spilled to a sqlite file,
+from which they are brought back on the next access.
+"""
+
+from __future__ import division
+
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+class TTLCache(object):
+    """
+    LRU cache of at most maxsize entries, each valid for ttl seconds.
+    """
+
+    def __init__(self, maxsize=100000, ttl=3600, spill=None):
+        super(TTLCache, self).__init__()
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+        self.spill = None
+        if spill is not None:
+            self.spill = sqlite3.connect(spill, check_same_thread=False,
+                                         isolation_level=None)
+            self.spill.execute("PRAGMA synchronous = OFF")
+            self.spill.execute("CREATE TABLE IF NOT EXISTS cache ("
+                               "key TEXT PRIMARY KEY, value TEXT, "
+                               "expires REAL)")
+
+    def _unspill(self, key, now):
+        row = self.spill.execute("SELECT value, expires FROM cache "
+                                 "WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        self.spill.execute("DELETE FROM cache WHERE key = ?", (key,))
+        value, expires = row
+        if expires <= now:
+            return None
+        return expires, value
+
+    def get(self, key, default=None):
+        """
+        Return the value of the key if cached and not expired.
+        """
+
+        now = time.time()
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None and self.spill is not None:
+                entry = self._unspill(key, now)
+
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return default
+
+            # Move to the most recently used end
+            self._insert(key, entry)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, ttl=None):
+        """
+        Cache the value of the key, for ttl seconds if given.
+        """
+
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.data.pop(key, None)
+            self._insert(key, (time.time() + ttl, value))
+
+    def _insert(self, key, entry):
+        self.data[key] = entry
+
+        now = time.time()
+        while len(self.data) > self.maxsize:
+            old_key, (expires, value) = self.data.popitem(last=False)
+            if self.spill is not None and expires > now:
+                self.spill.execute("INSERT OR REPLACE INTO cache "
+                                   "VALUES (?, ?, ?)",
+                                   (old_key, value, expires))
+
+    def stats(self):
+        """
+        Return the hit and miss counts and the hit rate.
+        """
+
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self.data),
+            }
@@ -14,6 +14,27 @@ import wriggler.const as const
 
 log = logbook.Logger(__name__)
 
+def has_rate_limit(headers):
+    """
+    Check if the headers carry the remaining calls.
+
+    Responses without them (e.g. most server errors)
+    say nothing about the rate limit.
+    """
+
+    remain = headers.get("X-Rate-Limit-Remaining", None)
+    if remain is None:
+        remain = headers.get("X-RateLimit-Remaining", None)
+    if remain is None:
+        return False
+
+    try:
+        int(remain)
+    except ValueError:
+        return False
+
+    return True
+
 def get_remaining(headers):
     """
     Get the ratelimit header.
@@ -8,6 +8,9 @@ CONNECT_RETRY_AFTER = 10
 # Maximum number of connection retries
 CONNECT_RETRY_MAX = 100
 
+# Longest wait between reconnects of a failing stream (seconds)
+STREAM_BACKOFF_MAX = 320
+
 # In case of unknown error in api, retry after this many seconds
 API_RETRY_AFTER = 5
 
@@ -17,3 +20,33 @@ API_RETRY_MAX = 100
 # In case ratelimit is hit, wake 5 secs after the reset time is over.
 API_RESET_BUFFER = 5
 
+# Maximum time a failing key is quarantined for (seconds)
+KEY_QUARANTINE_MAX = 6 * 60 * 60
+
+# Consecutive suspect failures (timeouts, 401s without an error code)
+# of a key before it is quarantined
+KEY_STRIKES_MAX = 3
+
+# Default port of the key state server
+KEY_STATE_PORT = 7469
+
+# Save the state of persisted keys this often (seconds)
+KEY_STATE_SAVE_EVERY = 60
+
+# Consecutive failures to a host before its circuit opens
+CIRCUIT_FAIL_MAX = 20
+
+# Seconds an open circuit waits before letting probes through
+CIRCUIT_RESET_AFTER = 60
+
+# Probe requests allowed, and needed to succeed, while half open
+CIRCUIT_PROBES = 3
+
+# Retries allowed per successful request, over the retry budget window
+RETRY_BUDGET_RATIO = 0.2
+
+# Sliding window of the retry budget (seconds)
+RETRY_BUDGET_WINDOW = 60
+
+# Retries always allowed in the retry budget window
+RETRY_BUDGET_MIN = 10
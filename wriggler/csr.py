@@ -0,0 +1,208 @@
+"""
+Graphs stored on disk in compressed sparse row layout.
+
+A graph is a directory of little endian int64 arrays:
+
+neighbors.i64  - Neighbor ids of all the rows, one row after the other
+offsets.i64    - Start of every row in neighbors, and the end of the last
+rows.i64       - User id of every row
+index_ids.i64  - User ids, sorted
+index_rows.i64 - Row of every user in index_ids
+
+CSRWriter appends rows as the pages of ids come in (e.g. from friends_ids
+or followers_ids), and builds the index when closed. CSRGraph maps the
+arrays, so neighbors are read straight from the files on query.
+"""
+
+import os
+import struct
+from bisect import bisect_left
+from array import array
+from itertools import izip
+
+import logbook
+
+from wriggler.mmarray import MappedArray
+
+log = logbook.Logger(__name__)
+
+FILES = ("neighbors", "offsets", "rows", "index_ids", "index_rows")
+
+def pack(ids):
+    """
+    Pack the ids as little endian int64.
+    """
+
+    return struct.pack("<%dq" % len(ids), *ids)
+
+def fname_of(dirname, name):
+    return os.path.join(dirname, name + ".i64")
+
+class CSRWriter(object):
+    """
+    Write a graph, one row after the other.
+
+    The neighbors of a row can be added over many calls, but the rows of
+    different users must not be interleaved.
+    """
+
+    def __init__(self, dirname):
+        super(CSRWriter, self).__init__()
+
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self.dirname = dirname
+        self.neighbors = open(fname_of(dirname, "neighbors"), "wb")
+        self.offsets = open(fname_of(dirname, "offsets"), "wb")
+        self.rows = open(fname_of(dirname, "rows"), "wb")
+
+        # User id of every row; "l" is 64 bit on the platforms we run on
+        self.user_ids = array("l")
+        self.nedges = 0
+        self.current = None
+
+    def add(self, user_id, neighbor_ids):
+        """
+        Add the neighbors to the row of the user.
+        """
+
+        if user_id != self.current:
+            self.offsets.write(pack([self.nedges]))
+            self.rows.write(pack([user_id]))
+            self.user_ids.append(user_id)
+            self.current = user_id
+
+        self.neighbors.write(pack(neighbor_ids))
+        self.nedges += len(neighbor_ids)
+
+    def add_pages(self, user_id, pages):
+        """
+        Add the pages of ids returned by cursor_iter for the user.
+
+        Stops at the first failed page. Returns the number of ids added.
+        The row is added even if there are no ids.
+        """
+
+        count = 0
+        self.add(user_id, [])
+        for data, meta in pages:
+            if meta["code"] != 200:
+                log.notice(u"Failed to get ids of {}; {}", user_id, meta)
+                break
+            self.add(user_id, data["ids"])
+            count += len(data["ids"])
+        return count
+
+    def close(self):
+        """
+        Write the end of the last row and the index.
+        """
+
+        self.offsets.write(pack([self.nedges]))
+        for fobj in (self.neighbors, self.offsets, self.rows):
+            fobj.close()
+
+        # Rows of the same user sort by row, so the first comes first
+        order = sorted(izip(self.user_ids, xrange(len(self.user_ids))))
+        with open(fname_of(self.dirname, "index_ids"), "wb") as ids, \
+                open(fname_of(self.dirname, "index_rows"), "wb") as rows:
+            last = None
+            for user_id, row in order:
+                if user_id == last:
+                    log.notice(u"User {} has many rows; keeping the first",
+                               user_id)
+                    continue
+                ids.write(pack([user_id]))
+                rows.write(pack([row]))
+                last = user_id
+
+        log.info(u"Wrote graph of {} rows, {} edges to {}",
+                 len(self.user_ids), self.nedges, self.dirname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+class CSRGraph(object):
+    """
+    Read only graph written by CSRWriter.
+    """
+
+    def __init__(self, dirname):
+        super(CSRGraph, self).__init__()
+
+        self.dirname = dirname
+        self.arrays = dict((name, MappedArray(fname_of(dirname, name), "<q"))
+                           for name in FILES)
+
+        self.nrows = len(self.arrays["rows"])
+        self.nedges = len(self.arrays["neighbors"])
+
+    def __len__(self):
+        return self.nrows
+
+    def row(self, user_id):
+        """
+        Return the row of the user, or None.
+        """
+
+        ids = self.arrays["index_ids"]
+        pos = bisect_left(ids, user_id)
+        if pos < len(ids) and ids[pos] == user_id:
+            return self.arrays["index_rows"][pos]
+        return None
+
+    def __contains__(self, user_id):
+        return self.row(user_id) is not None
+
+    def row_neighbors(self, row):
+        """
+        Return a view of the neighbor ids of the row, read on access.
+        """
+
+        offsets = self.arrays["offsets"]
+        return self.arrays["neighbors"].view(offsets[row], offsets[row + 1])
+
+    def neighbors(self, user_id):
+        """
+        Return the neighbor ids of the user; KeyError if not in the graph.
+
+        The ids are a MappedView, valid till the graph is closed.
+        """
+
+        row = self.row(user_id)
+        if row is None:
+            raise KeyError(user_id)
+        return self.row_neighbors(row)
+
+    def degree(self, user_id):
+        """
+        Return the number of neighbors of the user.
+        """
+
+        row = self.row(user_id)
+        if row is None:
+            raise KeyError(user_id)
+        offsets = self.arrays["offsets"]
+        return offsets[row + 1] - offsets[row]
+
+    def iteritems(self):
+        """
+        Iterate over (user_id, neighbor_ids) of the rows, in order.
+        """
+
+        for row, user_id in enumerate(self.arrays["rows"]):
+            yield user_id, self.row_neighbors(row)
+
+    def close(self):
+        for arr in self.arrays.itervalues():
+            arr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
@@ -2,15 +2,25 @@
 Foursquare API
 """
 
+from __future__ import division
+
+import json
+import math
 import time
 import pprint
+import threading
+from urlparse import urlsplit
 
 import logbook
 
 from wriggler import Error
 import wriggler.const as const
 import wriggler.req as req
-from wriggler.check_rate_limit import check_rate_limit
+import wriggler.budget as budget
+import wriggler.workers as workers
+from wriggler.keystate import LocalKeyState
+from wriggler.check_rate_limit import (check_rate_limit, get_remaining,
+                                       get_reset_time, has_rate_limit)
 
 log = logbook.Logger(__name__)
 
@@ -128,40 +138,156 @@ class FoursquareError(Error):
                           self.error_detail,
                           btext)
 
+class MultiAuth(object):
+    """
+    Manage multiple foursquare credentials.
+
+    The remaining calls and reset times of the credentials are kept in
+    state (see wriggler.keystate). Every call is made with a credential
+    that has calls left, and blocks only when all of them are exhausted.
+    Unlike the twitter MultiAuth, the pool can be shared by threads.
+    """
+
+    def __init__(self, keys, state=None):
+        super(MultiAuth, self).__init__()
+
+        self.keys = {key["client_id"]: key for key in keys}
+        self.slots = [key["client_id"] for key in keys]
+        self.state = LocalKeyState() if state is None else state
+
+    def acquire(self):
+        """
+        Lease a call and return the credential to make it with.
+        """
+
+        while True:
+            slot, wait = self.state.lease(self.slots)
+            if slot is not None:
+                return self.keys[slot]
+
+            log.debug("All credentials in rate limit, sleeping {} secs ...",
+                      wait)
+            time.sleep(wait)
+
+    def release(self, key):
+        """
+        Give back the call leased on the credential.
+        """
+
+        self.state.release(key["client_id"])
+
+    def check_limit(self, key, headers):
+        """
+        Record the rate limit of the credential.
+
+        Returns False, recording nothing, if the headers do not carry
+        the rate limit.
+        """
+
+        if not has_rate_limit(headers):
+            return False
+
+        now = int(time.time())
+        sleep_time = check_rate_limit(headers)
+
+        if sleep_time:
+            log.debug("Credential {} hit rate limit ...", key["client_id"])
+            self.state.update(key["client_id"], 0, now + sleep_time)
+        else:
+            self.state.update(key["client_id"], get_remaining(headers),
+                              get_reset_time(headers))
+        return True
+
+# Pools for calls made with a single credential
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def get_pool(auth):
+    """
+    Return the pool of the auth; a single credential gets its own.
+    """
+
+    if isinstance(auth, MultiAuth):
+        return auth
+
+    with _POOLS_LOCK:
+        if auth["client_id"] not in _POOLS:
+            _POOLS[auth["client_id"]] = MultiAuth([auth])
+        return _POOLS[auth["client_id"]]
+
+def read_keys(fname, state=None):
+    """
+    Read multiple credentials from file.
+    """
+
+    log.debug("Reading keys from {} ...", fname)
+    with open(fname) as fobj:
+        keys = json.load(fobj)
+
+    return MultiAuth(keys, state)
+
+def is_throttled(r):
+    """
+    Check if the error response is due to rate limiting.
+    """
+
+    if r.status_code == 429:
+        return True
+
+    try:
+        return r.json()["meta"]["errorType"] == "rate_limit_exceeded"
+    except (ValueError, KeyError, TypeError):
+        return False
+
 def rest_api_call(endpoint, auth, accept_codes, params):
     """
     Call the rest api endpoint.
+
+    auth is either a credential dict or a MultiAuth.
     """
 
+    pool = get_pool(auth)
+
     # Add version info into the code
-    params.setdefault("client_id", auth["client_id"])
-    params.setdefault("client_secret", auth["client_secret"])
     params.setdefault("v", VERSION)
     params.setdefault("m", MODE)
 
+    retries = budget.current(urlsplit(endpoint).netloc)
     tries = 0
     while tries < const.API_RETRY_MAX:
-        r = req.get(endpoint, params=params, timeout=60.0)
+        key = pool.acquire()
+        params["client_id"] = key["client_id"]
+        params["client_secret"] = key["client_secret"]
+
+        try:
+            r = req.get(endpoint, params=params, timeout=60.0)
+        except req.ConnectFailError:
+            pool.release(key)
+            raise
+
+        limited = pool.check_limit(key, r.headers)
 
         # Proper receive
         if 200 <= r.status_code < 300 or r.status_code in accept_codes:
-            time.sleep(check_rate_limit(r.headers))
-
             try:
                 data = r.json()
             except ValueError:
                 log.info(u"Try L1 {}: Falied to decode Json - {}\n{}",
                          tries, r.status_code, r.text)
+                if not retries.can_retry():
+                    break
                 tries += 1
                 continue
 
             return (data, r.status_code)
 
         # Check if rate limited
-        if r.status_code in 403:
+        if r.status_code in (403, 429) and is_throttled(r):
             log.info(u"Try L1 {}: Being throttled - {}\n{}",
                      tries, r.status_code, r.text)
-            time.sleep(check_rate_limit(r.headers))
+            # Without rate limit headers, wait before trying again
+            if not limited:
+                time.sleep(const.API_RETRY_AFTER)
             tries += 1
             continue
 
@@ -169,7 +295,9 @@ def rest_api_call(endpoint, auth, accept_codes, params):
         if 500 <= r.status_code < 600:
             log.info(u"Try L1 {}: Server side error {}\n{}",
                      tries, r.status_code, r.text)
-            time.sleep(check_rate_limit(r.headers))
+            if not retries.can_retry():
+                break
+            time.sleep(const.API_RETRY_AFTER)
             tries += 1
             continue
 
@@ -189,3 +317,100 @@ def venues_explore(auth, **params):
 
     return rest_api_call(endpoint, auth, accept_codes, params)
 
+# Largest radius (in meters) venues_explore accepts
+EXPLORE_RADIUS_MAX = 100000
+
+def tile_radius(tile):
+    """
+    Return the radius (in meters) of the circle around the tile.
+    """
+
+    south, west, north, east = tile
+    lat = math.radians((south + north) / 2)
+    dy = (north - south) * 111320.0
+    dx = (east - west) * 111320.0 * math.cos(lat)
+    return int(math.ceil(math.hypot(dx, dy) / 2))
+
+def split_tile(tile):
+    """
+    Split the tile into four.
+    """
+
+    south, west, north, east = tile
+    lat, lng = (south + north) / 2, (west + east) / 2
+    return [(south, west, lat, lng), (south, lng, lat, east),
+            (lat, west, north, lng), (lat, lng, north, east)]
+
+def explore_tile(auth, tile, params):
+    """
+    Explore the venues in the tile.
+
+    Returns the venues inside the tile and
+    whether the call returned as many venues as it could.
+    """
+
+    south, west, north, east = tile
+    params = dict(params)
+    params["ll"] = "%f,%f" % ((south + north) / 2, (west + east) / 2)
+    params["radius"] = min(tile_radius(tile), EXPLORE_RADIUS_MAX)
+
+    data, _ = venues_explore(auth, **params)
+    resp = data["response"]
+
+    venues = [item["venue"] for group in resp.get("groups", [])
+              for item in group.get("items", [])]
+    saturated = (len(venues) >= params["limit"] or
+                 resp.get("totalResults", 0) > len(venues))
+
+    inside = []
+    for venue in venues:
+        lat, lng = venue["location"]["lat"], venue["location"]["lng"]
+        if south <= lat <= north and west <= lng <= east:
+            inside.append(venue)
+
+    return inside, saturated
+
+def venues_sweep(auth, sw, ne, nthreads=1, min_size=0.001, **params):
+    """
+    Explore all the venues in the bounding box.
+
+    Starts with the whole box as a single tile, and splits a tile into
+    four when its call returned as many venues as it could. Tiles too
+    large for the circle around them to fit in EXPLORE_RADIUS_MAX are
+    split without a call, as the call would miss their corners. Tiles
+    smaller than min_size degrees are not split further. Each level of
+    tiles is explored with nthreads concurrent calls.
+
+    auth   - Credential dict or MultiAuth
+    sw, ne - (lat, lng) of the south west and north east corners
+
+    Yields every venue found, once.
+    """
+
+    params.setdefault("limit", 50)
+
+    seen = set()
+    tiles = [(sw[0], sw[1], ne[0], ne[1])]
+    func = lambda ath, tile: (tile, explore_tile(ath, tile, params))
+
+    while tiles:
+        next_tiles = []
+        for tile in tiles:
+            if tile_radius(tile) > EXPLORE_RADIUS_MAX:
+                next_tiles.extend(split_tile(tile))
+        tiles = [t for t in tiles if tile_radius(t) <= EXPLORE_RADIUS_MAX]
+
+        for tile, (venues, saturated) in workers.imap(func, tiles,
+                                                      [auth] * nthreads):
+            for venue in venues:
+                if venue["id"] not in seen:
+                    seen.add(venue["id"])
+                    yield venue
+
+            south, west, north, east = tile
+            if saturated and min(north - south, east - west) > min_size:
+                next_tiles.extend(split_tile(tile))
+
+        log.debug(u"Sweep level done; {} venues, {} tiles next",
+                  len(seen), len(next_tiles))
+        tiles = next_tiles
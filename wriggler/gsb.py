@@ -3,11 +3,16 @@ API for Google Safe Browsing Lookup API
 """
 
 import time
+from functools import partial
+from urlparse import urlsplit, urlunsplit
+
 import logbook
 
 from wriggler import Error
 import wriggler.const as const
 import wriggler.req as req
+import wriggler.budget as budget
+import wriggler.workers as workers
 
 log = logbook.Logger(__name__)
 
@@ -15,9 +20,15 @@ CLIENT = "wriggler.gsb"
 PVER = 3.0
 ENDPOINT = "https://sb-ssl.google.com/safebrowsing/api/lookup"
 
-# max request body size
+# max request body size in bytes
 MAX_SIZE = 10 * 1024
 
+# max number of urls in a request
+MAX_URLS = 500
+
+# max number of urls (including duplicates and cached ones) in a batch
+MAX_BATCH = 10 * MAX_URLS
+
 ERROR_CODES = {
     400: ("Bad Request", "The HTTP request was not correctly formed"),
     401: ("Not Authorized", "The apikey is not authorized"),
@@ -58,23 +69,78 @@ class GoogleSafeBrowsingError(Error):
                "--------\n{3}")
         return hdr.format(self.http_status_code, etext, edesc, body)
 
-def make_body(urls):
+def canonicalize(url):
+    """
+    Return the url in a canonical form, used to remove duplicates.
+    """
+
+    url = url.strip()
+    if "://" not in url:
+        url = "http://" + url
+
+    scheme, netloc, path, query, _ = urlsplit(url)
+    return urlunsplit((scheme.lower(), netloc.lower(), path or "/", query, ""))
+
+def join_body(lines):
+    """
+    Join the encoded urls into a request body.
     """
-    Create the body of the next request.
+
+    if not lines:
+        return None
+    return str(len(lines)) + "\n" + "\n".join(lines)
+
+def make_body(urls, cache=None):
+    """
+    Create the bodies of the requests.
+
+    Duplicate urls (after canonicalization) are sent only once,
+    and every body is at most MAX_SIZE bytes long. Urls with a verdict
+    in the cache are not sent.
+
+    Yields the (url, canonical url) pairs of the batch,
+    the unique canonical urls sent, the body (None if nothing is sent)
+    and a dict of the cached verdicts.
     """
 
-    us, body = [], ""
+    batch, canons, lines, size, known = [], [], [], 0, {}
+    seen = set()
 
     for url in urls:
-        us.append(url)
-        body = body + "\n" + url
+        canon = canonicalize(url)
 
-        if len(us) == 500 or len(body) >= MAX_SIZE:
-            yield us, str(len(us)) + body
-            us, body = [], ""
+        if len(batch) == MAX_BATCH:
+            yield batch, canons, join_body(lines), known
+            batch, canons, lines, size, known = [], [], [], 0, {}
+            seen = set()
 
-    if us:
-        yield us, str(len(us)) + body
+        if canon not in seen:
+            verdict = None if cache is None else cache.get(canon)
+
+            line = canon
+            if isinstance(line, unicode):
+                line = line.encode("utf-8")
+
+            # Size of the body with the new url; count + lines
+            new_size = len(str(len(lines) + 1)) + size + 1 + len(line)
+            if verdict is None and lines and (len(lines) == MAX_URLS or
+                                              new_size > MAX_SIZE):
+                yield batch, canons, join_body(lines), known
+                batch, canons, lines, size, known = [], [], [], 0, {}
+                seen = set()
+
+            seen.add(canon)
+            if verdict is not None:
+                known[canon] = verdict
+            else:
+                canons.append(canon)
+                lines.append(line)
+                size += 1 + len(line)
+
+        batch.append((url, canon))
+
+    if batch:
+        yield batch, canons, join_body(lines), known
 
 def do_lookup(auth, urls, data):
     """
@@ -85,6 +151,7 @@ def do_lookup(auth, urls, data):
     params = {"client": CLIENT, "appver": 0.1, "apikey": auth, "pver": PVER}
 
     # Make the request
+    retries = budget.current(urlsplit(ENDPOINT).netloc)
     tries = 0
     while tries < const.API_RETRY_MAX:
         r = req.post(ENDPOINT, params=params, data=data, timeout=60.0)
@@ -105,22 +172,52 @@ def do_lookup(auth, urls, data):
             log.info(u"Try L1 {}: Server side error {} {}",
                      tries, r.status_code, r.text)
             time.sleep(const.API_RETRY_AFTER)
+            if not retries.can_retry():
+                break
+            tries += 1
+            continue
 
         # Some other error
         break
 
     raise GoogleSafeBrowsingError(r, tries)
 
-def lookup(auth, urls):
+def lookup_batch(auth, batch, cache=None):
+    """
+    Lookup a batch made by make_body.
+    """
+
+    pairs, canons, data, known = batch
+
+    resp = {}
+    if data is not None:
+        resp, _ = do_lookup(auth, canons, data)
+        if cache is not None:
+            for canon, verdict in resp.iteritems():
+                cache.put(canon, verdict)
+
+    # As the api would answer for the whole batch
+    resp.update(known)
+    bad = any(verdict != "ok" for verdict in resp.itervalues())
+    status_code = 200 if bad else 204
+
+    return {url: resp[canon] for url, canon in pairs}, status_code
+
+def lookup(auth, urls, nthreads=1, cache=None):
     """
     Check ecah url using Google Safe Browsing Lookup API.
 
     Returns a dict mapping each url to the api response.
 
-    key  - API Key
-    urls - List of urls to check
+    key      - API Key
+    urls     - List of urls to check
+    nthreads - Number of batches looked up concurrently
+    cache    - wriggler.cache.TTLCache of verdicts, if any
+
+    The responses are yielded one batch at a time in the input order.
+    Only the urls missing from the cache are sent to the api.
     """
 
-    for us, data in make_body(urls):
-        resp = do_lookup(auth, us, data)
-        yield resp
+    batches = make_body(urls, cache)
+    func = partial(lookup_batch, cache=cache)
+    return workers.imap(func, batches, [auth] * nthreads)
@@ -0,0 +1,413 @@
+"""
+Local hash prefix database for Google Safe Browsing checks.
+
+Works like the Safe Browsing Update API (v4). The hash prefixes of the
+threat lists are kept on disk as sorted arrays, one file for each prefix
+size, which are memory mapped and searched with bisect. The lists are
+updated incrementally with threatListUpdates:fetch, no more often than
+the server allows, and only urls with a local prefix hit are checked
+remotely with fullHashes:find. Full hash responses are cached for as long
+as the server says they are valid.
+"""
+
+from __future__ import division
+
+import os
+import json
+import time
+import heapq
+import base64
+import bisect
+import hashlib
+from urlparse import urlsplit
+
+import logbook
+
+import wriggler.const as const
+import wriggler.req as req
+import wriggler.budget as budget
+from wriggler.gsb import CLIENT, GoogleSafeBrowsingError, canonicalize
+from wriggler.cache import TTLCache
+from wriggler.mmarray import MappedArray
+
+log = logbook.Logger(__name__)
+
+ENDPOINT = "https://safebrowsing.googleapis.com/v4"
+
+# (threatType, platformType, threatEntryType) of the lists kept
+LISTS = [
+    ("MALWARE", "ANY_PLATFORM", "URL"),
+    ("SOCIAL_ENGINEERING", "ANY_PLATFORM", "URL"),
+]
+
+# Threat types as named by the lookup api
+VERDICTS = {
+    "MALWARE": "malware",
+    "SOCIAL_ENGINEERING": "phishing",
+}
+
+def url_expressions(url):
+    """
+    Return the host suffix / path prefix expressions of the url.
+    """
+
+    _, netloc, path, query, _ = urlsplit(canonicalize(url))
+    host = netloc.rsplit("@", 1)[-1].split(":", 1)[0]
+
+    # Exact host and up to four suffixes of the last five components
+    hosts = [host]
+    parts = host.split(".")
+    if not host.replace(".", "").isdigit():
+        for n in xrange(min(len(parts) - 1, 5), 1, -1):
+            suffix = ".".join(parts[-n:])
+            if suffix not in hosts:
+                hosts.append(suffix)
+
+    # Exact path with and without query and up to four path prefixes
+    paths = [path + "?" + query] if query else []
+    paths.append(path)
+    prefix = "/"
+    for comp in [None] + path.split("/")[1:-1][:3]:
+        if comp is not None:
+            prefix += comp + "/"
+        if prefix not in paths:
+            paths.append(prefix)
+
+    return [h + p for h in hosts for p in paths]
+
+def duration(text):
+    """
+    Return the seconds of a duration like "300.5s".
+    """
+
+    return float(text.rstrip("s"))
+
+def full_hash(expr):
+    """
+    Return the sha256 hash of the expression.
+    """
+
+    if isinstance(expr, unicode):
+        expr = expr.encode("utf-8")
+    return hashlib.sha256(expr).digest()
+
+def contains(arr, item):
+    """
+    Check if the sorted array contains the item.
+    """
+
+    idx = bisect.bisect_left(arr, item)
+    return idx < len(arr) and arr[idx] == item
+
+class PrefixList(object):
+    """
+    Sorted hash prefixes of one threat list.
+    """
+
+    def __init__(self, dbdir, name):
+        super(PrefixList, self).__init__()
+
+        self.base = os.path.join(dbdir, name)
+        self.state = ""
+        self.arrays = {}
+        self.load()
+
+    def load(self):
+        """
+        Map the prefix arrays saved on disk.
+        """
+
+        for arr in self.arrays.values():
+            arr.close()
+        self.state, self.arrays = "", {}
+
+        try:
+            with open(self.base + ".json") as fobj:
+                meta = json.load(fobj)
+        except IOError:
+            return
+
+        self.state = meta["state"]
+        for size in meta["sizes"]:
+            fname = "%s.%d" % (self.base, size)
+            self.arrays[size] = MappedArray(fname, "%ds" % size)
+
+    def __len__(self):
+        return sum(len(arr) for arr in self.arrays.values())
+
+    def prefixes(self):
+        """
+        Iterate over all the prefixes in sorted order.
+        """
+
+        return heapq.merge(*self.arrays.values())
+
+    def match(self, fhash):
+        """
+        Return the prefixes of the full hash in the list.
+        """
+
+        return [fhash[:size] for size, arr in self.arrays.iteritems()
+                if contains(arr, fhash[:size])]
+
+    def apply(self, update):
+        """
+        Apply a list update response.
+
+        Returns False if the checksum did not match; the list is then
+        cleared so that the next update is a full one.
+        """
+
+        if update["responseType"] == "FULL_UPDATE":
+            old = iter([])
+        else:
+            old = self.prefixes()
+
+        removals = set()
+        for removal in update.get("removals", []):
+            removals.update(removal["rawIndices"]["indices"])
+
+        additions = []
+        for addition in update.get("additions", []):
+            raw = addition["rawHashes"]
+            size = raw["prefixSize"]
+            data = base64.b64decode(raw["rawHashes"])
+            for i in xrange(0, len(data), size):
+                additions.append(data[i:i+size])
+        additions.sort()
+
+        # Indices of removals refer to the old sorted list
+        kept = (p for i, p in enumerate(old) if i not in removals)
+
+        sha, files = hashlib.sha256(), {}
+        for prefix in heapq.merge(kept, additions):
+            sha.update(prefix)
+            size = len(prefix)
+            if size not in files:
+                files[size] = open("%s.%d.tmp" % (self.base, size), "wb")
+            files[size].write(prefix)
+        for fobj in files.values():
+            fobj.close()
+
+        checksum = update.get("checksum", {}).get("sha256")
+        if checksum and base64.b64decode(checksum) != sha.digest():
+            log.notice(u"Checksum mismatch for {}; resetting list", self.base)
+            for size in files:
+                os.remove("%s.%d.tmp" % (self.base, size))
+            self.save("", [])
+            return False
+
+        for size in files:
+            os.rename("%s.%d.tmp" % (self.base, size),
+                      "%s.%d" % (self.base, size))
+        self.save(update["newClientState"], sorted(files))
+        return True
+
+    def save(self, state, sizes):
+        """
+        Save the list state and prefix sizes, then map the arrays again.
+        """
+
+        with open(self.base + ".json.tmp", "w") as fobj:
+            json.dump({"state": state, "sizes": sizes}, fobj)
+        os.rename(self.base + ".json.tmp", self.base + ".json")
+        self.load()
+
+class Database(object):
+    """
+    Local database of the threat lists.
+    """
+
+    def __init__(self, auth, dbdir, lists=None, endpoint=ENDPOINT):
+        super(Database, self).__init__()
+
+        if not os.path.exists(dbdir):
+            os.makedirs(dbdir)
+
+        self.auth = auth
+        self.endpoint = endpoint
+        self.lists = {}
+        for tl in LISTS if lists is None else lists:
+            self.lists[tuple(tl)] = PrefixList(dbdir, "_".join(tl))
+
+        self.next_update = 0
+
+        # Threat matches of (full hash, list), and prefixes with no
+        # other matches, as long as the server says they are valid
+        self.positive = TTLCache()
+        self.negative = TTLCache()
+
+    def call(self, method, body):
+        """
+        Call the api method.
+        """
+
+        url = self.endpoint + "/" + method
+        params = {"key": self.auth}
+        headers = {"Content-Type": "application/json"}
+        data = json.dumps(body)
+
+        retries = budget.current(urlsplit(url).netloc)
+        tries = 0
+        while tries < const.API_RETRY_MAX:
+            r = req.post(url, params=params, data=data, headers=headers,
+                         timeout=60.0)
+
+            if r.status_code == 200:
+                try:
+                    return r.json()
+                except ValueError:
+                    log.info(u"Try L1 {}: Falied to decode JSON - {}\n{}",
+                             tries, r.status_code, r.text)
+                    if not retries.can_retry():
+                        break
+                    tries += 1
+                    continue
+
+            # Server side error Retry
+            if 500 <= r.status_code < 600:
+                log.info(u"Try L1 {}: Server side error {} {}",
+                         tries, r.status_code, r.text)
+                time.sleep(const.API_RETRY_AFTER)
+                if not retries.can_retry():
+                    break
+                tries += 1
+                continue
+
+            # Some other error
+            break
+
+        raise GoogleSafeBrowsingError(r, tries)
+
+    def update(self):
+        """
+        Update all the lists.
+
+        Returns the number of seconds to wait before the next update.
+        Nothing is fetched till the wait asked by the server is over.
+        """
+
+        wait = self.next_update - time.time()
+        if wait > 0:
+            log.debug(u"Not updating for another {:.0f} secs", wait)
+            return wait
+
+        list_requests = []
+        for tl, plist in sorted(self.lists.iteritems()):
+            list_requests.append({
+                "threatType": tl[0],
+                "platformType": tl[1],
+                "threatEntryType": tl[2],
+                "state": plist.state,
+                "constraints": {"supportedCompressions": ["RAW"]},
+            })
+        body = {"client": {"clientId": CLIENT, "clientVersion": "0.1"},
+                "listUpdateRequests": list_requests}
+
+        resp = self.call("threatListUpdates:fetch", body)
+        for update in resp.get("listUpdateResponses", []):
+            tl = (update["threatType"], update["platformType"],
+                  update["threatEntryType"])
+            self.lists[tl].apply(update)
+            log.debug(u"Updated list {}; {} prefixes", tl, len(self.lists[tl]))
+
+        wait = duration(resp.get("minimumWaitDuration", "0s"))
+        self.next_update = time.time() + wait
+        return wait
+
+    def find_full_hashes(self, prefixes):
+        """
+        Return the (full hash, threat list) pairs matching the prefixes.
+
+        The matches and the prefixes are cached for the durations
+        given in the response.
+        """
+
+        tls = sorted(self.lists)
+        body = {
+            "client": {"clientId": CLIENT, "clientVersion": "0.1"},
+            "clientStates": [self.lists[tl].state for tl in tls],
+            "threatInfo": {
+                "threatTypes": sorted(set(tl[0] for tl in tls)),
+                "platformTypes": sorted(set(tl[1] for tl in tls)),
+                "threatEntryTypes": sorted(set(tl[2] for tl in tls)),
+                "threatEntries": [{"hash": base64.b64encode(p)}
+                                  for p in sorted(prefixes)],
+            },
+        }
+
+        resp = self.call("fullHashes:find", body)
+
+        ttl = duration(resp.get("negativeCacheDuration", "0s"))
+        for prefix in prefixes:
+            self.negative.put(prefix, True, ttl)
+
+        matches = set()
+        for match in resp.get("matches", []):
+            tl = (match["threatType"], match["platformType"],
+                  match["threatEntryType"])
+            key = (base64.b64decode(match["threat"]["hash"]), tl)
+            self.positive.put(key, True,
+                              duration(match.get("cacheDuration", "0s")))
+            matches.add(key)
+        return matches
+
+    def check(self, urls):
+        """
+        Check the urls; full hashes are fetched only on prefix hits
+        which are not cached.
+
+        Returns a dict mapping each url to the verdict
+        and the status code the lookup api would have returned.
+        """
+
+        hits, prefixes = {}, set()
+        for url in urls:
+            for expr in url_expressions(url):
+                fhash = full_hash(expr)
+                for tl, plist in self.lists.iteritems():
+                    matched = plist.match(fhash)
+                    if not matched:
+                        continue
+                    hits.setdefault(url, []).append((fhash, tl))
+                    if self.positive.get((fhash, tl)):
+                        continue
+                    if not any(self.negative.get(p) for p in matched):
+                        prefixes.update(matched)
+
+        ret = {url: "ok" for url in urls}
+        if not hits:
+            return ret, 204
+
+        matches = set()
+        if prefixes:
+            matches = self.find_full_hashes(prefixes)
+
+        status_code = 204
+        for url, url_hits in hits.iteritems():
+            threats = set(VERDICTS.get(tl[0], tl[0].lower())
+                          for fhash, tl in url_hits
+                          if (fhash, tl) in matches or
+                          self.positive.get((fhash, tl)))
+            if threats:
+                ret[url] = ",".join(sorted(threats))
+                status_code = 200
+        return ret, status_code
+
+    def lookup(self, urls, size=500):
+        """
+        Check the urls, size at a time.
+
+        Yields the response dict and status code of every batch,
+        like wriggler.gsb.lookup.
+        """
+
+        batch = []
+        for url in urls:
+            batch.append(url)
+            if len(batch) == size:
+                yield self.check(batch)
+                batch = []
+
+        if batch:
+            yield self.check(batch)
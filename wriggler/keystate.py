@@ -0,0 +1,455 @@
+"""
+Shared rate limit state for pools of api keys.
+
+The state maps a slot name (usually a key id) to the remaining number of
+calls and the time at which the rate limit window resets. A pool leases a
+slot before every call, which atomically reserves one call from the slot.
+The backends only differ in how far the state is shared:
+
+LocalKeyState  - threads of the current process
+SQLiteKeyState - processes on one host, via a file locked sqlite database
+RemoteKeyState - processes on many hosts, via a KeyStateServer
+"""
+
+from __future__ import division
+
+import os
+import json
+import time
+import hashlib
+import socket
+import sqlite3
+import threading
+import SocketServer
+
+import logbook
+
+from wriggler import Error
+import wriggler.const as const
+
+log = logbook.Logger(__name__)
+
+class KeyStateError(Error):
+    """
+    Raised when the shared key state can not be reached.
+    """
+
+def merge(row, remaining, reset):
+    """
+    Merge the observed remaining calls and reset time into the row.
+    """
+
+    old_remaining, old_reset = row
+
+    if reset is None:
+        reset = old_reset
+
+    # A new window or the first observation; trust the server.
+    # Otherwise calls leased by others may not be counted yet.
+    if old_remaining is None or reset > old_reset:
+        return [remaining, reset]
+    return [min(old_remaining, remaining), max(reset, old_reset)]
+
+def choose(rows, slots, now):
+    """
+    Choose the slot to lease.
+
+    Returns the chosen slot (or None) and the seconds to wait
+    before any slot becomes available.
+    """
+
+    best, best_remaining, wait = None, -1, None
+    for slot in slots:
+        remaining, reset = rows.get(slot, (None, 0))
+
+        # Window is over, so the remaining calls are unknown
+        if reset <= now:
+            remaining = None
+
+        if remaining is None:
+            return slot, 0
+
+        if remaining > best_remaining:
+            best, best_remaining = slot, remaining
+
+        if remaining <= 0:
+            w = reset - now
+            wait = w if wait is None else min(wait, w)
+
+    if best_remaining > 0:
+        return best, 0
+    return None, max(wait or 0, 1)
+
+def take(row, now):
+    """
+    Reserve one call from the leased row.
+    """
+
+    remaining, reset = row
+    if remaining is None or reset <= now:
+        return [None, reset]
+    return [remaining - 1, reset]
+
+def give(row):
+    """
+    Return a reserved call back to the row.
+    """
+
+    remaining, reset = row
+    if remaining is None:
+        return [None, reset]
+    return [remaining + 1, reset]
+
+class LocalKeyState(object):
+    """
+    Key state shared between threads of the current process.
+    """
+
+    def __init__(self):
+        super(LocalKeyState, self).__init__()
+
+        self.lock = threading.Lock()
+        self.rows = {}
+
+    def get(self, slot):
+        """
+        Return the remaining calls and reset time of the slot.
+        """
+
+        with self.lock:
+            return tuple(self.rows.get(slot, (None, 0)))
+
+    def update(self, slot, remaining, reset):
+        """
+        Record the rate limit observed for the slot.
+        """
+
+        with self.lock:
+            row = self.rows.get(slot, (None, 0))
+            self.rows[slot] = merge(row, remaining, reset)
+
+    def replace(self, slot, remaining, reset):
+        """
+        Overwrite the rate limit of the slot with an authoritative one.
+        """
+
+        with self.lock:
+            self.rows[slot] = [remaining, reset]
+
+    def lease(self, slots):
+        """
+        Lease one call from the best available slot.
+        """
+
+        now = int(time.time())
+        with self.lock:
+            slot, wait = choose(self.rows, slots, now)
+            if slot is not None:
+                self.rows[slot] = take(self.rows.get(slot, (None, 0)), now)
+            return slot, wait
+
+    def release(self, slot):
+        """
+        Give back a call leased from the slot but never made.
+        """
+
+        with self.lock:
+            if slot in self.rows:
+                self.rows[slot] = give(self.rows[slot])
+
+    def dump(self):
+        """
+        Return the rows whose window is not over yet.
+        """
+
+        now = int(time.time())
+        with self.lock:
+            return dict((slot, list(row))
+                        for slot, row in self.rows.iteritems()
+                        if row[1] > now)
+
+    def load(self, rows):
+        """
+        Merge rows returned by dump into the state.
+        """
+
+        with self.lock:
+            for slot, (remaining, reset) in rows.iteritems():
+                row = self.rows.get(slot, (None, 0))
+                self.rows[slot] = merge(row, remaining, reset)
+
+class SQLiteKeyState(object):
+    """
+    Key state shared between processes on a host.
+
+    Every lease runs in an immediate transaction,
+    so sqlite's file lock serializes the processes.
+    """
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS keystate ("
+              "slot TEXT PRIMARY KEY, remaining INTEGER, reset INTEGER)")
+
+    def __init__(self, fname, timeout=60.0):
+        super(SQLiteKeyState, self).__init__()
+
+        self.fname = fname
+        self.timeout = timeout
+        self.local = threading.local()
+
+        with self.transaction() as cur:
+            cur.execute(self.SCHEMA)
+
+    @property
+    def conn(self):
+        """
+        Connection for the current thread and process.
+        """
+
+        pid = os.getpid()
+        if getattr(self.local, "pid", None) != pid:
+            conn = sqlite3.connect(self.fname, timeout=self.timeout,
+                                   isolation_level=None)
+            # Readers do not block the writer, and commits skip most fsyncs
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = pid
+        return self.local.conn
+
+    def transaction(self):
+        """
+        Return a context manager wrapping an immediate transaction.
+        """
+
+        return _Transaction(self.conn)
+
+    def _rows(self, cur, slots):
+        rows = {}
+        for i in xrange(0, len(slots), 500):
+            part = slots[i:i+500]
+            sql = ("SELECT slot, remaining, reset FROM keystate "
+                   "WHERE slot IN (%s)" % ",".join("?" * len(part)))
+            for slot, remaining, reset in cur.execute(sql, part):
+                rows[slot] = [remaining, reset]
+        return rows
+
+    @staticmethod
+    def _save(cur, slot, row):
+        cur.execute("INSERT OR REPLACE INTO keystate VALUES (?, ?, ?)",
+                    (slot, row[0], row[1]))
+
+    def get(self, slot):
+        """
+        Return the remaining calls and reset time of the slot.
+        """
+
+        with self.transaction() as cur:
+            return tuple(self._rows(cur, [slot]).get(slot, (None, 0)))
+
+    def update(self, slot, remaining, reset):
+        """
+        Record the rate limit observed for the slot.
+        """
+
+        with self.transaction() as cur:
+            row = self._rows(cur, [slot]).get(slot, (None, 0))
+            self._save(cur, slot, merge(row, remaining, reset))
+
+    def replace(self, slot, remaining, reset):
+        """
+        Overwrite the rate limit of the slot with an authoritative one.
+        """
+
+        with self.transaction() as cur:
+            self._save(cur, slot, [remaining, reset])
+
+    def lease(self, slots):
+        """
+        Lease one call from the best available slot.
+        """
+
+        now = int(time.time())
+        with self.transaction() as cur:
+            rows = self._rows(cur, list(slots))
+            slot, wait = choose(rows, slots, now)
+            if slot is not None:
+                self._save(cur, slot, take(rows.get(slot, (None, 0)), now))
+            return slot, wait
+
+    def release(self, slot):
+        """
+        Give back a call leased from the slot but never made.
+        """
+
+        with self.transaction() as cur:
+            rows = self._rows(cur, [slot])
+            if slot in rows:
+                self._save(cur, slot, give(rows[slot]))
+
+class _Transaction(object):
+    """
+    Immediate sqlite transaction; takes the write lock on entry.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cur = None
+
+    def __enter__(self):
+        self.cur = self.conn.cursor()
+        self.cur.execute("BEGIN IMMEDIATE")
+        return self.cur
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.cur.execute("COMMIT")
+        else:
+            self.cur.execute("ROLLBACK")
+        self.cur.close()
+
+class _KeyStateHandler(SocketServer.StreamRequestHandler):
+    """
+    Serve newline delimited json requests on a connection.
+    """
+
+    def handle(self):
+        state = self.server.state
+        for line in iter(self.rfile.readline, ""):
+            req = json.loads(line)
+            op = req["op"]
+            if op == "get":
+                resp = state.get(req["slot"])
+            elif op == "update":
+                resp = state.update(req["slot"], req["remaining"],
+                                    req["reset"])
+            elif op == "replace":
+                resp = state.replace(req["slot"], req["remaining"],
+                                     req["reset"])
+            elif op == "lease":
+                resp = state.lease(req["slots"])
+            elif op == "release":
+                resp = state.release(req["slot"])
+            else:
+                resp = {"error": "Invalid op: %s" % op}
+            self.wfile.write(json.dumps(resp) + "\n")
+            self.wfile.flush()
+
+class KeyStateServer(SocketServer.ThreadingTCPServer):
+    """
+    Coordinator serving a key state to a cluster of crawlers.
+
+    The server is not authenticated; it listens on localhost unless
+    given another address, and only ever sees hashed slot names.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=None, state=None):
+        if address is None:
+            address = ("127.0.0.1", const.KEY_STATE_PORT)
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 _KeyStateHandler)
+
+        self.state = LocalKeyState() if state is None else state
+
+def hash_slot(slot):
+    """
+    Return the hash sent to the server in place of the slot.
+
+    Slots name the keys, which must not go over the network.
+    """
+
+    return hashlib.sha1(slot.encode("utf-8")).hexdigest()
+
+class RemoteKeyState(object):
+    """
+    Key state kept by a KeyStateServer.
+    """
+
+    def __init__(self, address=None, timeout=60.0):
+        super(RemoteKeyState, self).__init__()
+
+        if address is None:
+            address = ("127.0.0.1", const.KEY_STATE_PORT)
+        self.address = tuple(address)
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        self.local.sock = sock
+        self.local.rfile = sock.makefile("rb")
+        self.local.pid = os.getpid()
+
+    def _close(self):
+        try:
+            self.local.rfile.close()
+            self.local.sock.close()
+        except (AttributeError, socket.error):
+            pass
+        self.local.pid = None
+
+    def call(self, op, **args):
+        """
+        Make the request to the server and return the response.
+        """
+
+        args["op"] = op
+        msg = json.dumps(args) + "\n"
+
+        for tries in xrange(const.CONNECT_RETRY_MAX):
+            try:
+                if getattr(self.local, "pid", None) != os.getpid():
+                    self._connect()
+                self.local.sock.sendall(msg)
+                line = self.local.rfile.readline()
+                if not line:
+                    raise socket.error("Connection closed by server")
+                return json.loads(line)
+            except socket.error:
+                msg_ = u"Try L0: {} - Key state server {} failed"
+                log.info(msg_, tries, self.address, exc_info=True)
+                self._close()
+                time.sleep(const.CONNECT_RETRY_AFTER)
+
+        raise KeyStateError(self.address, op)
+
+    def get(self, slot):
+        """
+        Return the remaining calls and reset time of the slot.
+        """
+
+        return tuple(self.call("get", slot=hash_slot(slot)))
+
+    def update(self, slot, remaining, reset):
+        """
+        Record the rate limit observed for the slot.
+        """
+
+        self.call("update", slot=hash_slot(slot), remaining=remaining,
+                  reset=reset)
+
+    def replace(self, slot, remaining, reset):
+        """
+        Overwrite the rate limit of the slot with an authoritative one.
+        """
+
+        self.call("replace", slot=hash_slot(slot), remaining=remaining,
+                  reset=reset)
+
+    def lease(self, slots):
+        """
+        Lease one call from the best available slot.
+        """
+
+        hashes = dict((hash_slot(slot), slot) for slot in slots)
+        slot, wait = self.call("lease", slots=list(hashes))
+        return hashes.get(slot), wait
+
+    def release(self, slot):
+        """
+        Give back a call leased from the slot but never made.
+        """
+
+        self.call("release", slot=hash_slot(slot))
@@ -0,0 +1,121 @@
+"""
+Read only arrays of fixed size records in memory mapped files.
+
+Records are unpacked from the mapping on access, so large arrays can be
+searched (with bisect) or sliced without reading them into memory. Views
+of a range of records unpack them on access too, without copying.
+"""
+
+import os
+import mmap
+import struct
+
+class MappedArray(object):
+    """
+    Array of records, each packed with the struct format fmt.
+    """
+
+    def __init__(self, fname, fmt):
+        super(MappedArray, self).__init__()
+
+        self.fname = fname
+        self.struct = struct.Struct(fmt)
+        self.itemsize = self.struct.size
+
+        self.fobj = open(fname, "rb")
+        size = os.fstat(self.fobj.fileno()).st_size
+
+        # Empty files can not be mapped
+        if size:
+            self.mm = mmap.mmap(self.fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mm = ""
+        self.length = size // self.itemsize
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(self.length))]
+
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
+            raise IndexError("MappedArray index out of range")
+
+        return self.struct.unpack_from(self.mm, idx * self.itemsize)[0]
+
+    def __iter__(self):
+        unpack_from = self.struct.unpack_from
+        for offset in xrange(0, self.length * self.itemsize, self.itemsize):
+            yield unpack_from(self.mm, offset)[0]
+
+    def view(self, start, stop):
+        """
+        Return a view of the records from start to stop.
+        """
+
+        start, stop, _ = slice(start, stop).indices(self.length)
+        return MappedView(self, start, stop)
+
+    def close(self):
+        """
+        Unmap and close the file.
+        """
+
+        if self.mm:
+            self.mm.close()
+        self.fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+class MappedView(object):
+    """
+    Range of records of a MappedArray; valid till the array is closed.
+    """
+
+    def __init__(self, arr, start, stop):
+        super(MappedView, self).__init__()
+
+        self.arr = arr
+        self.start = start
+        self.length = max(stop - start, 0)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(self.length))]
+
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
+            raise IndexError("MappedView index out of range")
+
+        return self.arr[self.start + idx]
+
+    def __iter__(self):
+        arr = self.arr
+        unpack_from, itemsize = arr.struct.unpack_from, arr.itemsize
+        begin = self.start * itemsize
+        for offset in xrange(begin, begin + self.length * itemsize, itemsize):
+            yield unpack_from(arr.mm, offset)[0]
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __repr__(self):
+        return "MappedView(%r)" % list(self)
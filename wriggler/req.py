@@ -4,15 +4,26 @@ A simple and robust way for making http requests.
 This library wraps python-requests. The errors handled by this module are
 connection requests and server side errors. The error handling strategy
 is quite simple. Wait for fixed number of seconds on error and then retry.
+
+Failures are tracked per host by a circuit breaker. After CIRCUIT_FAIL_MAX
+consecutive failures the circuit of the host opens, and requests to it
+fail at once with CircuitOpenError. After CIRCUIT_RESET_AFTER seconds a
+few probe requests are let through; the circuit closes if they succeed
+and opens again if any fails. If retry budgets are enabled, retries are
+drawn from the budget of the host (or of the job); see wriggler.budget.
 """
 
+import time
+import threading
 from time import sleep
+from urlparse import urlparse
 
 import requests
 import logbook
 
 from wriggler import Error
 import wriggler.const as const
+import wriggler.budget as budget
 
 log = logbook.Logger(__name__)
 
@@ -21,6 +32,98 @@ class ConnectFailError(Error):
     Raised on error cases.
     """
 
+class RequestTimeoutError(ConnectFailError):
+    """
+    Raised on a timeout, when the caller handles them.
+    """
+
+class CircuitOpenError(ConnectFailError):
+    """
+    Raised when the circuit of the host is open.
+    """
+
+class CircuitBreaker(object):
+    """
+    Circuit breakers of the hosts, safe to share between threads.
+    """
+
+    def __init__(self, fail_max=None, reset_after=None, probes=None):
+        super(CircuitBreaker, self).__init__()
+
+        self.fail_max = fail_max or const.CIRCUIT_FAIL_MAX
+        self.reset_after = reset_after or const.CIRCUIT_RESET_AFTER
+        self.probes = probes or const.CIRCUIT_PROBES
+
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def circuit(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = {"state": "closed", "failures": 0,
+                                "opened": 0, "probes": 0, "successes": 0}
+        return self.hosts[host]
+
+    def state(self, host):
+        """
+        Return the state of the host; closed, open or half-open.
+        """
+
+        with self.lock:
+            return self.circuit(host)["state"]
+
+    def allow(self, host):
+        """
+        Raise CircuitOpenError unless a request to the host may be made.
+        """
+
+        with self.lock:
+            circuit = self.circuit(host)
+            if circuit["state"] == "closed":
+                return
+
+            if circuit["state"] == "open":
+                if time.time() - circuit["opened"] < self.reset_after:
+                    raise CircuitOpenError(host)
+                log.info(u"Circuit of {} half open", host)
+                circuit["state"] = "half-open"
+                circuit["probes"], circuit["successes"] = 0, 0
+
+            if circuit["probes"] >= self.probes:
+                raise CircuitOpenError(host)
+            circuit["probes"] += 1
+
+    def success(self, host):
+        """
+        Record a successful request to the host.
+        """
+
+        with self.lock:
+            circuit = self.circuit(host)
+            circuit["failures"] = 0
+            if circuit["state"] == "half-open":
+                circuit["successes"] += 1
+                if circuit["successes"] >= self.probes:
+                    log.info(u"Circuit of {} closed", host)
+                    circuit["state"] = "closed"
+
+    def failure(self, host):
+        """
+        Record a failed request to the host.
+        """
+
+        with self.lock:
+            circuit = self.circuit(host)
+            circuit["failures"] += 1
+            if (circuit["state"] == "half-open" or
+                    circuit["failures"] >= self.fail_max):
+                if circuit["state"] != "open":
+                    log.notice(u"Circuit of {} open", host)
+                circuit["state"] = "open"
+                circuit["opened"] = time.time()
+
+# Shared by all the requests of the process
+breaker = CircuitBreaker()
+
 def robust_http(url, method, args, kwargs):
     """
     Repeat the HTTP GET/POST operatopn in case of failure.
@@ -30,23 +133,51 @@ def robust_http(url, method, args, kwargs):
 
     # Get the function to be called
     session = kwargs.pop("session", None)
+    retry_timeouts = kwargs.pop("retry_timeouts", True)
     if session is None:
         to_call = getattr(requests, method)
     else:
         to_call = getattr(session, method)
 
+    host = urlparse(url).netloc
+
     # Keep trying for downlod
     for tries in xrange(const.CONNECT_RETRY_MAX):
+        if tries > 0:
+            if not budget.current(host).can_retry():
+                log.notice(u"Retry budget exhausted - {} {}",
+                           method.upper(), url)
+                break
+            sleep(const.CONNECT_RETRY_AFTER)
+
+        breaker.allow(host)
         try:
-            return to_call(url, *args, **kwargs)
+            r = to_call(url, *args, **kwargs)
+        except requests.Timeout:
+            msg = u"Try L0: {} - {} Request Timed Out\n{}\n"
+            log.info(msg, tries, method.upper(), url)
+            breaker.failure(host)
+            if not retry_timeouts:
+                raise RequestTimeoutError(url, method)
+            continue
         except requests.RequestException:
             msg = u"Try L0: {} - {} Request Failed\n{}\n"
             log.info(msg, tries, method.upper(), url, exc_info=True)
-            sleep(const.CONNECT_RETRY_AFTER)
+            breaker.failure(host)
+            continue
         except Exception: # pylint: disable=broad-except
             msg = u"Try L0: {} - {} Request Failed\n{}\n"
             log.warn(msg, tries, method.upper(), url, exc_info=True)
-            sleep(const.CONNECT_RETRY_AFTER)
+            breaker.failure(host)
+            continue
+
+        # Server errors are retried by the callers
+        if r.status_code >= 500:
+            breaker.failure(host)
+        else:
+            breaker.success(host)
+            budget.current(host).success()
+        return r
 
     # Cant help any more; Quit program
     raise ConnectFailError(url, method)
@@ -64,4 +195,3 @@ def post(url, *args, **kwargs):
     """
 
     return robust_http(url, "post", args, kwargs)
-
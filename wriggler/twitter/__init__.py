@@ -2,6 +2,9 @@
 Common twitter specific functions.
 """
 
+# Twitter's snowflake epoch in milliseconds
+TWEPOCH = 1288834974657
+
 def list_to_csv(args):
     """
     Convert a list to a string csv.
@@ -10,3 +13,36 @@ def list_to_csv(args):
     args = map(str, args)
     args = ",".join(args)
     return args
+
+def boxes_to_csv(boxes):
+    """
+    Convert a list of bounding boxes to a string csv.
+
+    Boxes are (sw_lon, sw_lat, ne_lon, ne_lat); a flat list
+    of coordinates is also accepted.
+    """
+
+    coords = []
+    for box in boxes:
+        if isinstance(box, (list, tuple)):
+            coords.extend(box)
+        else:
+            coords.append(box)
+
+    if len(coords) % 4:
+        raise ValueError("Bounding boxes need four coordinates each")
+    return list_to_csv(coords)
+
+def snowflake_time(sid):
+    """
+    Return the unix time (in seconds) encoded in the snowflake id.
+    """
+
+    return ((sid >> 22) + TWEPOCH) / 1000.0
+
+def time_snowflake(ts):
+    """
+    Return the smallest snowflake id generated at the unix time ts.
+    """
+
+    return max(int(ts * 1000) - TWEPOCH, 0) << 22
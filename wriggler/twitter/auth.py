@@ -2,86 +2,567 @@
 Defines the multi auth object for multiple key management.
 """
 
+import os
 import sys
 import time
 import json
+import atexit
+import threading
+from urllib import quote
+from urlparse import urlparse
 
 import logbook
 import requests
 from requests_oauthlib import OAuth1
 
+from wriggler import Error
 import wriggler.const as const
-from wriggler.check_rate_limit import check_rate_limit
+import wriggler.req as req
+import wriggler.workers as workers
+import wriggler.twitter.error_codes as ec
+from wriggler.keystate import LocalKeyState
+from wriggler.check_rate_limit import (check_rate_limit, get_remaining,
+                                       get_reset_time, has_rate_limit)
 
 log = logbook.Logger(__name__)
 
+BEARER_TOKEN_ENDPOINT = "https://api.twitter.com/oauth2/token"
+RATE_LIMIT_ENDPOINT = ("https://api.twitter.com/1.1/"
+                       "application/rate_limit_status.json")
+
+# Resources which can also be called with application only auth.
+# These have a rate limit bucket separate from the user context ones.
+APP_AUTH_RESOURCES = set([
+    "/application/rate_limit_status",
+    "/favorites/list",
+    "/followers/ids",
+    "/friends/ids",
+    "/lists/members",
+    "/lists/memberships",
+    "/lists/show",
+    "/search/tweets",
+    "/statuses/lookup",
+    "/statuses/retweeters/ids",
+    "/statuses/retweets/:id",
+    "/statuses/show/:id",
+    "/statuses/user_timeline",
+    "/trends/available",
+    "/trends/place",
+    "/users/lookup",
+    "/users/show/:id",
+])
+
+# Resources named with an :id by the api, though the id is a parameter
+RESOURCE_ALIASES = {
+    "/statuses/show": "/statuses/show/:id",
+    "/users/show": "/users/show/:id",
+}
+
+def key_id(key):
+    """
+    Return the id used to share the state of the key.
+    """
+
+    return key.get("resource_owner_key") or key["client_key"]
+
+def resource_name(endpoint):
+    """
+    Return the rate limit resource name of the endpoint url.
+    """
+
+    path = urlparse(endpoint).path
+    if path.startswith("/1.1/"):
+        path = path[4:]
+    if path.endswith(".json"):
+        path = path[:-5]
+
+    parts = [":id" if part.isdigit() else part for part in path.split("/")]
+    path = "/".join(parts)
+    return RESOURCE_ALIASES.get(path, path)
+
+class BearerAuth(requests.auth.AuthBase):
+    """
+    Application only auth using a bearer token.
+    """
+
+    def __init__(self, bearer_token):
+        super(BearerAuth, self).__init__()
+
+        self.bearer_token = bearer_token
+
+    def __call__(self, r):
+        r.headers["Authorization"] = "Bearer " + self.bearer_token
+        return r
+
+def get_bearer_token(key, session=None):
+    """
+    Get the bearer token for the consumer key of the given key.
+
+    Returns None if Twitter refuses to issue one.
+    """
+
+    auth = (quote(key["client_key"]), quote(key["client_secret"]))
+    data = {"grant_type": "client_credentials"}
+    r = req.post(BEARER_TOKEN_ENDPOINT, data=data, auth=auth,
+                 session=session, timeout=60.0)
+
+    try:
+        body = r.json()
+        if r.status_code == 200 and body["token_type"] == "bearer":
+            return body["access_token"]
+    except (ValueError, KeyError, TypeError):
+        pass
+
+    log.notice(u"Failed to get bearer token - {}\n{}", r.status_code, r.text)
+    return None
+
 class MultiAuth(object):
     """
     Manage multiple twitter keys.
+
+    Every key gives a user auth context. With app_auth, every distinct
+    consumer key also gives an application only auth context, using a
+    bearer token derived on first use. Calls are scheduled over the
+    contexts per rate limit resource.
+
+    The reset and remaining data of the contexts are kept in state,
+    which may be shared with other threads, processes or hosts.
+    See wriggler.keystate for the available backends.
+
+    Contexts that keep failing are quarantined for longer and longer,
+    and ones with invalid credentials are dropped for good.
     """
 
-    def __init__(self, keys):
+    def __init__(self, keys, state=None, app_auth=False):
         super(MultiAuth, self).__init__()
 
-        now = int(time.time())
-
         self.idx = 0
         self.keys = keys
-        self.reset = [now] * len(keys)
+        self.resource = None
+
+        # Auth contexts as (kind, index of key) and their ids
+        self.contexts = [("user", i) for i in xrange(len(keys))]
+        self.ctx_ids = [key_id(key) for key in keys]
+        if app_auth:
+            seen = set()
+            for i, key in enumerate(keys):
+                if key["client_key"] not in seen:
+                    seen.add(key["client_key"])
+                    self.contexts.append(("app", i))
+                    self.ctx_ids.append("app:" + key["client_key"])
+
+        self.bearer = {}
+        self.state = LocalKeyState() if state is None else state
+
+        self.live = range(len(self.contexts))
+        self.health = [{"status": "ok", "failures": 0, "until": 0,
+                        "strikes": 0, "last_error": None}
+                       for _ in self.contexts]
 
         self.session = requests.Session()
 
+    def clone(self):
+        """
+        Return a MultiAuth over the same contexts sharing their state.
+
+        Clones can be used by different threads at the same time.
+        """
+
+        other = MultiAuth(self.keys, self.state)
+        other.contexts = self.contexts
+        other.ctx_ids = self.ctx_ids
+        other.bearer = self.bearer
+        other.live = self.live
+        other.health = self.health
+        return other
+
+    def clones(self, n):
+        """
+        Return n clones, one for every thread of workers.imap.
+
+        Each thread needs its own current context, while the rate
+        limits and health of the keys are shared by all of them.
+        """
+
+        return [self.clone() for _ in xrange(n)]
+
+    def drop(self, idx):
+        """
+        Remove the context from rotation.
+        """
+
+        self.health[idx]["status"] = "dead"
+        try:
+            self.live.remove(idx)
+        except ValueError:
+            pass
+
     @property
     def token(self):
-        return self.keys[self.idx]
+        return self.keys[self.contexts[self.idx][1]]
 
     @property
     def oauth(self):
-        return OAuth1(signature_type="auth_header", **self.keys[self.idx])
+        return self.context_auth(self.idx)
+
+    def context_auth(self, idx):
+        """
+        Return the requests auth of the context.
+        """
+
+        kind, kidx = self.contexts[idx]
+        if kind == "app":
+            return BearerAuth(self.bearer[self.keys[kidx]["client_key"]])
+        return OAuth1(signature_type="auth_header", **self.keys[kidx])
+
+    def slot(self, idx, resource):
+        """
+        Return the key state slot of the context for the resource.
+        """
+
+        if resource is None:
+            return self.ctx_ids[idx]
+        return self.ctx_ids[idx] + ":" + resource
+
+    def capacity(self, resource=None):
+        """
+        Return the number of live contexts usable for the resource.
+        """
+
+        app_ok = resource in APP_AUTH_RESOURCES
+        return sum(1 for i in self.live
+                   if app_ok or self.contexts[i][0] == "user")
+
+    def bearer_token(self, idx):
+        """
+        Return the bearer token of the app context; drop it on failure.
+        """
+
+        client_key = self.keys[self.contexts[idx][1]]["client_key"]
+        if client_key not in self.bearer:
+            token = get_bearer_token(self.keys[self.contexts[idx][1]],
+                                     self.session)
+            if token is None:
+                self.drop(idx)
+                return None
+            self.bearer[client_key] = token
+
+        return self.bearer[client_key]
+
+    def acquire(self, resource=None):
+        """
+        Lease a call to the resource from the next available context.
+
+        If all the contexts are under rate limit,
+        sleep off the shortest rate limit window.
+        """
+
+        while True:
+            app_ok = resource in APP_AUTH_RESOURCES
+            ctxs = [i for i in self.live
+                    if app_ok or self.contexts[i][0] == "user"]
+            if not ctxs:
+                raise Error("No usable keys left")
+
+            now = int(time.time())
+            ready = [i for i in ctxs if self.health[i]["until"] <= now]
+            if not ready:
+                wait = min(self.health[i]["until"] for i in ctxs) - now
+                log.debug("All keys quarantined, sleeping {} secs ...", wait)
+                time.sleep(wait)
+                continue
+
+            slots = [self.slot(i, resource) for i in ready]
+            slot, wait = self.state.lease(slots)
+            if slot is None:
+                log.debug("All keys in rate limit, sleeping {} secs ...",
+                          wait)
+                time.sleep(wait)
+                continue
+
+            idx = ready[slots.index(slot)]
+            if self.contexts[idx][0] == "app" and not self.bearer_token(idx):
+                self.state.release(slot)
+                continue
+
+            self.idx, self.resource = idx, resource
+            return
+
+    def release(self):
+        """
+        Give back the call leased on the current context.
+        """
+
+        self.state.release(self.slot(self.idx, self.resource))
 
     def check_limit(self, headers):
         """
-        Check if rate limit is hit for the current key.
+        Record the rate limit of the current context from the headers.
+
+        Returns False, recording nothing, if the headers do not carry
+        the rate limit.
         """
 
+        if not has_rate_limit(headers):
+            return False
+
         now = int(time.time())
+        slot = self.slot(self.idx, self.resource)
         sleep_time = check_rate_limit(headers)
 
         if sleep_time:
             log.debug("Key {} hit rate limit ...", self.idx)
+            self.state.update(slot, 0, now + sleep_time)
+        else:
+            self.state.update(slot, get_remaining(headers),
+                              get_reset_time(headers))
+        return True
 
-            # Save the reset time
-            self.reset[self.idx] = now + sleep_time
+    def key_ok(self):
+        """
+        Record a successful call on the current context.
+        """
 
-            # Move on to the next key
-            self.idx = (self.idx + 1) % len(self.keys)
+        health = self.health[self.idx]
+        health["strikes"] = 0
+        if health["status"] == "ok":
+            health["failures"] = 0
 
-            # If the next key is also under ratelimit,
-            # sleep off the rate limit window
-            if self.reset[self.idx] > now:
-                log.debug("Key {} still in rate limit ...", self.idx)
-                time.sleep(self.reset[self.idx] - now)
+    def strike_key(self, error_code):
+        """
+        Record a failure which may not be the fault of the current context.
 
-    def skip_key(self):
+        Timeouts and 401s without an error code can also come from the
+        network or the request; the context is only skipped after
+        KEY_STRIKES_MAX of them in a row. Returns True if it was skipped.
         """
-        Skip the current key.
+
+        health = self.health[self.idx]
+        health["strikes"] = health.get("strikes", 0) + 1
+        health["last_error"] = error_code
+        if health["strikes"] < const.KEY_STRIKES_MAX:
+            return False
+
+        health["strikes"] = 0
+        self.skip_key(error_code)
+        return True
+
+    def skip_key(self, error_code=0):
         """
+        Skip the current context.
 
-        log.debug("Skipping key {} ...", self.idx)
+        The context is quarantined for API_RETRY_AFTER seconds, doubled
+        for every consecutive failure up to KEY_QUARANTINE_MAX. Contexts
+        failing with one of DEAD_KEY_CODES are removed from rotation,
+        except app contexts which only drop their bearer token.
+        """
+
+        health = self.health[self.idx]
+        kind, kidx = self.contexts[self.idx]
+
+        health["failures"] += 1
+        health["last_error"] = error_code
+
+        if error_code in ec.DEAD_KEY_CODES:
+            if kind == "app":
+                self.bearer.pop(self.keys[kidx]["client_key"], None)
+            else:
+                log.notice("Dropping key {}; error code {} ...",
+                           self.idx, error_code)
+                self.drop(self.idx)
+                return
 
         now = int(time.time())
+        quarantine = const.API_RETRY_AFTER * 2 ** (health["failures"] - 1)
+        quarantine = min(quarantine, const.KEY_QUARANTINE_MAX)
+
+        log.debug("Skipping key {} for {} secs ...", self.idx, quarantine)
 
-        # Save the reset time
-        self.reset[self.idx] = now + const.API_RETRY_AFTER
+        # Kept out of the rate limit state, which is shared
+        # and only follows what the api reports
+        health["until"] = now + quarantine
 
-        # Move on to the next key
-        self.idx = (self.idx + 1) % len(self.keys)
+    def sync_limits(self, nthreads=4):
+        """
+        Fill the state of every context from application/rate_limit_status.
+
+        The contexts are queried concurrently. The limits returned replace
+        the state, instead of being merged into it, so a state which
+        drifted below the real limits is corrected. Returns the number
+        of contexts whose limits were synced.
+        """
+
+        auths = self.clones(nthreads)
+        results = workers.imap(get_rate_limits, list(self.live), auths,
+                               ordered=False)
+
+        nsynced = 0
+        for idx, limits in results:
+            if limits is None:
+                continue
+            for resource, limit in limits.iteritems():
+                self.state.replace(self.slot(idx, resource),
+                                   limit["remaining"], limit["reset"])
+            nsynced += 1
 
-        # If the next key is under ratelimit,
-        # sleep off the rate limit window
-        if self.reset[self.idx] > now:
-            log.debug("Key {} still in rate limit ...", self.idx)
-            time.sleep(self.reset[self.idx] - now)
+        log.info("Synced rate limits of {} of {} contexts",
+                 nsynced, len(self.contexts))
+        return nsynced
+
+    def resync(self, interval, nthreads=4):
+        """
+        Sync the limits every interval seconds, in a background thread.
+
+        Returns an event which stops the thread when set.
+        """
+
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.sync_limits(nthreads)
+                except Exception: # pylint: disable=broad-except
+                    log.warn(u"Rate limit sync failed", exc_info=True)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return stop
+
+    def snapshot(self):
+        """
+        Return the scheduling state of the contexts.
+
+        Rate limit rows are included if the state backend supports it;
+        the shared backends keep their own state.
+        """
+
+        snap = {"idx": self.idx, "health": {}, "state": {}}
+        for ctx_id, health in zip(self.ctx_ids, self.health):
+            snap["health"][ctx_id] = dict(health)
+        if hasattr(self.state, "dump"):
+            snap["state"] = self.state.dump()
+        return snap
+
+    def restore(self, snap):
+        """
+        Restore the scheduling state from a snapshot.
+
+        Contexts are matched by id, so keys added or removed
+        since the snapshot are fine.
+        """
+
+        for idx, ctx_id in enumerate(self.ctx_ids):
+            if ctx_id in snap["health"]:
+                self.health[idx].update(snap["health"][ctx_id])
+                if self.health[idx]["status"] == "dead":
+                    self.drop(idx)
+
+        if snap["idx"] < len(self.contexts):
+            self.idx = snap["idx"]
+        if hasattr(self.state, "load"):
+            self.state.load(snap["state"])
+
+    def save_state(self, fname):
+        """
+        Save the snapshot to the file, atomically.
+        """
+
+        tmp_fname = fname + ".tmp"
+        with open(tmp_fname, "w") as fobj:
+            json.dump(self.snapshot(), fobj)
+        os.rename(tmp_fname, fname)
+
+    def load_state(self, fname):
+        """
+        Restore the snapshot saved in the file, if any.
+
+        Returns True if the state was restored.
+        """
+
+        if not os.path.exists(fname):
+            return False
+
+        try:
+            with open(fname) as fobj:
+                self.restore(json.load(fobj))
+        except (ValueError, KeyError, TypeError):
+            log.notice(u"Ignoring bad key state file {}", fname)
+            return False
+
+        log.debug("Restored key state from {} ...", fname)
+        return True
+
+    def persist(self, fname, interval=const.KEY_STATE_SAVE_EVERY):
+        """
+        Save the state every interval seconds and at exit.
+
+        Returns an event which stops the periodic saves when set.
+        """
+
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.save_state(fname)
+                except (IOError, OSError):
+                    log.warn(u"Saving key state failed", exc_info=True)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+        atexit.register(self.save_state, fname)
+        return stop
+
+    def health_report(self):
+        """
+        Return the health of every context.
+        """
+
+        now = int(time.time())
+        report = []
+        for ctx, ctx_id, health in zip(self.contexts, self.ctx_ids,
+                                       self.health):
+            status = health["status"]
+            if status == "ok" and health["until"] > now:
+                status = "quarantined"
+            report.append({
+                "key": ctx_id,
+                "context": ctx[0],
+                "status": status,
+                "failures": health["failures"],
+                "until": health["until"],
+                "last_error": health["last_error"],
+            })
+        return report
+
+def get_rate_limits(auth, idx):
+    """
+    Get the rate limits of the context from application/rate_limit_status.
+
+    Returns idx and a dict of resource to limit, remaining and reset;
+    the limits are None if the call failed.
+    """
+
+    if auth.contexts[idx][0] == "app" and not auth.bearer_token(idx):
+        return idx, None
+
+    try:
+        r = req.get(RATE_LIMIT_ENDPOINT, auth=auth.context_auth(idx),
+                    session=auth.session, timeout=60.0)
+        resources = r.json()["resources"]
+    except (req.ConnectFailError, ValueError, KeyError, TypeError):
+        log.notice(u"Failed to get rate limits of context {}", idx,
+                   exc_info=True)
+        return idx, None
+
+    limits = {}
+    for family in resources.itervalues():
+        limits.update(family)
+    return idx, limits
 
 def chunks(l, n):
     """
@@ -91,20 +572,49 @@ def chunks(l, n):
     for i in xrange(0, len(l), n):
         yield l[i:i+n]
 
-def read_keys(fname):
+def ichunks(iterable, n):
+    """
+    Yield successive n-sized lists from any iterable.
+    """
+
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+def read_keys(fname, state=None, app_auth=False, warm=False,
+              state_fname=None):
     """
     Read multiple keys from file.
+
+    With warm, the rate limits of the keys are synced before returning.
+    With state_fname, the state saved there is restored, and then
+    saved back periodically and at exit.
     """
 
     log.debug("Reading keys from {} ...", fname)
     with open(fname) as fobj:
         keys = json.load(fobj)
 
-    return MultiAuth(keys)
+    auth = MultiAuth(keys, state, app_auth)
+    if state_fname is not None:
+        auth.load_state(state_fname)
+        auth.persist(state_fname)
+    if warm:
+        auth.sync_limits()
+    return auth
 
-def read_keys_split(fname, size=sys.maxsize):
+def read_keys_split(fname, size=sys.maxsize, state=None, app_auth=False,
+                    warm=False, state_fname=None):
     """
     Read multiple keys from file split into size blocks.
+
+    The state of block i is persisted to state_fname.i
     """
 
     log.debug("Reading keys from {} ...", fname)
@@ -112,6 +622,13 @@ def read_keys_split(fname, size=sys.maxsize):
         keys = json.load(fobj)
 
     ks = list(chunks(keys, size))
-    auths = [MultiAuth(k) for k in ks]
+    auths = [MultiAuth(k, state, app_auth) for k in ks]
+    for i, auth in enumerate(auths):
+        if state_fname is not None:
+            block_fname = "%s.%d" % (state_fname, i)
+            auth.load_state(block_fname)
+            auth.persist(block_fname)
+        if warm:
+            auth.sync_limits()
 
     return auths
@@ -0,0 +1,115 @@
+"""
+Retweet cascade reconstruction.
+
+For every seed tweet, the retweeters are paged with
+statuses_retweeters_ids, the most recent 100 retweets (with their ids,
+and so their times) are taken from statuses_retweets_id, and optionally
+the retweeter profiles are looked up in batches of 100. Seeds are crawled
+concurrently with clones of one MultiAuth.
+
+Cascades are written as a tab separated edge list:
+
+    seed_id  retweeter_id  retweet_id  retweet_time
+
+where retweet_id and retweet_time are "-" if unknown.
+"""
+
+import sys
+import json
+
+import logbook
+
+import wriggler.workers as workers
+import wriggler.twitter.rest as rest
+from wriggler.twitter import snowflake_time
+from wriggler.twitter.auth import ichunks
+
+log = logbook.Logger(__name__)
+
+def get_cascade(auth, seed, profiles=False):
+    """
+    Get the cascade of the seed tweet.
+
+    Returns the seed, the (retweeter_id, retweet_id) edges
+    and the retweeter profiles if asked for.
+    """
+
+    retweeters = []
+    params = {"id": seed, "maxitems": sys.maxsize}
+    for data, meta in rest.statuses_retweeters_ids(auth, **params):
+        if meta["code"] != 200:
+            break
+        retweeters.extend(data["ids"])
+
+    retweets = {}
+    data, meta = rest.statuses_retweets_id(auth, id=seed)
+    if meta["code"] == 200:
+        for retweet in data:
+            retweets[retweet["user"]["id"]] = retweet["id"]
+
+    # Recent retweeters may not be in the ids yet
+    known = set(retweeters)
+    retweeters.extend(uid for uid in retweets if uid not in known)
+
+    users = []
+    if profiles:
+        for chunk in ichunks(retweeters, 100):
+            data, meta = rest.users_lookup(auth, user_id=chunk)
+            if meta["code"] == 200:
+                users.extend(data)
+
+    edges = [(uid, retweets.get(uid)) for uid in retweeters]
+    return seed, edges, users
+
+def format_edge(seed, retweeter_id, retweet_id):
+    """
+    Format the edge as a line of the edge list.
+    """
+
+    if retweet_id is None:
+        return "%d\t%d\t-\t-\n" % (seed, retweeter_id)
+
+    rt_time = snowflake_time(retweet_id)
+    return "%d\t%d\t%d\t%.3f\n" % (seed, retweeter_id, retweet_id, rt_time)
+
+def crawl_cascades(auth, seeds, edges_fname, profiles_fname=None,
+                   nthreads=4):
+    """
+    Crawl the cascades of the seed tweets.
+
+    auth           - MultiAuth
+    seeds          - Iterable of seed tweet ids
+    edges_fname    - Edge list output file
+    profiles_fname - If given, retweeter profiles are written here,
+                     one json per line, each user once
+
+    Returns the number of cascades and edges written.
+    """
+
+    profiles = profiles_fname is not None
+    func = lambda ath, seed: get_cascade(ath, seed, profiles)
+    auths = auth.clones(nthreads)
+
+    seen_users = set()
+    ncascades, nedges = 0, 0
+    with open(edges_fname, "w") as efobj:
+        pfobj = open(profiles_fname, "w") if profiles else None
+        try:
+            results = workers.imap(func, seeds, auths, ordered=False)
+            for seed, edges, users in results:
+                for retweeter_id, retweet_id in edges:
+                    efobj.write(format_edge(seed, retweeter_id, retweet_id))
+
+                for user in users:
+                    if user["id"] not in seen_users:
+                        seen_users.add(user["id"])
+                        pfobj.write(json.dumps(user) + "\n")
+
+                ncascades += 1
+                nedges += len(edges)
+        finally:
+            if pfobj is not None:
+                pfobj.close()
+
+    log.info("Crawled {} cascades; {} edges", ncascades, nedges)
+    return ncascades, nedges
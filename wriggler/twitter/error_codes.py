@@ -215,6 +215,14 @@ ERROR_CODES = [
 
 ERROR_CODE_TODO = {code: todo for code, _, todo in ERROR_CODES}
 
+# Skipped keys failing with these codes will never work again;
+# others are quarantined for a while.
+DEAD_KEY_CODES = set([
+    64, # Your account is suspended
+    89, # Invalid or expired token
+    215, # Bad authentication data
+])
+
 def get_error_todo(response):
     """
     Decide what to do.
@@ -0,0 +1,89 @@
+"""
+Spatial index of bounding boxes for routing geotagged tweets.
+
+statuses_filter matches locations loosely; tweets whose place only
+overlaps a box are delivered too. BoxIndex finds the boxes which really
+contain the point of a tweet. The boxes are registered in every cell of a
+uniform grid they overlap, so a query only checks the boxes of one cell.
+"""
+
+from __future__ import division
+
+import math
+
+def tweet_point(tweet):
+    """
+    Return the (lon, lat) of the tweet, or None.
+
+    The exact coordinates are used if present, else the center
+    of the bounding box of the place.
+    """
+
+    coords = tweet.get("coordinates")
+    if coords and coords.get("type") == "Point":
+        lon, lat = coords["coordinates"]
+        return lon, lat
+
+    place = tweet.get("place")
+    try:
+        ring = place["bounding_box"]["coordinates"][0]
+    except (TypeError, KeyError, IndexError):
+        return None
+    if not ring:
+        return None
+
+    lons = [p[0] for p in ring]
+    lats = [p[1] for p in ring]
+    return (min(lons) + max(lons)) / 2, (min(lats) + max(lats)) / 2
+
+class BoxIndex(object):
+    """
+    Grid index over (sw_lon, sw_lat, ne_lon, ne_lat) boxes.
+
+    cell - Size of the grid cells in degrees
+    """
+
+    def __init__(self, cell=1.0):
+        super(BoxIndex, self).__init__()
+
+        self.cell = cell
+        self.grid = {}
+        self.boxes = []
+
+    def cell_of(self, lon, lat):
+        x = int(math.floor(lon / self.cell))
+        y = int(math.floor(lat / self.cell))
+        return x, y
+
+    def add(self, box, value):
+        """
+        Add the box; value is returned for the points in it.
+        """
+
+        west, south, east, north = box
+        if west > east or south > north:
+            raise ValueError("Invalid bounding box: {}".format(box))
+
+        entry = (west, south, east, north, value)
+        self.boxes.append(entry)
+
+        x0, y0 = self.cell_of(west, south)
+        x1, y1 = self.cell_of(east, north)
+        for x in xrange(x0, x1 + 1):
+            for y in xrange(y0, y1 + 1):
+                self.grid.setdefault((x, y), []).append(entry)
+
+    def query(self, lon, lat):
+        """
+        Return the values of the boxes containing the point.
+        """
+
+        found = []
+        entries = self.grid.get(self.cell_of(lon, lat), ())
+        for west, south, east, north, value in entries:
+            if west <= lon <= east and south <= lat <= north:
+                found.append(value)
+        return found
+
+    def __len__(self):
+        return len(self.boxes)
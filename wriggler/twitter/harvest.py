@@ -0,0 +1,141 @@
+"""
+Bulk harvest of user timelines.
+
+Crawls the timelines of a large list of users concurrently, with clones
+of one MultiAuth. Tweets are written to sharded newline delimited json
+files, and every user done is recorded in a completion index, so that an
+interrupted harvest can be resumed.
+"""
+
+import os
+import json
+
+import logbook
+
+from wriggler import Error
+import wriggler.workers as workers
+import wriggler.twitter.rest as rest
+
+log = logbook.Logger(__name__)
+
+# Maximum number of tweets returned by statuses_user_timeline
+MAX_TIMELINE = 3200
+
+def read_users(fname, maxitems):
+    """
+    Read (user_id, maxitems) from the file.
+
+    Each line has a user id, optionally followed by a tab and
+    the maximum number of tweets to get for the user.
+    """
+
+    with open(fname) as fobj:
+        for line in fobj:
+            parts = line.split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            user_maxitems = int(parts[1]) if len(parts) > 1 else maxitems
+            yield int(parts[0]), user_maxitems
+
+def read_index(fname):
+    """
+    Return the ids of the users in the completion index.
+    """
+
+    done = set()
+    if not os.path.exists(fname):
+        return done
+
+    with open(fname) as fobj:
+        for line in fobj:
+            done.add(int(line.split("\t", 1)[0]))
+    return done
+
+def user_timeline(auth, user):
+    """
+    Get the timeline of the user.
+
+    Users which can not be crawled (protected, suspended, etc.)
+    are given up on at once, keeping the status and error codes.
+    If the calls fail, the tweets are None.
+    """
+
+    user_id, maxitems = user
+    if maxitems <= 0:
+        return user_id, [], 200, 0
+
+    params = {"user_id": user_id, "maxitems": maxitems}
+
+    tweets, code, error_code = [], 200, 0
+    try:
+        for data, meta in rest.statuses_user_timeline(auth, **params):
+            if meta["code"] != 200:
+                code, error_code = meta["code"], meta["error_code"]
+                break
+            tweets.extend(data)
+    except Error:
+        log.notice(u"Failed to harvest user {}", user_id, exc_info=True)
+        return user_id, None, None, None
+
+    return user_id, tweets[:maxitems], code, error_code
+
+def harvest(auth, fname, outdir, nthreads=8, nshards=16,
+            maxitems=MAX_TIMELINE):
+    """
+    Harvest the timelines of the users in the file.
+
+    auth     - MultiAuth
+    fname    - File of user ids; see read_users
+    outdir   - Output directory; tweets of a user go to the shard
+               timelines-NNN.json chosen by user_id % nshards,
+               and the user is then added to index.tsv
+    maxitems - Default maximum number of tweets per user
+
+    Users already in the index are skipped. Users whose calls failed are
+    left out of the index, so they are tried again on resume.
+    Returns the number of users and tweets harvested.
+    """
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    index_fname = os.path.join(outdir, "index.tsv")
+    done = read_index(index_fname)
+    log.info("{} users already harvested", len(done))
+
+    users = (u for u in read_users(fname, maxitems) if u[0] not in done)
+    auths = auth.clones(nthreads)
+
+    shards = [open(os.path.join(outdir, "timelines-%03d.json" % i), "a")
+              for i in xrange(nshards)]
+    index = open(index_fname, "a")
+
+    nusers, ntweets, nfailed = 0, 0, 0
+    try:
+        results = workers.imap(user_timeline, users, auths, ordered=False)
+        for user_id, tweets, code, error_code in results:
+            if tweets is None:
+                nfailed += 1
+                continue
+
+            shard = user_id % nshards
+            for tweet in tweets:
+                shards[shard].write(json.dumps(tweet) + "\n")
+            shards[shard].flush()
+
+            index.write("%d\t%d\t%d\t%d\t%d\n" %
+                        (user_id, code, error_code, len(tweets), shard))
+            index.flush()
+
+            nusers += 1
+            ntweets += len(tweets)
+            if nusers % 1000 == 0:
+                log.info("Harvested {} users, {} tweets", nusers, ntweets)
+    finally:
+        for fobj in shards:
+            fobj.close()
+        index.close()
+
+    if nfailed:
+        log.notice("Failed to harvest {} users", nfailed)
+    return nusers, ntweets
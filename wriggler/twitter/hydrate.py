@@ -0,0 +1,131 @@
+"""
+Streaming hydration of user and tweet ids.
+
+Ids are read lazily from a text file (one id per line) or a binary file of
+int64 ids (memory mapped), grouped into batches of 100 and looked up
+concurrently with clones of one MultiAuth. Only a bounded number of
+batches is in memory at a time, whatever the size of the input.
+
+Ids are only missing if a successful lookup left them out. The ids of
+batches whose lookup failed are written out separately, to be retried.
+"""
+
+import json
+
+import logbook
+
+from wriggler import Error
+import wriggler.workers as workers
+import wriggler.twitter.rest as rest
+from wriggler.mmarray import MappedArray
+from wriggler.twitter.auth import ichunks
+
+log = logbook.Logger(__name__)
+
+# Maximum number of ids in a lookup call
+BATCH_SIZE = 100
+
+def read_text_ids(fname):
+    """
+    Iterate over the ids in a text file, one per line.
+    """
+
+    with open(fname) as fobj:
+        for line in fobj:
+            line = line.strip()
+            if line:
+                yield int(line)
+
+def read_binary_ids(fname):
+    """
+    Iterate over the ids in a binary file of little endian int64.
+    """
+
+    with MappedArray(fname, "<q") as arr:
+        for sid in arr:
+            yield sid
+
+def split_found(ids, lookup):
+    """
+    Call the lookup on the ids.
+
+    Returns the objects, the missing ids and the failed ids.
+    """
+
+    try:
+        data, meta = lookup()
+    except Error:
+        log.notice(u"Lookup of {} ids failed", len(ids), exc_info=True)
+        return [], [], ids
+
+    # Not found is a 404 when none of the ids exist
+    if meta["code"] == 404:
+        return [], ids, []
+    if meta["code"] != 200:
+        log.notice(u"Lookup of {} ids failed; {}", len(ids), meta)
+        return [], [], ids
+
+    found = set(obj["id"] for obj in data)
+    return data, [i for i in ids if i not in found], []
+
+def lookup_users(auth, ids):
+    """
+    Lookup the users; returns the users, missing and failed ids.
+    """
+
+    return split_found(ids, lambda: rest.users_lookup(auth, user_id=ids))
+
+def lookup_tweets(auth, ids):
+    """
+    Lookup the tweets; returns the tweets, missing and failed ids.
+    """
+
+    return split_found(ids, lambda: rest.statuses_lookup(auth, id=ids))
+
+LOOKUPS = {
+    "users": lookup_users,
+    "tweets": lookup_tweets,
+}
+
+def hydrate(auth, kind, fname, out_fname, missing_fname, nthreads=4,
+            binary=False, failed_fname=None):
+    """
+    Hydrate the ids in the file.
+
+    auth          - MultiAuth
+    kind          - "users" or "tweets"
+    fname         - Input file of ids; int64 binary if binary
+    out_fname     - Hydrated objects are written here, one json per line
+    missing_fname - Ids not returned by the api are written here
+    failed_fname  - Ids whose lookup failed are written here;
+                    default missing_fname + ".failed"
+
+    Returns the number of objects, missing and failed ids written.
+    """
+
+    if failed_fname is None:
+        failed_fname = missing_fname + ".failed"
+
+    ids = read_binary_ids(fname) if binary else read_text_ids(fname)
+    batches = ichunks(ids, BATCH_SIZE)
+    auths = auth.clones(nthreads)
+
+    nfound, nmissing, nfailed = 0, 0, 0
+    with open(out_fname, "w") as out, open(missing_fname, "w") as missing, \
+            open(failed_fname, "w") as failed:
+        results = workers.imap(LOOKUPS[kind], batches, auths, ordered=False)
+        for objs, missing_ids, failed_ids in results:
+            for obj in objs:
+                out.write(json.dumps(obj) + "\n")
+            for sid in missing_ids:
+                missing.write("%d\n" % sid)
+            for sid in failed_ids:
+                failed.write("%d\n" % sid)
+
+            nfound += len(objs)
+            nmissing += len(missing_ids)
+            nfailed += len(failed_ids)
+
+    log.info("Hydrated {} {}; {} missing, {} failed",
+             nfound, kind, nmissing, nfailed)
+    return nfound, nmissing, nfailed
@@ -0,0 +1,209 @@
+"""
+Timeline monitoring with adaptive poll intervals.
+
+The posting rate of every user is estimated from the tweets found between
+polls, with older observations decayed away. Given a budget of calls per
+second derived from the MultiAuth pool, the expected delay in finding new
+tweets is smallest when users are polled at a frequency proportional to
+the square root of their rate. Polls are kept in a heap by due time, and
+the due users are polled concurrently with clones of the MultiAuth.
+"""
+
+from __future__ import division
+
+import time
+import math
+import heapq
+
+import logbook
+
+import wriggler.workers as workers
+import wriggler.twitter.rest as rest
+from wriggler.twitter import snowflake_time
+from wriggler.twitter.harvest import MAX_TIMELINE
+
+log = logbook.Logger(__name__)
+
+# Rate limit of statuses/user_timeline, per user context
+TIMELINE_LIMIT = 900
+TIMELINE_WINDOW = 15 * 60
+
+# Prior for the posting rate; a tweet a day
+PRIOR_COUNT = 1
+PRIOR_SPAN = 24 * 60 * 60
+
+# Observations lose half their weight in this many seconds
+RATE_HALFLIFE = 7 * 24 * 60 * 60
+
+def poll_user(auth, user):
+    """
+    Return the tweets of the user newer than since_id.
+
+    On the first poll (since_id None) only the latest page is fetched.
+    Returns the user_id, the time of the poll and the tweets;
+    tweets is None if the call failed.
+    """
+
+    user_id, since_id = user
+    now = time.time()
+
+    if since_id is None:
+        data, meta = rest.statuses_user_timeline(auth, user_id=user_id)
+        pages = [(data, meta)]
+    else:
+        pages = rest.statuses_user_timeline(auth, user_id=user_id,
+                                            since_id=since_id,
+                                            maxitems=MAX_TIMELINE)
+
+    tweets = []
+    for data, meta in pages:
+        if meta["code"] != 200:
+            log.notice("Polling user {} failed; {}", user_id, meta)
+            return user_id, now, None
+        tweets.extend(data)
+
+    return user_id, now, tweets
+
+class Monitor(object):
+    """
+    Schedule polls of user timelines.
+
+    auth         - MultiAuth whose pool sets the budget
+    user_ids     - Users to monitor
+    share        - Fraction of the pool's rate limit to use
+    min_interval - Shortest time between polls of a user
+    max_interval - Longest time between polls of a user, if given
+    """
+
+    def __init__(self, auth, user_ids, share=0.9, min_interval=60,
+                 max_interval=None):
+        super(Monitor, self).__init__()
+
+        self.auth = auth
+        self.share = share
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        # Per user: since_id, decayed tweet count and observed seconds
+        self.users = {}
+        for user_id in user_ids:
+            self.users[user_id] = {"since_id": None, "count": 0.0,
+                                   "span": 0.0, "last": None}
+        self.sqrt_total = len(self.users) * math.sqrt(PRIOR_COUNT / PRIOR_SPAN)
+
+        # Everyone is polled first, spread over the budget
+        now = time.time()
+        step = 1 / self.budget()
+        self.heap = [(now + i * step, user_id)
+                     for i, user_id in enumerate(self.users)]
+        heapq.heapify(self.heap)
+
+    def budget(self):
+        """
+        Return the number of polls per second allowed.
+        """
+
+        ncontexts = max(self.auth.capacity("/statuses/user_timeline"), 1)
+        return ncontexts * self.share * TIMELINE_LIMIT / TIMELINE_WINDOW
+
+    def rate(self, user_id):
+        """
+        Return the estimated tweets per second of the user.
+        """
+
+        user = self.users[user_id]
+        return (user["count"] + PRIOR_COUNT) / (user["span"] + PRIOR_SPAN)
+
+    def interval(self, user_id):
+        """
+        Return the time till the next poll of the user.
+
+        Users are polled at budget * sqrt(rate) / sum(sqrt(rates))
+        times per second, within the interval bounds.
+        """
+
+        freq = self.budget() * math.sqrt(self.rate(user_id)) / self.sqrt_total
+        interval = max(1 / freq, self.min_interval)
+        if self.max_interval is not None:
+            interval = min(interval, self.max_interval)
+        return interval
+
+    def update(self, user_id, now, tweets):
+        """
+        Update the rate estimate of the user with the polled tweets.
+        """
+
+        user = self.users[user_id]
+        old_sqrt = math.sqrt(self.rate(user_id))
+
+        if tweets:
+            user["since_id"] = max(tweet["id"] for tweet in tweets)
+
+        if user["last"] is None:
+            # Rate over the span of the latest page
+            if tweets:
+                oldest = min(tweet["id"] for tweet in tweets)
+                user["count"] = len(tweets)
+                user["span"] = max(now - snowflake_time(oldest), 1)
+        else:
+            elapsed = now - user["last"]
+            weight = 0.5 ** (elapsed / RATE_HALFLIFE)
+            user["count"] = user["count"] * weight + len(tweets)
+            user["span"] = user["span"] * weight + elapsed
+        user["last"] = now
+
+        self.sqrt_total += math.sqrt(self.rate(user_id)) - old_sqrt
+
+    def due(self, now):
+        """
+        Pop and return the users due for a poll at now.
+        """
+
+        users = []
+        while self.heap and self.heap[0][0] <= now:
+            users.append(heapq.heappop(self.heap)[1])
+        return users
+
+    def schedule(self, user_id, now):
+        heapq.heappush(self.heap, (now + self.interval(user_id), user_id))
+
+def monitor(auth, user_ids, nthreads=4, maxpolls=None, **kwargs):
+    """
+    Monitor the timelines of the users.
+
+    auth     - MultiAuth
+    user_ids - Users to monitor
+    maxpolls - Stop after this many polls; default never
+    kwargs   - Passed on to Monitor
+
+    Yields new tweets, as they are found. The tweets found on
+    the first poll of a user are not yielded.
+    """
+
+    sched = Monitor(auth, user_ids, **kwargs)
+    auths = auth.clones(nthreads)
+
+    npolls = 0
+    while sched.heap and (maxpolls is None or npolls < maxpolls):
+        now = time.time()
+        due = sched.due(now)
+        if maxpolls is not None:
+            for user_id in due[maxpolls - npolls:]:
+                heapq.heappush(sched.heap, (now, user_id))
+            due = due[:maxpolls - npolls]
+        if not due:
+            time.sleep(max(sched.heap[0][0] - now, 0))
+            continue
+
+        users = [(user_id, sched.users[user_id]["since_id"])
+                 for user_id in due]
+        for user_id, ts, tweets in workers.imap(poll_user, users, auths,
+                                                ordered=False):
+            first = sched.users[user_id]["last"] is None
+            if tweets is not None:
+                sched.update(user_id, ts, tweets)
+                if not first:
+                    for tweet in tweets:
+                        yield tweet
+            sched.schedule(user_id, ts)
+            npolls += 1
@@ -2,16 +2,32 @@
 Robust Twitter crawler primitives.
 """
 
+import time
+from urlparse import urlsplit
+
 import logbook
 
 from wriggler import Error
 import wriggler.const as const
 import wriggler.req as req
+import wriggler.budget as budget
+import wriggler.workers as workers
 import wriggler.twitter.error_codes as ec
 from wriggler.twitter import list_to_csv
+from wriggler.twitter.auth import resource_name
 
 log = logbook.Logger(__name__)
 
+# Resources whose answer does not depend on the user asked for; a bare
+# 401 from any other resource can be a protected user, not a bad key
+USER_FREE_RESOURCES = frozenset([
+    "/search/tweets",
+    "/statuses/lookup",
+    "/trends/available",
+    "/trends/place",
+    "/users/lookup",
+])
+
 def rest_call(endpoint, auth, params, method="get"):
     """
     Call a Twitter rest api endpoint.
@@ -20,26 +36,47 @@ def rest_call(endpoint, auth, params, method="get"):
     ## DEBUG
     # print(endpoint)
 
-    args = {"auth": auth.oauth, "session": auth.session, "timeout": 60.0}
+    if method not in ("get", "post"):
+        raise ValueError("Invalid value for parameter 'method'")
 
+    resource = resource_name(endpoint)
+
+    retries = budget.current(urlsplit(endpoint).netloc)
     tries = 0
     while tries < const.API_RETRY_MAX:
-        if method == "get":
-            r = req.get(endpoint, params=params, **args)
-        elif method == "post":
-            r = req.post(endpoint, data=params, **args)
-        else:
-            raise ValueError("Invalid value for parameter 'method'")
+        auth.acquire(resource)
+        args = {"auth": auth.oauth, "session": auth.session, "timeout": 60.0,
+                "retry_timeouts": False}
+
+        try:
+            if method == "get":
+                r = req.get(endpoint, params=params, **args)
+            else:
+                r = req.post(endpoint, data=params, **args)
+        except req.RequestTimeoutError:
+            # Keys that keep timing out are skipped
+            auth.release()
+            auth.strike_key("timeout")
+            if not retries.can_retry():
+                break
+            tries += 1
+            continue
+        except req.ConnectFailError:
+            auth.release()
+            raise
 
         # Proper receive
         if 200 <= r.status_code < 300:
             auth.check_limit(r.headers)
+            auth.key_ok()
 
             try:
                 data = r.json()
             except ValueError:
                 log.info(u"Try L1 {}: Falied to decode JSON - {}\n{}",
                          tries, r.status_code, r.text)
+                if not retries.can_retry():
+                    break
                 tries += 1
                 continue
 
@@ -48,14 +85,31 @@ def rest_call(endpoint, auth, params, method="get"):
         log.info(u"Try L1 {}: Received error", tries)
         todo, status_code, error_code = ec.get_error_todo(r)
         if todo is ec.RETRY:
-            auth.check_limit(r.headers)
+            # Without rate limit headers, wait before trying again
+            if not auth.check_limit(r.headers):
+                time.sleep(const.API_RETRY_AFTER)
+            # Waits for rate limits are not retries of failures
+            if (status_code not in (420, 429) and
+                    not retries.can_retry()):
+                break
             tries += 1
             continue
         elif todo is ec.SKIP_AND_RETRY:
-            auth.skip_key()
+            auth.skip_key(error_code)
+            if not retries.can_retry():
+                break
             tries += 1
             continue
         elif todo is ec.GIVEUP:
+            # Revoked keys can get a bare 401, as do protected users
+            if (status_code == 401 and error_code == 0 and
+                    resource in USER_FREE_RESOURCES and
+                    auth.strike_key(401)):
+                if not retries.can_retry():
+                    break
+                tries += 1
+                continue
+
             try:
                 data = r.json()
             except ValueError:
@@ -70,8 +124,17 @@ def rest_call(endpoint, auth, params, method="get"):
 def id_iter(func, maxitems, auth, params):
     """
     Iterate over the calls of the function using max_id.
+
+    With prefetch=depth in params, the next pages are fetched in the
+    background while the current one is processed. The auth object
+    must not be used elsewhere till the iteration is done.
     """
 
+    prefetch = params.pop("prefetch", 0)
+    pages = _id_pages(func, maxitems, auth, params)
+    return workers.prefetch(pages, prefetch) if prefetch > 0 else pages
+
+def _id_pages(func, maxitems, auth, params):
     count = 0
     max_id = float("inf")
     while count < maxitems:
@@ -87,8 +150,17 @@ def id_iter(func, maxitems, auth, params):
 def cursor_iter(func, maxitems, auth, params):
     """
     Iteratie over the calls of the function using cursor.
+
+    With prefetch=depth in params, the next pages are fetched in the
+    background while the current one is processed. The auth object
+    must not be used elsewhere till the iteration is done.
     """
 
+    prefetch = params.pop("prefetch", 0)
+    pages = _cursor_pages(func, maxitems, auth, params)
+    return workers.prefetch(pages, prefetch) if prefetch > 0 else pages
+
+def _cursor_pages(func, maxitems, auth, params):
     count = 0
     while count < maxitems:
         data, meta = func(auth, **params)
@@ -0,0 +1,250 @@
+"""
+Route the tweets of one stream to many subscribers.
+
+Every subscriber has its own track terms and locations; the union of all
+of them is used for a single statuses_filter connection, and the tweets
+are matched back to the subscribers here. All the words of all the terms
+are compiled into one Aho-Corasick automaton, so each tweet is matched in
+a single pass over its text, whatever the number of terms.
+
+As with track, a term matches when all its words appear in the tweet as
+whole words (ignoring case, and also as #hashtags and @mentions). Matched
+tweets are put on bounded per-subscriber queues; tweets which do not fit
+are dropped and counted, so a slow subscriber never blocks the stream.
+
+Geotagged tweets are matched to the subscribers whose boxes contain them
+with a grid index (see wriggler.twitter.geo), unlike the loose matching
+of locations by statuses_filter.
+"""
+
+import json
+import Queue
+from collections import deque
+
+import logbook
+
+from wriggler.twitter.geo import BoxIndex, tweet_point
+
+log = logbook.Logger(__name__)
+
+class Automaton(object):
+    """
+    Aho-Corasick automaton over a set of strings.
+    """
+
+    def __init__(self):
+        super(Automaton, self).__init__()
+
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+
+    def add(self, word, value):
+        """
+        Add the string; value is returned when it is found.
+        """
+
+        node = 0
+        for ch in word:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+                self.goto[node][ch] = nxt
+            node = nxt
+        self.out[node].append((len(word), value))
+
+    def build(self):
+        """
+        Compute the failure links; call after adding all the strings.
+        """
+
+        queue = deque(self.goto[0].itervalues())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].iteritems():
+                queue.append(child)
+
+                fail = self.fail[node]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(ch, 0)
+                self.fail[child] = fail if fail != child else 0
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def search(self, text):
+        """
+        Yield (start, end, value) of every occurrence in the text.
+        """
+
+        goto, fail, out = self.goto, self.fail, self.out
+
+        node = 0
+        for end, ch in enumerate(text, 1):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, value in out[node]:
+                yield end - length, end, value
+
+def is_word_char(ch):
+    return ch.isalnum() or ch == "_"
+
+def tweet_text(tweet):
+    """
+    Return the full text of the tweet.
+    """
+
+    if "extended_tweet" in tweet:
+        return tweet["extended_tweet"].get("full_text", tweet.get("text", ""))
+    return tweet.get("text") or ""
+
+class Router(object):
+    """
+    Route stream messages to the subscribers whose terms they match.
+
+    qsize - Size of every subscriber queue
+    cell  - Grid cell size of the location index, in degrees
+    """
+
+    def __init__(self, qsize=10000, cell=1.0):
+        super(Router, self).__init__()
+
+        self.qsize = qsize
+        self.cell = cell
+        self.terms = {}
+        self.boxes = {}
+        self.queues = {}
+        self.dropped = {}
+        self.compile()
+
+    def subscribe(self, name, terms=(), locations=()):
+        """
+        Subscribe to tweets matching any of the terms, or located
+        in any of the (sw_lon, sw_lat, ne_lon, ne_lat) boxes.
+
+        Returns the queue of the subscriber; matched tweets are put
+        on it as dicts.
+        """
+
+        self.terms[name] = [t.lower().split() for t in terms if t.strip()]
+        self.boxes[name] = [tuple(box) for box in locations]
+        if name not in self.queues:
+            self.queues[name] = Queue.Queue(self.qsize)
+            self.dropped[name] = 0
+        self.compile()
+        return self.queues[name]
+
+    def compile(self):
+        """
+        Compile the terms of all the subscribers.
+        """
+
+        automaton = Automaton()
+        word_terms, term_size = {}, {}
+        for name, terms in self.terms.iteritems():
+            for i, words in enumerate(terms):
+                term_size[name, i] = len(set(words))
+                for word in set(words):
+                    if word not in word_terms:
+                        word_terms[word] = []
+                        automaton.add(word, word)
+                    word_terms[word].append((name, i))
+        automaton.build()
+
+        index = BoxIndex(self.cell)
+        for name, boxes in self.boxes.iteritems():
+            for box in boxes:
+                index.add(box, name)
+
+        # Swapped at once, so routing can go on in another thread
+        self.compiled = (automaton, word_terms, term_size, index)
+
+    def track(self):
+        """
+        Return the union of the terms, for statuses_filter.
+        """
+
+        terms = set()
+        for words_list in self.terms.itervalues():
+            terms.update(" ".join(words) for words in words_list)
+        return sorted(terms)
+
+    def locations(self):
+        """
+        Return the union of the boxes, for statuses_filter.
+        """
+
+        boxes = set()
+        for name_boxes in self.boxes.itervalues():
+            boxes.update(name_boxes)
+        return sorted(boxes)
+
+    def match(self, text):
+        """
+        Return the names of the subscribers matching the text.
+        """
+
+        automaton, word_terms, term_size, _ = self.compiled
+
+        text = text.lower()
+        found = set()
+        for start, end, word in automaton.search(text):
+            if start > 0 and is_word_char(text[start - 1]):
+                continue
+            if end < len(text) and is_word_char(text[end]):
+                continue
+            found.add(word)
+
+        counts, names = {}, set()
+        for word in found:
+            for key in word_terms[word]:
+                counts[key] = counts.get(key, 0) + 1
+                if counts[key] == term_size[key]:
+                    names.add(key[0])
+        return names
+
+    def route(self, line):
+        """
+        Route the stream line; returns the subscribers it went to.
+        """
+
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            return set()
+        if not isinstance(msg, dict) or "text" not in msg:
+            return set()
+
+        names = self.match(tweet_text(msg))
+        point = tweet_point(msg)
+        if point is not None:
+            names.update(self.compiled[3].query(*point))
+
+        for name in names:
+            try:
+                self.queues[name].put_nowait(msg)
+            except Queue.Full:
+                if self.dropped[name] % 10000 == 0:
+                    log.notice(u"Queue of {} full; dropping tweets", name)
+                self.dropped[name] += 1
+        return names
+
+    def run(self, lines):
+        """
+        Route all the lines of the stream.
+        """
+
+        for line in lines:
+            self.route(line)
+
+    def stats(self):
+        """
+        Return the queued and dropped tweets of every subscriber.
+        """
+
+        return dict((name, {"queued": self.queues[name].qsize(),
+                            "dropped": self.dropped[name]})
+                    for name in self.queues)
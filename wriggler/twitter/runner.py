@@ -0,0 +1,144 @@
+"""
+Run a crawl over many processes, one for each block of keys.
+
+The keys are split with read_keys_split and every block gets its own
+worker process. Tasks are fed through a single shared queue, so a worker
+that is done picks up the next task while slower ones are still busy.
+Results are returned in the order of completion.
+"""
+
+import sys
+import Queue
+import traceback
+import multiprocessing as mp
+
+import logbook
+
+from wriggler import Error
+from wriggler.twitter.auth import read_keys_split
+
+log = logbook.Logger(__name__)
+
+# Kinds of messages sent back by the workers
+PAGE, DONE, FATAL = 1, 2, 3
+
+# Check the workers are alive when no result came for this long (seconds)
+POLL_INTERVAL = 5.0
+
+def make_params(task, param, params):
+    """
+    Return the parameters for calling the endpoint on the task.
+    """
+
+    ret = dict(params)
+    if param is None:
+        ret.update(task)
+    else:
+        ret[param] = task
+    return ret
+
+def worker(func, auth, param, params, tasks, results):
+    """
+    Call the endpoint on tasks till the stop signal is received.
+    """
+
+    for task in iter(tasks.get, None):
+        try:
+            ret = func(auth, **make_params(task, param, params))
+
+            # Endpoints called with maxitems return an iterator of pages
+            pages = [ret] if isinstance(ret, tuple) else ret
+            for data, meta in pages:
+                results.put((PAGE, task, data, meta))
+        except Error as e:
+            log.warn(u"Task {} failed - {!r}", task, e)
+            meta = {"code": None, "error_code": None, "error": repr(e)}
+            results.put((PAGE, task, None, meta))
+        except Exception: # pylint: disable=broad-except
+            results.put((FATAL, task, traceback.format_exc(), None))
+            return
+
+        results.put((DONE, task, None, None))
+
+def imap_crawl(func, tasks, kfname, size=sys.maxsize, param=None,
+               depth=2, state=None, **params):
+    """
+    Call the endpoint func on every task using a pool of processes.
+
+    func   - Endpoint function from wriggler.twitter.rest
+    tasks  - Iterable of tasks; parameter dicts if param is None
+             else values of the parameter param
+    kfname - Key file; split into blocks of size keys, one per process
+    depth  - Number of queued tasks per process
+    state  - Key state shared between the processes, if any
+    params - Parameters common to all the calls
+
+    Yields (task, data, meta) for every page received.
+    """
+
+    auths = read_keys_split(kfname, size, state)
+    log.info("Starting {} worker processes ...", len(auths))
+
+    taskq, resultq = mp.Queue(), mp.Queue()
+    procs = []
+    for auth in auths:
+        args = (func, auth, param, params, taskq, resultq)
+        proc = mp.Process(target=worker, args=args)
+        proc.daemon = True
+        proc.start()
+        procs.append(proc)
+
+    tasks = iter(tasks)
+    pending = 0
+
+    def feed():
+        for task in tasks:
+            taskq.put(task)
+            return 1
+        return 0
+
+    try:
+        for _ in xrange(depth * len(procs)):
+            pending += feed()
+
+        while pending:
+            try:
+                kind, task, data, meta = resultq.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                # A killed worker never sends back its tasks
+                for proc in procs:
+                    if not proc.is_alive():
+                        raise Error("Worker process %d died with exit code %s"
+                                    % (proc.pid, proc.exitcode))
+                continue
+
+            if kind == PAGE:
+                yield task, data, meta
+            elif kind == DONE:
+                pending -= 1
+                pending += feed()
+            else:
+                raise Error("Worker failed on task %r\n%s" % (task, data))
+    finally:
+        for proc in procs:
+            taskq.put(None)
+        for proc in procs:
+            if pending:
+                proc.terminate()
+            proc.join()
+
+def crawl(func, tasks, kfname, sink, **kwargs):
+    """
+    Call the endpoint func on every task and send the results to sink.
+
+    sink is called as sink(task, data, meta) for every page received.
+    See imap_crawl for the rest of the arguments.
+
+    Returns the number of pages received.
+    """
+
+    count = 0
+    for task, data, meta in imap_crawl(func, tasks, kfname, **kwargs):
+        sink(task, data, meta)
+        count += 1
+    return count
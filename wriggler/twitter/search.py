@@ -0,0 +1,125 @@
+"""
+Parallel search over snowflake id ranges.
+
+Tweet ids are snowflakes, which encode their creation time. The search
+window is split into id ranges by time, the ranges are paged concurrently
+with clones of one MultiAuth, and the pages are merged back in
+descending id order as they arrive.
+"""
+
+from __future__ import division
+
+import sys
+import time
+import Queue
+import threading
+from collections import deque
+
+import logbook
+
+import wriggler.workers as workers
+import wriggler.twitter.rest as rest
+from wriggler.twitter import time_snowflake
+
+log = logbook.Logger(__name__)
+
+# Search api only returns tweets from the last seven days
+SEARCH_WINDOW = 7 * 24 * 60 * 60
+
+def id_ranges(since, until, parts):
+    """
+    Split the time window into parts id ranges, newest first.
+
+    Returns (since_id, max_id) pairs; since_id is exclusive
+    and max_id inclusive, as in the api.
+    """
+
+    step = (until - since) / parts
+    bounds = [time_snowflake(until - i * step) - 1 for i in xrange(parts)]
+    bounds.append(time_snowflake(since) - 1)
+
+    return [(bounds[i + 1], bounds[i]) for i in xrange(parts)]
+
+def search_range(auth, id_range, params):
+    """
+    Iterate over the pages of tweets in the id range, newest first.
+    """
+
+    params = dict(params)
+    params["since_id"], params["max_id"] = id_range
+    params.setdefault("maxitems", sys.maxsize)
+
+    count = 0
+    for data, meta in rest.search_tweets(auth, **params):
+        if meta["code"] != 200:
+            log.notice(u"Search failed on range {}; {}", id_range, meta)
+            break
+        count += len(data["statuses"])
+        yield data["statuses"]
+
+    log.debug(u"Range {} done; {} tweets", id_range, count)
+
+def search_parallel(auth, q, nthreads=4, parts=None, since=None, until=None,
+                    depth=2, **params):
+    """
+    Search for tweets, crawling id ranges concurrently.
+
+    auth         - MultiAuth
+    q            - Search query
+    nthreads     - Number of concurrent threads
+    parts        - Number of id ranges; default 4 * nthreads
+    since, until - Unix times of the window; default the last seven days
+    depth        - Pages a range may be fetched ahead of the consumer
+    params       - Other parameters of search_tweets
+
+    The newest range is yielded page by page as it is fetched, while the
+    next nthreads - 1 ranges are fetched up to depth pages ahead.
+
+    Yields tweets in descending order of id, each once.
+    """
+
+    if until is None:
+        until = time.time()
+    if since is None:
+        since = until - SEARCH_WINDOW
+    if parts is None:
+        parts = 4 * nthreads
+
+    params["q"] = q
+    ranges = iter(id_ranges(since, until, parts))
+    stop = threading.Event()
+    running = deque()
+
+    def start(ath):
+        id_range = next(ranges, None)
+        if id_range is not None:
+            queue = Queue.Queue(depth)
+            pages = search_range(ath, id_range, params)
+            thread = workers.produce(pages, queue, stop)
+            running.append((ath, queue, thread))
+
+    for ath in auth.clones(nthreads):
+        start(ath)
+
+    last_id = float("inf")
+    try:
+        while running:
+            ath, queue, _ = running[0]
+            ok, tweets = queue.get()
+            if not ok:
+                if tweets is not None:
+                    raise tweets
+                # The range is done, so its auth is free for the next one
+                running.popleft()
+                start(ath)
+                continue
+
+            # Ranges are disjoint and paged newest first
+            for tweet in tweets:
+                if tweet["id"] < last_id:
+                    last_id = tweet["id"]
+                    yield tweet
+    finally:
+        stop.set()
+        for _, _, thread in running:
+            thread.join()
@@ -3,18 +3,27 @@ Robust Twitter streaming API interface.
 """
 
 import ssl
+import json
+import Queue
 import httplib
+import threading
 from time import sleep
+from collections import deque
 
 import logbook
 from requests_oauthlib import OAuth1
 
-from wriggler.twitter import list_to_csv
+from wriggler.twitter import list_to_csv, boxes_to_csv
 import wriggler.const as const
 import wriggler.req as req
+import wriggler.budget as budget
+import wriggler.workers as workers
 
 log = logbook.Logger(__name__)
 
+# Number of recent message identities kept to dedup merged streams
+HA_DEDUP_WINDOW = 100000
+
 def stream_call(endpoint, auth, params, method):
     """
     Do the streaming api.
@@ -23,17 +32,34 @@ def stream_call(endpoint, auth, params, method):
     auth = OAuth1(signature_type="auth_header", **auth.token)
 
     # Enter the infinite loop
+    backoff = const.CONNECT_RETRY_AFTER
     while True:
-        if method == "get":
-            r = req.get(endpoint, params=params, auth=auth,
-                        timeout=60.0, stream=True)
-        elif method == "post":
-            r = req.post(endpoint, data=params, auth=auth,
-                         timeout=60.0, stream=True)
-        else:
-            raise ValueError("Invalid value for parameter 'method'")
+        try:
+            # Reconnects are paced below, not drawn from the retry budgets
+            with budget.use(budget.unlimited):
+                if method == "get":
+                    r = req.get(endpoint, params=params, auth=auth,
+                                timeout=60.0, stream=True)
+                elif method == "post":
+                    r = req.post(endpoint, data=params, auth=auth,
+                                 timeout=60.0, stream=True)
+                else:
+                    raise ValueError("Invalid value for parameter 'method'")
+        except req.CircuitOpenError:
+            # Streams outlive outages; wait for the probes
+            log.info(u"Circuit open, sleeping {} secs ...",
+                     const.CIRCUIT_RESET_AFTER)
+            sleep(const.CIRCUIT_RESET_AFTER)
+            continue
+        except req.ConnectFailError:
+            # Out of retries (or retry budget); streams never give up
+            log.info(u"Connect failed, sleeping {} secs ...", backoff)
+            sleep(backoff)
+            backoff = min(backoff * 2, const.STREAM_BACKOFF_MAX)
+            continue
 
         if r.status_code == 200:
+            backoff = const.CONNECT_RETRY_AFTER
             # Loop over the lines
             try:
                 for line in r.iter_lines():
@@ -71,6 +97,8 @@ def statuses_filter(auth, **params):
         params["follow"] = list_to_csv(params["follow"])
     if "track" in params and isinstance(params["track"], (list, tuple)):
         params["track"] = list_to_csv(params["track"])
+    if isinstance(params.get("locations"), (list, tuple)):
+        params["locations"] = boxes_to_csv(params["locations"])
 
     params.setdefault("delimited", 0)
     params.setdefault("stall_warnings", 1)
@@ -86,3 +114,71 @@ def statuses_sample(auth):
     params = {"delimited": 0, "stall_warnings": 1}
 
     return stream_call(endpoint, auth, params, "get")
+
+def message_id(line):
+    """
+    Return the identity of the stream message.
+
+    Tweets are identified by id; other messages (deletes, limit
+    notices, etc.) by their content.
+    """
+
+    try:
+        msg = json.loads(line)
+    except ValueError:
+        return line
+
+    if isinstance(msg, dict) and "id" in msg:
+        return msg["id"]
+    return json.dumps(msg, sort_keys=True)
+
+def merge_streams(streams, window=HA_DEDUP_WINDOW, qsize=10000):
+    """
+    Merge the streams of lines, read concurrently.
+
+    Yields every message once, from the stream it arrived first on.
+    Messages are deduplicated against the last window ones. An error
+    is raised only when all the streams have failed.
+    """
+
+    queue = Queue.Queue(qsize)
+    stop = threading.Event()
+    for lines in streams:
+        workers.produce(lines, queue, stop)
+
+    seen, recent = set(), deque()
+    alive, errors = len(streams), []
+    try:
+        while alive:
+            ok, line = queue.get()
+            if not ok:
+                alive -= 1
+                if line is not None:
+                    log.warn(u"Stream failed; {!r}", line)
+                    errors.append(line)
+                continue
+
+            mid = message_id(line)
+            if mid in seen:
+                continue
+            seen.add(mid)
+            recent.append(mid)
+            if len(recent) > window:
+                seen.discard(recent.popleft())
+            yield line
+
+        if errors and len(errors) == len(streams):
+            raise errors[-1]
+    finally:
+        stop.set()
+
+def statuses_filter_ha(auths, window=HA_DEDUP_WINDOW, **params):
+    """
+    Collect tweets from statuses_filter over redundant connections.
+
+    The same filter is opened with every auth (use different keys,
+    e.g. from read_keys_split(fname, 1)); see merge_streams.
+    """
+
+    streams = [statuses_filter(auth, **dict(params)) for auth in auths]
+    return merge_streams(streams, window)
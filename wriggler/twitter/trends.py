@@ -0,0 +1,165 @@
+"""
+Scheduled polling of trends, keeping only the changes.
+
+The trend locations are fetched once, then every round the trends of all
+the locations are fetched concurrently with clones of one MultiAuth. The
+rounds are spaced so that the calls fit in the rate limit of the pool.
+Each location's ranked trends are compared to the previous round, and only
+the differences are emitted: the trends which entered, left or moved in
+the ranking, and those whose details (e.g. tweet_volume) changed.
+"""
+
+from __future__ import division
+
+import time
+import json
+
+import logbook
+
+from wriggler import Error
+import wriggler.workers as workers
+import wriggler.twitter.rest as rest
+
+log = logbook.Logger(__name__)
+
+# Rate limit of trends/place, per context
+TRENDS_LIMIT = 75
+TRENDS_WINDOW = 15 * 60
+
+def min_interval(auth, nplaces):
+    """
+    Return the shortest round interval that fits in the rate limit.
+    """
+
+    ncontexts = auth.capacity("/trends/place")
+    return nplaces * TRENDS_WINDOW / (TRENDS_LIMIT * max(ncontexts, 1))
+
+def get_woeids(auth):
+    """
+    Return the woeids of all the trend locations.
+    """
+
+    data, meta = rest.trends_available(auth)
+    if meta["code"] != 200:
+        raise Error("trends_available failed; {}".format(meta))
+    return [place["woeid"] for place in data]
+
+def trends_place(auth, woeid):
+    """
+    Return the woeid, time and trends of the place.
+
+    Trends are None if the call failed.
+    """
+
+    data, meta = rest.trends_place(auth, id=woeid)
+    if meta["code"] != 200:
+        log.notice("Trends of {} failed; {}", woeid, meta)
+        return woeid, time.time(), None
+    return woeid, time.time(), data[0]["trends"]
+
+def ranks(trends):
+    """
+    Return the trends and their ranks (from 1) by name.
+    """
+
+    ret = {}
+    for rank, trend in enumerate(trends, 1):
+        ret.setdefault(trend["name"], (rank, trend))
+    return ret
+
+def diff_trends(old, new):
+    """
+    Compare the ranked lists of trends.
+
+    Returns the trends which entered, as (rank, trend); left, as
+    (old rank, name); moved, as (name, old rank, new rank); and
+    changed in place, as (rank, trend). All are in rank order.
+    """
+
+    old_ranks, new_ranks = ranks(old), ranks(new)
+
+    entered, moved, changed = [], [], []
+    for name, (rank, trend) in sorted(new_ranks.iteritems(),
+                                      key=lambda item: item[1][0]):
+        if name not in old_ranks:
+            entered.append((rank, trend))
+            continue
+
+        old_rank, old_trend = old_ranks[name]
+        if old_rank != rank:
+            moved.append((name, old_rank, rank))
+        if old_trend != trend:
+            changed.append((rank, trend))
+
+    left = sorted((rank, name) for name, (rank, _) in old_ranks.iteritems()
+                  if name not in new_ranks)
+    return entered, left, moved, changed
+
+def trends_deltas(auth, interval=0, woeids=None, nthreads=4, rounds=None):
+    """
+    Poll the trends and yield the changes.
+
+    auth     - MultiAuth
+    interval - Seconds between the start of rounds; raised to
+               the minimum allowed by the rate limit
+    woeids   - Places to poll; default all trend locations
+    rounds   - Number of rounds; default forever
+
+    Yields dicts with the woeid, time, and the entered, left, moved
+    and changed trends of the place; see diff_trends. The first round
+    of a place has all its trends entered.
+    """
+
+    if woeids is None:
+        woeids = get_woeids(auth)
+
+    shortest = min_interval(auth, len(woeids))
+    if interval < shortest:
+        log.info("Raising interval to {:.0f} secs for the rate limit",
+                 shortest)
+        interval = shortest
+
+    auths = auth.clones(nthreads)
+    last = {}
+
+    count = 0
+    while rounds is None or count < rounds:
+        start = time.time()
+
+        results = workers.imap(trends_place, woeids, auths, ordered=False)
+        nchanged = 0
+        for woeid, ts, trends in results:
+            if trends is None:
+                continue
+
+            delta = diff_trends(last.get(woeid, []), trends)
+            last[woeid] = trends
+            if any(delta):
+                nchanged += 1
+                entered, left, moved, changed = delta
+                yield {"woeid": woeid, "time": ts, "entered": entered,
+                       "left": left, "moved": moved, "changed": changed}
+
+        count += 1
+        log.info("Round {} done; {} of {} places changed",
+                 count, nchanged, len(woeids))
+
+        wait = start + interval - time.time()
+        if wait > 0 and (rounds is None or count < rounds):
+            time.sleep(wait)
+
+def poll_trends(auth, fname, **kwargs):
+    """
+    Poll the trends, appending the changes to the file.
+
+    Takes the arguments of trends_deltas.
+    Returns the number of changes written.
+    """
+
+    count = 0
+    with open(fname, "a") as fobj:
+        for delta in trends_deltas(auth, **kwargs):
+            fobj.write(json.dumps(delta) + "\n")
+            fobj.flush()
+            count += 1
+    return count
@@ -0,0 +1,153 @@
+"""
+Make api calls concurrently on a small pool of threads.
+
+Every thread is given its own auth object, so that non thread safe state
+(like the current key of a MultiAuth) is never shared between threads.
+"""
+
+import sys
+import Queue
+import threading
+from itertools import islice
+
+import logbook
+
+import wriggler.budget as budget
+
+log = logbook.Logger(__name__)
+
+def put(queue, item, stop):
+    """
+    Put the item on the bounded queue, unless stop is set first.
+
+    Returns True if the item was put.
+    """
+
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=1.0)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def produce(items, queue, stop):
+    """
+    Iterate over the items on a background thread, putting them on queue.
+
+    Puts (True, item) for every item, then (False, None) when done or
+    (False, error) if the iteration failed. The thread stops early once
+    stop is set. Retries in the thread draw from the caller's budget.
+
+    Returns the started thread.
+    """
+
+    job = budget.job()
+
+    def run():
+        try:
+            with budget.use(job):
+                for item in items:
+                    if not put(queue, (True, item), stop):
+                        return
+        except Exception: # pylint: disable=broad-except
+            log.debug(u"Producer failed", exc_info=True)
+            put(queue, (False, sys.exc_info()[1]), stop)
+            return
+        put(queue, (False, None), stop)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def prefetch(items, depth):
+    """
+    Iterate over the items, produced by a background thread.
+
+    The thread runs at most depth items ahead of the consumer. Closing
+    the iterator waits for the thread to finish its current item, so
+    the auth it uses is not used by both afterwards.
+    """
+
+    queue, stop = Queue.Queue(depth), threading.Event()
+    thread = produce(items, queue, stop)
+
+    try:
+        while True:
+            ok, item = queue.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def imap(func, iterable, auths, ordered=True, window=None):
+    """
+    Call func(auth, item) for every item, using one thread per auth.
+
+    The iterable is consumed lazily; at most window items (default twice
+    the number of threads) are in flight or waiting to be yielded.
+    Results are yielded in input order if ordered, else as they complete.
+    An exception raised by func is raised again in the caller.
+    """
+
+    auths = list(auths)
+    if window is None:
+        window = 2 * len(auths)
+
+    tasks, results = Queue.Queue(), Queue.Queue()
+
+    # Retries in the threads draw from the caller's budget
+    job = budget.job()
+
+    def work(auth):
+        with budget.use(job):
+            for idx, item in iter(tasks.get, None):
+                try:
+                    results.put((idx, True, func(auth, item)))
+                except Exception: # pylint: disable=broad-except
+                    log.debug(u"Call failed on item {}", idx, exc_info=True)
+                    results.put((idx, False, sys.exc_info()[1]))
+
+    threads = [threading.Thread(target=work, args=(auth,)) for auth in auths]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    items = enumerate(iterable)
+    pending, done, nxt = 0, {}, 0
+    try:
+        for task in islice(items, window):
+            tasks.put(task)
+            pending += 1
+
+        while pending:
+            idx, ok, ret = results.get()
+            pending -= 1
+            if not ok:
+                raise ret
+
+            if not ordered:
+                yield ret
+            else:
+                done[idx] = ret
+                while nxt in done:
+                    yield done.pop(nxt)
+                    nxt += 1
+
+            for task in islice(items, max(window - pending - len(done), 0)):
+                tasks.put(task)
+                pending += 1
+    finally:
+        # Drop the queued tasks and stop the threads
+        try:
+            while True:
+                tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        for _ in threads:
+            tasks.put(None)